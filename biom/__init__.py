@@ -38,6 +38,7 @@ except ImportError:
 biom_config = load_biom_config()
 
 sparse_backends = ['CSMat', 'ScipySparseMat']
+sparse_storages = ['default', 'compact']
 
 def set_sparse_backend(sparse_backend, warn=True):
     """Sets the sparse matrix backend to use in biom.table.
@@ -120,3 +121,32 @@ def get_sparse_backend():
     return SparseObj, to_sparse, dict_to_sparseobj, list_dict_to_sparseobj, \
            list_nparray_to_sparseobj, nparray_to_sparseobj, \
            list_list_to_sparseobj
+
+def get_coo_arrays_to_sparseobj(sparse_obj):
+    """Returns the function building a sparse_obj from COO arrays.
+
+    sparse_obj is the sparse matrix class returned by get_sparse_backend. The
+    function takes ``(values, (rows, cols))`` arrays, a dtype and a shape, and
+    sums duplicate entries.
+    """
+    if sparse_obj.__name__ == 'ScipySparseMat':
+        from biom.backends.scipysparse import coo_arrays_to_scipy
+        return coo_arrays_to_scipy
+    elif sparse_obj.__name__ == 'CSMat':
+        from biom.backends.csmat import coo_arrays_to_csmat
+        return coo_arrays_to_csmat
+    else:
+        raise InvalidSparseBackendException("Unrecognized sparse backend "
+                                            "'%s'." % sparse_obj.__name__)
+
+def get_sparse_storage():
+    """Returns the storage policy for the data of new tables.
+
+    Read from the python_code_sparse_storage value in the biom config dict,
+    defaulting to 'default'. With 'compact', tables store their values as
+    float32 or int32 and use the smallest index type the backend supports.
+    """
+    storage = biom_config['python_code_sparse_storage']
+    if storage is None:
+        storage = 'default'
+    return storage
@@ -10,10 +10,11 @@
 
 import numpy as np
 from numpy import (array, ndarray, concatenate, argsort, searchsorted, uint32,
-                   zeros)
+                   zeros, bincount, cumsum, repeat, arange, diff)
 from operator import itemgetter
-from biom.util import flatten
+from biom.util import flatten, compact_dtype, sum_dtype
 from biom.exception import TableException
+from biom.backends.vectorview import SparseVectorView
 from itertools import izip
 
 __author__ = "Daniel McDonald"
@@ -44,6 +45,9 @@ class CSMat(object):
         The numpy array that is returned will always be a 1-dimensional row
         vector.
         """
+        if isinstance(vec, SparseVectorView):
+            return vec.todense()
+
         vals = vec.items()
         num_rows, num_cols = vec.shape
 
@@ -68,6 +72,9 @@ class CSMat(object):
         self._coo_rows = []
         self._coo_cols = []
 
+        # staged writes, {(row, col): value}, packed in bulk on read
+        self._dok = {}
+
         # yale, or csr/csc format
         self._values = array([], dtype=dtype)
         self._pkd_ax = array([], dtype=uint32)
@@ -84,9 +91,25 @@ class CSMat(object):
             return self._pkd_ax[-1]
     size = property(_get_size)
 
+    def _get_nbytes(self):
+        """Returns the number of bytes held by the compressed arrays.
+
+        A matrix still in COO order is converted to CSR first.
+        """
+        if self._order == "coo":
+            self.convert("csr")
+        elif self.hasUpdates():
+            self.absorbUpdates()
+
+        return self._pkd_ax.nbytes + self._unpkd_ax.nbytes + \
+               self._values.nbytes
+    nbytes = property(_get_nbytes)
+
     def transpose(self):
         """Transpose self"""
         new_self = self.copy()
+        if new_self._dok:
+            new_self._absorbStaged()
 
         if new_self._order != "coo":
             rebuild = new_self._order
@@ -111,30 +134,33 @@ class CSMat(object):
         ``axis`` can be ``None``, 0, or 1.
         """
         if axis is None:
-            if self._order != 'coo':
+            if self._order != 'coo' or self._dok:
                 self.convert('coo')
 
             return np.sum(self._coo_values)
         elif axis == 0:
-            num_cols = self.shape[1]
-            col_sums = zeros(num_cols)
-
-            for col_idx in range(num_cols):
-                col_sums[col_idx] = self.getCol(col_idx).sum()
-
-            return col_sums
+            return self._sum_compressed('csc')
         elif axis == 1:
-            num_rows = self.shape[0]
-            row_sums = zeros(num_rows)
-
-            for row_idx in range(num_rows):
-                row_sums[row_idx] = self.getRow(row_idx).sum()
-
-            return row_sums
+            return self._sum_compressed('csr')
         else:
             raise ValueError("Invalid axis to sum over. Must be None, 0, or "
                              "1.")
 
+    def _sum_compressed(self, order):
+        """Sums each row (csr) or column (csc) in sum_dtype of the values"""
+        pkd_ax, unpkd_ax, values = self.getCompressedArrays(order)
+        dtype = sum_dtype(values.dtype)
+        sums = zeros(len(pkd_ax) - 1, dtype=dtype)
+
+        # reduceat over the starts of the non-empty vectors only, as it
+        # returns the value at the start index for an empty segment
+        nonempty = np.flatnonzero(diff(pkd_ax))
+        if len(nonempty):
+            sums[nonempty] = np.add.reduceat(values, pkd_ax[nonempty],
+                                             dtype=dtype)
+
+        return sums
+
     def update(self, data):
         """Update from a dict"""
         for (r,c),v in data.iteritems():
@@ -150,17 +176,19 @@ class CSMat(object):
 
     def hasUpdates(self):
         """Returns true if it appears there are updates"""
-        if len(self._coo_values) != 0:
+        if self._dok or len(self._coo_values) != 0:
             return True
         else:
             return False
 
     def absorbUpdates(self):
-        """If there are COO values not in CS form, pack them in"""
+        """If there are staged or COO values not in CS form, pack them in"""
         if self._order == 'coo':
+            if self._dok:
+                self._absorbStaged()
             return
         
-        if not self._coo_values:
+        if not self._coo_values and not self._dok:
             return
 
         # possibly a better way to do this
@@ -170,6 +198,9 @@ class CSMat(object):
 
     def convert(self, to_order):
         """Converts to csc <-> csr, csc <-> coo, csr <-> coo"""
+        if self._dok:
+            self._absorbStaged()
+
         if self._order == to_order:
             return
 
@@ -229,6 +260,187 @@ class CSMat(object):
 
         return v
 
+    def getRowView(self, row):
+        """Returns a read-only SparseVectorView of a row
+
+        The view shares the csr arrays of self rather than copying them.
+        """
+        if row >= self.shape[0] or row < 0:
+            raise IndexError, "Row %d is out of bounds!" % row
+
+        pkd_ax, unpkd_ax, values = self.getCompressedArrays('csr')
+        start, stop = pkd_ax[row], pkd_ax[row + 1]
+        return SparseVectorView(unpkd_ax[start:stop], values[start:stop],
+                                (1, self.shape[1]))
+
+    def getColView(self, col):
+        """Returns a read-only SparseVectorView of a col
+
+        The view shares the csc arrays of self rather than copying them.
+        """
+        if col >= self.shape[1] or col < 0:
+            raise IndexError, "Col %d is out of bounds!" % col
+
+        pkd_ax, unpkd_ax, values = self.getCompressedArrays('csc')
+        start, stop = pkd_ax[col], pkd_ax[col + 1]
+        return SparseVectorView(unpkd_ax[start:stop], values[start:stop],
+                                (self.shape[0], 1))
+
+    def getCompressedArrays(self, order):
+        """Returns (pkd_ax, unpkd_ax, values) of self in order
+
+        order is either csr or csc. The unpacked axis is sorted within each
+        row (or column). The arrays are the internal storage of self and must
+        not be modified.
+        """
+        if order not in ('csr', 'csc'):
+            raise ValueError, "Unknown order: %s" % order
+
+        if self.hasUpdates():
+            self.absorbUpdates()
+
+        self.convert(order)
+
+        return self._pkd_ax, self._unpkd_ax, self._values
+
+    def withValues(self, values, order):
+        """Return a CSMat with the structure of self in order holding values
+
+        values replaces the values array returned by getCompressedArrays. The
+        packed and unpacked axes are shared with self rather than copied.
+        """
+        pkd_ax, unpkd_ax, old_values = self.getCompressedArrays(order)
+        values = np.asarray(values)
+
+        if values.shape != old_values.shape:
+            raise ValueError, "Expected %d values, got %d" % (old_values.size,
+                                                              values.size)
+
+        new_self = CSMat(*self.shape, dtype=values.dtype.type)
+        new_self._pkd_ax = pkd_ax
+        new_self._unpkd_ax = unpkd_ax
+        new_self._values = values
+        new_self._order = order
+
+        return new_self
+
+    def compact(self, value_dtype=None):
+        """Return a CSMat holding the values as value_dtype
+
+        value_dtype defaults to compact_dtype of the values. The axes are
+        always uint32, so self is returned if the values already have that
+        dtype.
+        """
+        order = self._order if self._order in ("csr", "csc") else "csr"
+        values = self.getCompressedArrays(order)[2]
+
+        if value_dtype is None:
+            value_dtype = compact_dtype(values)
+
+        if values.dtype == value_dtype:
+            return self
+
+        return self.withValues(values.astype(value_dtype), order)
+
+    def dot(self, other):
+        """Return the matrix product of self and other as a CSMat
+
+        Each nonzero self[i,j] is expanded against row j of other, and the
+        partial products are summed by coo_arrays_to_csmat.
+        """
+        if self.shape[1] != other.shape[0]:
+            raise ValueError, "Cannot multiply a %dx%d matrix by a %dx%d " \
+                              "matrix" % (self.shape + other.shape)
+
+        a_pkd, a_cols, a_values = self.getCompressedArrays('csr')
+        b_pkd, b_cols, b_values = other.getCompressedArrays('csr')
+
+        a_pkd = a_pkd.astype(np.int64)
+        b_pkd = b_pkd.astype(np.int64)
+        a_rows = np.repeat(np.arange(self.shape[0]), np.diff(a_pkd))
+
+        # the number of partial products contributed by each self nonzero
+        counts = np.diff(b_pkd)[a_cols]
+        starts = np.cumsum(counts) - counts
+        offsets = np.arange(counts.sum()) - np.repeat(starts, counts) + \
+                  np.repeat(b_pkd[a_cols], counts)
+
+        rows = np.repeat(a_rows, counts)
+        cols = b_cols[offsets]
+        values = np.repeat(a_values, counts) * b_values[offsets]
+
+        dtype = np.result_type(self.dtype, other.dtype).type
+        return coo_arrays_to_csmat((values, (rows, cols)), dtype=dtype,
+                                   shape=(self.shape[0], other.shape[1]))
+
+    def take(self, indices, axis):
+        """Return the rows (axis=0) or columns (axis=1) at indices as a CSMat
+
+        indices may reorder or repeat rows (or columns). The packed segments
+        of the selected vectors are gathered in a single pass.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+
+        if axis == 0:
+            order = 'csr'
+            new_shape = (len(indices), self.shape[1])
+        elif axis == 1:
+            order = 'csc'
+            new_shape = (self.shape[0], len(indices))
+        else:
+            raise ValueError, "Unknown axis: %s" % axis
+
+        pkd_ax, unpkd_ax, values = self.getCompressedArrays(order)
+        pkd_ax = pkd_ax.astype(np.int64)
+
+        counts = np.diff(pkd_ax)[indices]
+        new_pkd_ax = zeros(len(indices) + 1, dtype=uint32)
+        np.cumsum(counts, out=new_pkd_ax[1:])
+
+        starts = new_pkd_ax[:-1].astype(np.int64)
+        offsets = np.arange(counts.sum()) - np.repeat(starts, counts) + \
+                  np.repeat(pkd_ax[indices], counts)
+
+        new_self = CSMat(*new_shape, dtype=self.dtype)
+        new_self._pkd_ax = new_pkd_ax
+        new_self._unpkd_ax = unpkd_ax[offsets]
+        new_self._values = values[offsets]
+        new_self._order = order
+
+        return new_self
+
+    def getValues(self, rows, cols):
+        """Returns the values at each (rows[i], cols[i]) as an array
+
+        The csr arrays are sorted by row and then column, so all coordinates
+        are found with a single binary search over their linear positions.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+
+        if rows.shape != cols.shape:
+            raise ValueError, "rows and cols must be the same length"
+        if len(rows) and (rows.min() < 0 or rows.max() >= self.shape[0]):
+            raise IndexError, "Row index out of bounds!"
+        if len(cols) and (cols.min() < 0 or cols.max() >= self.shape[1]):
+            raise IndexError, "Col index out of bounds!"
+
+        pkd_ax, unpkd_ax, values = self.getCompressedArrays('csr')
+        n_cols = self.shape[1]
+
+        linear = self._expand_compressed(pkd_ax).astype(np.int64)
+        linear *= n_cols
+        linear += unpkd_ax
+        query = rows * n_cols + cols
+
+        pos = searchsorted(linear, query)
+        found = pos < len(linear)
+        found[found] = linear[pos[found]] == query[found]
+
+        result = zeros(len(query), dtype=values.dtype)
+        result[found] = values[pos[found]]
+        return result
+
     def items(self):
         """returns [((r,c),v)]"""
         if self.hasUpdates():
@@ -273,6 +485,9 @@ class CSMat(object):
 
     def __contains__(self, args):
         """Return True if args are in self, false otherwise"""
+        if tuple(args) in self._dok:
+            return True
+
         if self._getitem(args) == (None, None, None):
             return False
         else:
@@ -284,6 +499,7 @@ class CSMat(object):
         new_self._coo_rows = self._coo_rows[:]
         new_self._coo_cols = self._coo_cols[:]
         new_self._coo_values = self._coo_values[:]
+        new_self._dok = self._dok.copy()
         new_self._pkd_ax = self._pkd_ax.copy()
         new_self._unpkd_ax = self._unpkd_ax.copy()
         new_self._values = self._values.copy()
@@ -362,16 +578,8 @@ class CSMat(object):
                 raise ValueError("Cannot set an existing non-zero element to "
                                  "zero.")
         else:
-            res = self._getitem(args)
-            if res == (None, None, None):
-                self._coo_rows.append(row)
-                self._coo_cols.append(col)
-                self._coo_values.append(value)
-            else:
-                if self._order == "coo":
-                    self._coo_values[res[0]] = value
-                else:
-                    self._values[res[-1]] = value
+            # staged in O(1), packed in bulk by absorbUpdates
+            self._dok[(row, col)] = value
 
     def __getitem__(self,args):
         """Wrap getitem to handle slices"""
@@ -396,6 +604,9 @@ class CSMat(object):
             if col >= self.shape[1] or col < 0:
                 raise IndexError, "Col out of bounds!"
 
+            if (row, col) in self._dok:
+                return self._dok[(row, col)]
+
             res = self._getitem(args)
             if res == (None,None,None):
                 return self.dtype(0)
@@ -415,24 +626,27 @@ class CSMat(object):
 
         if order is coo, returns
         rows_idx, cols_idx, values_idx (all the same thing...)
+
+        Staged writes are not searched, callers must check _dok first
         """
-        if self.hasUpdates():
+        if self._coo_values and self._order != 'coo':
             self.absorbUpdates()
 
         row,col = args
         if self._order == 'csr':
+            # the unpacked axis is sorted within each row
             start = self._pkd_ax[row]
             stop = self._pkd_ax[row+1]
-            for i,c in enumerate(self._unpkd_ax[start:stop]):
-                if c == col:
-                    return (row, start+i, start+i)
+            i = start + self._unpkd_ax[start:stop].searchsorted(col)
+            if i < stop and self._unpkd_ax[i] == col:
+                return (row, i, i)
 
         elif self._order == 'csc':
             start = self._pkd_ax[col]
             stop = self._pkd_ax[col+1]
-            for i,r in enumerate(self._unpkd_ax[start:stop]):
-                if r == row:
-                    return (start+i, col, start+i)
+            i = start + self._unpkd_ax[start:stop].searchsorted(row)
+            if i < stop and self._unpkd_ax[i] == row:
+                return (i, col, i)
 
         elif self._order == "coo":
             # O(N) naive... but likely not a major use case
@@ -446,6 +660,37 @@ class CSMat(object):
 
         return (None, None, None)
 
+    def _absorbStaged(self):
+        """Packs the staged writes into the COO lists
+
+        A staged write replaces any value stored at the same (row, col).
+        Leaves self in COO order.
+        """
+        if self._order != "coo":
+            self._buildCOOfromCS()
+
+        rows, cols = zip(*self._dok.keys())
+        values = self._dok.values()
+        self._dok = {}
+
+        if self._coo_values:
+            n_cols = self.shape[1]
+            linear = array(self._coo_rows, dtype=np.int64) * n_cols + \
+                     array(self._coo_cols, dtype=np.int64)
+            staged_linear = array(rows, dtype=np.int64) * n_cols + \
+                            array(cols, dtype=np.int64)
+            replaced = np.in1d(linear, staged_linear)
+
+            if replaced.any():
+                keep = np.flatnonzero(~replaced)
+                self._coo_rows = [self._coo_rows[i] for i in keep]
+                self._coo_cols = [self._coo_cols[i] for i in keep]
+                self._coo_values = [self._coo_values[i] for i in keep]
+
+        self._coo_rows.extend(rows)
+        self._coo_cols.extend(cols)
+        self._coo_values.extend(values)
+
     def _buildCSfromCS(self):
         """Convert csc <-> csr"""
         expanded = self._expand_compressed(self._pkd_ax)
@@ -461,14 +706,8 @@ class CSMat(object):
 
     def _expand_compressed(self, pkd_ax):
         """Expands packed axis"""
-        expanded = zeros(pkd_ax[-1], dtype=uint32)
-        last_idx = 0
-        pos = uint32(0)
-        for idx in pkd_ax[1:]:
-            expanded[last_idx:idx] = pos
-            pos += 1
-            last_idx = idx
-        return expanded
+        n_vectors = len(pkd_ax) - 1
+        return repeat(arange(n_vectors, dtype=uint32), diff(pkd_ax))
             
     def _buildCOOfromCS(self):
         """Constructs a COO representation from CSC or CSR
@@ -528,103 +767,51 @@ class CSMat(object):
 
     def _toCSR(self, rows, cols, values):
         """Returns packed_axis, unpacked_axis and values"""
-        values = array(values, dtype=self.dtype)
-        unpkd_ax = array(cols, dtype=uint32)
-        tmp_rows = array(rows, dtype=uint32)
-
-        order = argsort(tmp_rows)
-        values = values.take(order)
-        tmp_rows = tmp_rows.take(order)
-        unpkd_ax = unpkd_ax.take(order)
-
-        v_last = -1
-        pkd_ax = []
-        pos = 0
-        p_last = 0
-        expected_row_idx = 0
-
-        # determine starting values idx for each row
-        # sort values and columns within each row
-        for v in tmp_rows:
-            if v != v_last:
-                pkd_ax.append(pos)
-
-                # Determine if we skipped any rows (i.e. we have empty rows).
-                # Copy the last row's index for all empty rows.
-                num_empty_rows = v - expected_row_idx
-                if num_empty_rows > 0:
-                    pkd_ax.extend([pkd_ax[-1]] * num_empty_rows)
-                expected_row_idx = v + 1
-
-                col_order = argsort(unpkd_ax[p_last:pos])
-                unpkd_ax[p_last:pos] = unpkd_ax[p_last:pos].take(col_order)
-                values[p_last:pos] = values[p_last:pos].take(col_order)
-                v_last = v
-                p_last = pos
-            pos += 1
-        # catch last column sort    
-        col_order = argsort(unpkd_ax[p_last:pos])
-        unpkd_ax[p_last:pos] = unpkd_ax[p_last:pos].take(col_order)
-        values[p_last:pos] = values[p_last:pos].take(col_order)
-        
-        pkd_ax.append(pos)
-
-        num_trailing_rows = self.shape[0] - expected_row_idx
-        if num_trailing_rows > 0:
-            pkd_ax.extend([pkd_ax[-1]] * num_trailing_rows)
-
-        pkd_ax = array(pkd_ax, dtype=uint32)
-
-        return (pkd_ax, unpkd_ax, values)
+        return self._toCS(rows, cols, values, self.shape[0])
 
     def _toCSC(self, rows, cols, values):
         """Returns packed_axis, unpacked_axis, values"""
-        values = array(values, dtype=self.dtype)
-        unpkd_ax = array(rows, dtype=uint32)
-        tmp_cols = array(cols, dtype=uint32)
+        return self._toCS(cols, rows, values, self.shape[1])
+
+    def _toCS(self, pkd, unpkd, values, n_pkd):
+        """Returns packed_axis, unpacked_axis, values
 
-        order = argsort(tmp_cols)
+        pkd holds the indices along the axis to compress and n_pkd is the
+        length of that axis
+        """
+        values = array(values, dtype=self.dtype)
+        unpkd_ax = array(unpkd, dtype=uint32)
+        tmp_pkd = array(pkd, dtype=uint32)
+
+        # stable sort by packed index, then unpacked index within each vector
+        n_unpkd = int(unpkd_ax.max()) + 1 if len(unpkd_ax) else 1
+        linear = tmp_pkd.astype(np.int64)
+        linear *= n_unpkd
+        linear += unpkd_ax
+        order = _stable_argsort(linear, (n_pkd + 1) * n_unpkd)
         values = values.take(order)
-        tmp_cols = tmp_cols.take(order)
         unpkd_ax = unpkd_ax.take(order)
 
-        v_last = -1
-        pkd_ax = []
-        pos = 0
-        p_last = 0
-        expected_col_idx = 0
-
-        ### gotta be something in numpy that does this...
-        for v in tmp_cols:
-            if v != v_last:
-                pkd_ax.append(pos)
-
-                num_empty_cols = v - expected_col_idx
-                if num_empty_cols > 0:
-                    pkd_ax.extend([pkd_ax[-1]] * num_empty_cols)
-                expected_col_idx = v + 1
-
-                row_order = argsort(unpkd_ax[p_last:pos])
-                unpkd_ax[p_last:pos] = unpkd_ax[p_last:pos].take(row_order)
-                values[p_last:pos] = values[p_last:pos].take(row_order)
-                v_last = v
-                p_last = pos
-            pos += 1
-        
-        # catch last row sort
-        row_order = argsort(unpkd_ax[p_last:pos])
-        unpkd_ax[p_last:pos] = unpkd_ax[p_last:pos].take(row_order)
-        values[p_last:pos] = values[p_last:pos].take(row_order)
+        # the pointer of each vector is the number of values before it
+        counts = bincount(tmp_pkd, minlength=n_pkd)
+        pkd_ax = zeros(len(counts) + 1, dtype=uint32)
+        cumsum(counts, out=pkd_ax[1:])
 
-        pkd_ax.append(pos)
+        return (pkd_ax, unpkd_ax, values)
 
-        num_trailing_cols = self.shape[1] - expected_col_idx
-        if num_trailing_cols > 0:
-            pkd_ax.extend([pkd_ax[-1]] * num_trailing_cols)
+def _stable_argsort(keys, n_keys):
+    """Stable argsort of non-negative integer keys less than n_keys
 
-        pkd_ax = array(pkd_ax, dtype=uint32)
+    Ties are broken by position so that the faster quicksort returns the
+    stable order. Falls back to a mergesort if that could overflow.
+    """
+    n = len(keys)
+    if int(n_keys) * n >= 2 ** 63:
+        return argsort(keys, kind='mergesort')
 
-        return (pkd_ax, unpkd_ax, values)
+    unique_keys = keys * n
+    unique_keys += np.arange(n, dtype=np.int64)
+    return argsort(unique_keys)
 
 def to_csmat(values, transpose=False, dtype=float):
     """Tries to returns a populated CSMat object
@@ -693,10 +880,55 @@ def list_list_to_csmat(data, dtype=float, shape=None):
     else:
         n_rows, n_cols = shape
 
-    mat = CSMat(n_rows, n_cols)
+    mat = CSMat(n_rows, n_cols, dtype=dtype)
     mat.bulkCOOUpdate(rows, cols, values)
     return mat
 
+def coo_arrays_to_csmat(data, dtype=float, shape=None):
+    """Convert (values, (rows, cols)) arrays into a CSMat
+
+    Duplicate (row, col) entries are summed in dtype and zeros are dropped.
+    The CSMat is built directly in csr order.
+    """
+    values, (rows, cols) = data
+    values = np.asarray(values).astype(dtype, copy=False)
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+
+    if shape is None:
+        n_rows = rows.max() + 1
+        n_cols = cols.max() + 1
+    else:
+        n_rows, n_cols = shape
+
+    mat = CSMat(n_rows, n_cols, dtype=dtype)
+
+    # sort into csr order and sum runs of the same (row, col)
+    linear = rows * n_cols + cols
+    order = argsort(linear, kind='mergesort')
+    linear = linear[order]
+    values = values[order]
+
+    starts = np.flatnonzero(np.r_[True, linear[1:] != linear[:-1]]) \
+             if len(linear) else np.array([], dtype=np.int64)
+    linear = linear[starts]
+    summed = np.add.reduceat(values, starts) if len(starts) else values
+
+    nonzero = summed != 0
+    linear = linear[nonzero]
+    summed = summed[nonzero]
+
+    pkd_ax = zeros(n_rows + 1, dtype=uint32)
+    np.cumsum(np.bincount(linear // n_cols, minlength=n_rows),
+              out=pkd_ax[1:])
+
+    mat._pkd_ax = pkd_ax
+    mat._unpkd_ax = (linear % n_cols).astype(uint32)
+    mat._values = summed.astype(dtype)
+    mat._order = "csr"
+
+    return mat
+
 def nparray_to_csmat(data, dtype=float):
     """Convert a numpy array to a CSMat"""
     rows = []
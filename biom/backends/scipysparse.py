@@ -22,11 +22,14 @@ __email__ = "jai.rideout@gmail.com"
 from itertools import izip
 from operator import itemgetter
 
-from numpy import asarray, ndarray, newaxis, squeeze, float64
-from scipy.sparse import coo_matrix
+from numpy import (asarray, ndarray, newaxis, squeeze, float64, zeros, array,
+                   int32, int64, iinfo, cumsum, concatenate)
+from scipy.sparse import coo_matrix, csr_matrix, csc_matrix
 
+from biom import biom_config
+from biom.backends.vectorview import SparseVectorView
 from biom.exception import TableException
-from biom.util import flatten
+from biom.util import flatten, compact_dtype
 
 class ScipySparseMat(object):
     """Sparse matrix backend that utilizes scipy.sparse representations.
@@ -43,6 +46,9 @@ class ScipySparseMat(object):
         The numpy array that is returned will always be a 1-dimensional row
         vector.
         """
+        if isinstance(vec, SparseVectorView):
+            return vec.todense()
+
         dense_vec = asarray(vec._matrix.todense())
 
         if vec.shape == (1, 1):
@@ -78,6 +84,16 @@ class ScipySparseMat(object):
                 self.convert('csr')
                 self._matrix.eliminate_zeros()
 
+    def _get_matrix(self):
+        """Return the scipy matrix in its current format."""
+        return self._current_matrix
+
+    def _set_matrix(self, matrix):
+        """Set the scipy matrix, dropping any cached formats."""
+        self._cache = {}
+        self._current_matrix = matrix
+    _matrix = property(_get_matrix, _set_matrix)
+
     def _is_empty(self):
         """Return ``True`` if the matrix is empty/null.
 
@@ -119,14 +135,53 @@ class ScipySparseMat(object):
             return self._matrix.nnz
     size = property(_get_size)
 
+    def _get_nbytes(self):
+        """Return the number of bytes held by the matrix and its cache.
+
+        A matrix in lil format is converted to csr first.
+        """
+        if self.is_empty:
+            return 0
+
+        if self.fmt not in ('coo', 'csr', 'csc'):
+            self.convert('csr')
+
+        return sum([_matrix_nbytes(m)
+                    for m in [self._matrix] + self._cache.values()])
+    nbytes = property(_get_nbytes)
+
     def convert(self, fmt=None):
         """Convert the matrix to the specified sparse format.
 
         If ``fmt`` is ``None`` or we're already in the specified format, do
         nothing.
+
+        If the ``python_code_sparse_dual_cache_max_bytes`` biom config value
+        is set, the csr and csc formats are kept after converting away from
+        them, as long as the cached matrices fit within that many bytes.
+        Converting back is then free. The cache is dropped whenever the matrix
+        changes.
         """
-        if not self.is_empty:
-            self._matrix = self._matrix.asformat(fmt)
+        if self.is_empty or fmt is None:
+            return
+
+        current = self._matrix
+        if current.getformat() == fmt:
+            return
+
+        cache = self._cache
+        converted = cache.pop(fmt, None)
+        if converted is None:
+            converted = current.asformat(fmt)
+
+        if current.getformat() in ('csr', 'csc'):
+            cache_bytes = sum([_matrix_nbytes(m) for m in cache.values()])
+            if cache_bytes + _matrix_nbytes(current) <= \
+                    get_dual_cache_max_bytes():
+                cache[current.getformat()] = current
+
+        self._matrix = converted
+        self._cache = cache
 
     def transpose(self):
         """Return a transposed copy of ``self``."""
@@ -202,6 +257,178 @@ class ScipySparseMat(object):
 
         return col_vector
 
+    def getRowView(self, row_idx):
+        """Return a read-only view of the row at ``row_idx``.
+
+        The ``SparseVectorView`` shares the csr arrays of the matrix instead
+        of copying them.
+        """
+        if self.is_empty:
+            raise IndexError("Cannot retrieve a row from an "
+                             "empty/null matrix.")
+
+        num_rows, num_cols = self.shape
+        if row_idx >= num_rows or row_idx < 0:
+            raise IndexError("Row index %d is out of bounds." % row_idx)
+
+        indptr, indices, data = self.getCompressedArrays('csr')
+        start, end = indptr[row_idx:row_idx + 2]
+        return SparseVectorView(indices[start:end], data[start:end],
+                                (1, num_cols))
+
+    def getColView(self, col_idx):
+        """Return a read-only view of the column at ``col_idx``.
+
+        The ``SparseVectorView`` shares the csc arrays of the matrix instead
+        of copying them.
+        """
+        if self.is_empty:
+            raise IndexError("Cannot retrieve a column from an "
+                             "empty/null matrix.")
+
+        num_rows, num_cols = self.shape
+        if col_idx >= num_cols or col_idx < 0:
+            raise IndexError("Column index %d is out of bounds." % col_idx)
+
+        indptr, indices, data = self.getCompressedArrays('csc')
+        start, end = indptr[col_idx:col_idx + 2]
+        return SparseVectorView(indices[start:end], data[start:end],
+                                (num_rows, 1))
+
+    def getCompressedArrays(self, order):
+        """Return ``(indptr, indices, data)`` of the matrix in ``order``.
+
+        ``order`` must be either ``csr`` or ``csc``. The indices are sorted
+        within each row (or column). The returned arrays are the matrix's own
+        storage and must not be modified.
+        """
+        if order not in ('csr', 'csc'):
+            raise ValueError("Unknown order: %s" % order)
+
+        if self.is_empty:
+            num_ptrs = self.shape[0 if order == 'csr' else 1] + 1
+            return (zeros(num_ptrs, dtype=int32), array([], dtype=int32),
+                    array([]))
+
+        self.convert(order)
+        self._matrix.sort_indices()
+
+        return self._matrix.indptr, self._matrix.indices, self._matrix.data
+
+    def withValues(self, values, order):
+        """Return a new matrix with the structure of ``self`` and ``values``.
+
+        ``values`` replaces the data array returned by
+        ``getCompressedArrays(order)``. The ``indptr`` and ``indices`` arrays
+        are shared with ``self`` rather than copied, and the new matrix has the
+        dtype of ``values``.
+        """
+        indptr, indices, data = self.getCompressedArrays(order)
+        values = asarray(values)
+
+        if values.shape != data.shape:
+            raise ValueError("Expected %d values, got %d." % (data.size,
+                                                               values.size))
+
+        new_self = ScipySparseMat(*self.shape, dtype=values.dtype)
+
+        if not self.is_empty:
+            matrix_type = csr_matrix if order == 'csr' else csc_matrix
+            new_self._matrix = matrix_type((values, indices, indptr),
+                                           shape=self.shape, copy=False)
+
+        return new_self
+
+    def compact(self, value_dtype=None):
+        """Return the matrix stored in as few bytes as possible.
+
+        The index arrays are int32 whenever that can address the matrix, as
+        scipy does not support smaller index types. The values are cast to
+        ``value_dtype``, which defaults to ``compact_dtype`` of the values.
+        ``self`` is returned if nothing would change, otherwise the index
+        arrays may be shared with ``self``.
+        """
+        if self.is_empty:
+            return self
+
+        order = self.fmt if self.fmt in ('csr', 'csc') else 'csr'
+        indptr, indices, data = self.getCompressedArrays(order)
+
+        if value_dtype is None:
+            value_dtype = compact_dtype(data)
+
+        if max(self.shape + (len(data),)) <= iinfo(int32).max:
+            index_dtype = int32
+        else:
+            index_dtype = int64
+
+        if data.dtype == value_dtype and indices.dtype == index_dtype and \
+                indptr.dtype == index_dtype:
+            return self
+
+        matrix_type = csr_matrix if order == 'csr' else csc_matrix
+        new_self = ScipySparseMat(*self.shape, dtype=value_dtype)
+        new_self._matrix = matrix_type(
+                (data.astype(value_dtype, copy=False),
+                 indices.astype(index_dtype, copy=False),
+                 indptr.astype(index_dtype, copy=False)),
+                shape=self.shape, copy=False)
+
+        return new_self
+
+    def dot(self, other):
+        """Return the matrix product of ``self`` and ``other``.
+
+        ``other`` must be a ``ScipySparseMat`` with as many rows as ``self``
+        has columns. The product is returned in csr format.
+        """
+        if self.shape[1] != other.shape[0]:
+            raise ValueError("Cannot multiply a %dx%d matrix by a %dx%d "
+                             "matrix." % (self.shape + other.shape))
+
+        n_rows = self.shape[0]
+        n_cols = other.shape[1]
+
+        if self.is_empty or other.is_empty:
+            return self.__class__(n_rows, n_cols)
+
+        self.convert('csr')
+        other.convert('csr')
+
+        product = self.__class__(n_rows, n_cols)
+        product._matrix = (self._matrix * other._matrix).tocsr()
+        product._matrix.eliminate_zeros()
+
+        return product
+
+    def take(self, indices, axis):
+        """Return the rows (``axis=0``) or columns (``axis=1``) at ``indices``
+
+        ``indices`` is an array of row (or column) indices, and may reorder or
+        repeat them. The result is built with a single fancy-index of the
+        underlying matrix.
+        """
+        indices = asarray(indices, dtype=int)
+
+        if axis == 0:
+            new_shape = (len(indices), self.shape[1])
+        elif axis == 1:
+            new_shape = (self.shape[0], len(indices))
+        else:
+            raise ValueError("Unknown axis: %s" % axis)
+
+        new_self = self.__class__(*new_shape, dtype=self.dtype)
+
+        if not self.is_empty and len(indices):
+            if axis == 0:
+                self.convert('csr')
+                new_self._matrix = self._matrix[indices]
+            else:
+                self.convert('csc')
+                new_self._matrix = self._matrix[:, indices]
+
+        return new_self
+
     def items(self):
         """Return ``[((r,c),v)]``. No guaranteed ordering!"""
         return list(self.iteritems())
@@ -286,6 +513,8 @@ class ScipySparseMat(object):
                              "to be set.")
 
         self.convert('lil')
+        # the lil matrix is modified in place, so cached formats are stale
+        self._cache = {}
         if value == 0:
             # We can support this with scipy.sparse, but need to watch out for
             # efficiency issues and nnz. Leaving this unsupported for now to
@@ -324,7 +553,296 @@ class ScipySparseMat(object):
             if self.fmt == 'coo':
                 self.convert('csr')
 
-            return self._matrix[row, col]
+            if self.fmt in ('csr', 'csc'):
+                return self._get_element(row, col)
+            else:
+                return self._matrix[row, col]
+
+    def _get_element(self, row, col):
+        """Return the value at ``(row, col)`` of a csr/csc matrix.
+
+        The indices are sorted within each vector, so the element is found
+        with a binary search rather than scipy's indexing.
+        """
+        num_rows, num_cols = self.shape
+        if row < 0:
+            row += num_rows
+        if col < 0:
+            col += num_cols
+        if not (0 <= row < num_rows and 0 <= col < num_cols):
+            raise IndexError("Index (%d, %d) is out of bounds." % (row, col))
+
+        if self.fmt == 'csc':
+            vec_idx, idx = col, row
+        else:
+            vec_idx, idx = row, col
+
+        mat = self._matrix
+        mat.sort_indices()
+
+        start, end = mat.indptr[vec_idx], mat.indptr[vec_idx + 1]
+        pos = start + mat.indices[start:end].searchsorted(idx)
+        if pos < end and mat.indices[pos] == idx:
+            return mat.data[pos]
+        else:
+            return mat.dtype.type(0)
+
+    def getValues(self, rows, cols):
+        """Return the values at each ``(rows[i], cols[i])`` as an array.
+
+        All coordinates are resolved in a single scipy fancy indexing call.
+        """
+        rows = asarray(rows, dtype=int)
+        cols = asarray(cols, dtype=int)
+
+        if rows.shape != cols.shape:
+            raise ValueError("rows and cols must be the same length.")
+        if len(rows) == 0:
+            return zeros(0, dtype=self.dtype)
+
+        if self.fmt == 'coo':
+            self.convert('csr')
+
+        return asarray(self._matrix[rows, cols]).ravel()
+
+class H5ScipySparseMat(ScipySparseMat):
+    """``ScipySparseMat`` that reads its data lazily from an HDF5 BIOM group.
+
+    Rows and columns are read from the ``observation/`` (CSR) and ``sample/``
+    (CSC) groups of ``h5grp`` as they are requested, using only the needed
+    ``indptr`` range. Any other operation loads the full matrix in the
+    orientation given by ``order``, after which this object behaves as a
+    regular ``ScipySparseMat``.
+
+    The HDF5 file must remain open until the matrix is loaded.
+    """
+
+    def __init__(self, num_rows, num_cols, dtype=float, data=None,
+                 h5grp=None, order='observation'):
+        self._h5grp = None
+        self._indptr = {}
+
+        if h5grp is None or num_rows == 0 or num_cols == 0:
+            super(H5ScipySparseMat, self).__init__(num_rows, num_cols,
+                                                   dtype=dtype, data=data)
+        else:
+            if order not in ('observation', 'sample'):
+                raise ValueError("Unknown order %s!" % order)
+
+            self._h5grp = h5grp
+            self._order = order
+            self._lazy_shape = (num_rows, num_cols)
+            self._lazy_dtype = h5grp['%s/data' % order].dtype
+
+    def _is_lazy(self):
+        """Return ``True`` if the matrix has not been loaded yet."""
+        return self._h5grp is not None
+    is_lazy = property(_is_lazy)
+
+    def _get_matrix(self):
+        """Return the scipy matrix, loading it first if necessary."""
+        if self.is_lazy:
+            self._load()
+        return super(H5ScipySparseMat, self)._get_matrix()
+
+    def _set_matrix(self, matrix):
+        """Set the scipy matrix, dropping the lazy HDF5 source."""
+        self._h5grp = None
+        self._indptr = {}
+        super(H5ScipySparseMat, self)._set_matrix(matrix)
+    _matrix = property(_get_matrix, _set_matrix)
+
+    def _load(self):
+        """Read the full matrix in ``self._order`` from the HDF5 group."""
+        grp = self._h5grp[self._order]
+        cs = (grp['data'][:], grp['indices'][:], grp['indptr'][:])
+
+        if self._order == 'sample':
+            self._matrix = csc_matrix(cs, shape=self._lazy_shape)
+        else:
+            self._matrix = csr_matrix(cs, shape=self._lazy_shape)
+
+    def _is_empty(self):
+        if self.is_lazy:
+            return False
+        return super(H5ScipySparseMat, self)._is_empty()
+    is_empty = property(_is_empty)
+
+    def _get_shape(self):
+        if self.is_lazy:
+            return self._lazy_shape
+        return super(H5ScipySparseMat, self)._get_shape()
+    shape = property(_get_shape)
+
+    def _get_dtype(self):
+        if self.is_lazy:
+            return self._lazy_dtype
+        return super(H5ScipySparseMat, self)._get_dtype()
+    dtype = property(_get_dtype)
+
+    def _get_size(self):
+        if self.is_lazy:
+            return self._h5grp['%s/data' % self._order].shape[0]
+        return super(H5ScipySparseMat, self)._get_size()
+    size = property(_get_size)
+
+    def _get_nbytes(self):
+        """Return the number of bytes held in memory.
+
+        Only the ``indptr`` arrays read so far count for a lazy matrix.
+        """
+        if self.is_lazy:
+            return sum([indptr.nbytes for indptr in self._indptr.values()])
+        return super(H5ScipySparseMat, self)._get_nbytes()
+    nbytes = property(_get_nbytes)
+
+    def compact(self, value_dtype=None):
+        """Return the compacted matrix, or ``self`` if it is still lazy."""
+        if self.is_lazy:
+            return self
+        return super(H5ScipySparseMat, self).compact(value_dtype)
+
+    def _read_vector(self, axis, idx):
+        """Return ``(data, indices)`` for one compressed vector of ``axis``
+
+        Only the ``indptr`` dataset of ``axis`` is read in full, and it is
+        cached for subsequent lookups.
+        """
+        grp = self._h5grp[axis]
+        if axis not in self._indptr:
+            self._indptr[axis] = grp['indptr'][:]
+
+        start, end = self._indptr[axis][idx:idx + 2]
+        return grp['data'][start:end], grp['indices'][start:end]
+
+    def getRow(self, row_idx):
+        """Return the row at ``row_idx`` as a ``ScipySparseMat``.
+
+        A row vector will be returned in csr format.
+        """
+        if not self.is_lazy:
+            return super(H5ScipySparseMat, self).getRow(row_idx)
+
+        num_rows, num_cols = self.shape
+        if row_idx >= num_rows or row_idx < 0:
+            raise IndexError("Row index %d is out of bounds." % row_idx)
+
+        data, indices = self._read_vector('observation', row_idx)
+        row_vector = ScipySparseMat(1, num_cols, dtype=self.dtype)
+        row_vector._matrix = csr_matrix((data, indices, [0, len(data)]),
+                                        shape=(1, num_cols))
+
+        return row_vector
+
+    def getCol(self, col_idx):
+        """Return the column at ``col_idx`` as a ``ScipySparseMat``.
+
+        A column vector will be returned in csc format.
+        """
+        if not self.is_lazy:
+            return super(H5ScipySparseMat, self).getCol(col_idx)
+
+        num_rows, num_cols = self.shape
+        if col_idx >= num_cols or col_idx < 0:
+            raise IndexError("Column index %d is out of bounds." % col_idx)
+
+        data, indices = self._read_vector('sample', col_idx)
+        col_vector = ScipySparseMat(num_rows, 1, dtype=self.dtype)
+        col_vector._matrix = csc_matrix((data, indices, [0, len(data)]),
+                                        shape=(num_rows, 1))
+
+        return col_vector
+
+    def getRowView(self, row_idx):
+        """Return a read-only view of the row at ``row_idx``.
+
+        If the matrix has not been loaded, only the row is read.
+        """
+        if not self.is_lazy:
+            return super(H5ScipySparseMat, self).getRowView(row_idx)
+
+        num_rows, num_cols = self.shape
+        if row_idx >= num_rows or row_idx < 0:
+            raise IndexError("Row index %d is out of bounds." % row_idx)
+
+        data, indices = self._read_vector('observation', row_idx)
+        return SparseVectorView(indices, data, (1, num_cols))
+
+    def getColView(self, col_idx):
+        """Return a read-only view of the column at ``col_idx``.
+
+        If the matrix has not been loaded, only the column is read.
+        """
+        if not self.is_lazy:
+            return super(H5ScipySparseMat, self).getColView(col_idx)
+
+        num_rows, num_cols = self.shape
+        if col_idx >= num_cols or col_idx < 0:
+            raise IndexError("Column index %d is out of bounds." % col_idx)
+
+        data, indices = self._read_vector('sample', col_idx)
+        return SparseVectorView(indices, data, (num_rows, 1))
+
+    def take(self, indices, axis):
+        """Return the rows (``axis=0``) or columns (``axis=1``) at ``indices``
+
+        If the matrix has not been loaded, only the selected vectors are read
+        from the HDF5 group and the result is a ``ScipySparseMat``.
+        """
+        if not self.is_lazy:
+            return super(H5ScipySparseMat, self).take(indices, axis)
+
+        indices = asarray(indices, dtype=int)
+        num_rows, num_cols = self.shape
+
+        if axis == 0:
+            h5_axis, new_shape, matrix_type = ('observation',
+                    (len(indices), num_cols), csr_matrix)
+        elif axis == 1:
+            h5_axis, new_shape, matrix_type = ('sample',
+                    (num_rows, len(indices)), csc_matrix)
+        else:
+            raise ValueError("Unknown axis: %s" % axis)
+
+        vectors = [self._read_vector(h5_axis, idx) for idx in indices]
+        indptr = zeros(len(indices) + 1, dtype=int32)
+        indptr[1:] = cumsum([len(data) for data, _ in vectors])
+
+        new_self = ScipySparseMat(*new_shape, dtype=self.dtype)
+        if indptr[-1]:
+            data = concatenate([data for data, _ in vectors])
+            vec_indices = concatenate([idxs for _, idxs in vectors])
+            new_self._matrix = matrix_type((data, vec_indices, indptr),
+                                           shape=new_shape)
+
+        return new_self
+
+    def __eq__(self, other):
+        """Return ``True`` if both matrices are equal.
+
+        Lazy matrices compare equal to ``ScipySparseMat`` objects holding the
+        same data.
+        """
+        if not isinstance(other, ScipySparseMat):
+            return False
+        return ScipySparseMat.__eq__(other, self)
+
+def get_dual_cache_max_bytes():
+    """Return the number of bytes ``ScipySparseMat`` may use to cache formats
+
+    Read from the ``python_code_sparse_dual_cache_max_bytes`` biom config
+    value. Caching is disabled if it is not set.
+    """
+    max_bytes = biom_config['python_code_sparse_dual_cache_max_bytes']
+    if max_bytes is None:
+        return 0
+    return int(max_bytes)
+
+def _matrix_nbytes(matrix):
+    """Return the number of bytes held by a coo, csr or csc matrix"""
+    if matrix.getformat() == 'coo':
+        return matrix.data.nbytes + matrix.row.nbytes + matrix.col.nbytes
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
 
 def to_scipy(values, transpose=False, dtype=float):
     """Try to return a populated ``ScipySparseMat`` object.
@@ -406,7 +924,8 @@ def list_list_to_scipy(data, dtype=float, shape=None):
     else:
         n_rows, n_cols = shape
 
-    return ScipySparseMat(n_rows, n_cols, data=(values, (rows, cols)))
+    return ScipySparseMat(n_rows, n_cols, dtype=dtype,
+                          data=(values, (rows, cols)))
 
 def nparray_to_scipy(data, dtype=float):
     """Convert a numpy array to a ``ScipySparseMat``."""
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2011-2013, The BIOM Format Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from itertools import izip
+from numpy import zeros
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2011-2013, The BIOM Format Development Team"
+__credits__ = ["Daniel McDonald", "Jai Ram Rideout"]
+__license__ = "BSD"
+__url__ = "http://biom-format.org"
+__maintainer__ = "Daniel McDonald"
+__email__ = "daniel.mcdonald@colorado.edu"
+
+class SparseVectorView(object):
+    """A read-only view of a single row or column of a sparse matrix
+
+    ``indices`` and ``values`` are slices of the compressed arrays of the
+    parent matrix, so creating a view does not copy any data. ``shape`` is
+    ``(1, n)`` for a row and ``(n, 1)`` for a column.
+
+    A view is only valid until the parent matrix is modified or converted.
+    """
+    __slots__ = ('indices', 'values', 'shape')
+
+    def __init__(self, indices, values, shape):
+        self.indices = indices
+        self.values = values
+        self.shape = shape
+
+    def _get_dtype(self):
+        """Returns the type of the values"""
+        return self.values.dtype
+    dtype = property(_get_dtype)
+
+    def _get_size(self):
+        """Returns the number of stored values (NNZ)"""
+        return len(self.values)
+    size = property(_get_size)
+
+    def __len__(self):
+        """Returns the length of the vector, including zeros"""
+        return max(self.shape)
+
+    def __iter__(self):
+        """Yields ``(index, value)`` for each stored value"""
+        return izip(self.indices, self.values)
+
+    def todense(self):
+        """Returns the vector as a 1-dimensional numpy array"""
+        dense = zeros(len(self), dtype=self.dtype)
+        dense[self.indices] = self.values
+        return dense
+
+    def sum(self):
+        """Returns the sum of the vector"""
+        return self.values.sum()
+
+    def nonzero(self):
+        """Returns the indices of the nonzero values, like ndarray.nonzero"""
+        return (self.indices[self.values != 0],)
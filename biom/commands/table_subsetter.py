@@ -12,7 +12,8 @@ from __future__ import division
 from pyqi.core.command import (Command, CommandIn, CommandOut, 
         ParameterCollection)
 from pyqi.core.exception import CommandError
-from biom.parse import get_axis_indices, direct_slice_data, direct_parse_key
+from biom.parse import (get_axis_indices, direct_slice_data, direct_parse_key,
+        direct_index_keys)
 from types import GeneratorType
 
 __author__ = "Daniel McDonald"
@@ -62,28 +63,28 @@ class TableSubsetter(Command):
             raise CommandError("Invalid axis '%s'. Must be either %s." % (axis,
                 ' or '.join(map(lambda e: "'%s'" % e, self.Axes))))
 
-        idxs, new_axis_md = get_axis_indices(table_str, ids, axis)
-        new_data = direct_slice_data(table_str, idxs, axis)
+        # a single walk over the string locates every top-level key
+        index = direct_index_keys(table_str)
+        idxs, new_axis_md = get_axis_indices(table_str, ids, axis, index)
+        new_data = direct_slice_data(table_str, idxs, axis, index)
 
-        # multiple walks over the string. bad form, but easy right now
-        # ...should add a yield_and_ignore parser or something.
         def subset_generator():
             yield "{"
-            yield direct_parse_key(table_str, "id")
+            yield direct_parse_key(table_str, "id", index)
             yield ","
-            yield direct_parse_key(table_str, "format")
+            yield direct_parse_key(table_str, "format", index)
             yield ","
-            yield direct_parse_key(table_str, "format_url")
+            yield direct_parse_key(table_str, "format_url", index)
             yield ","
-            yield direct_parse_key(table_str, "type")
+            yield direct_parse_key(table_str, "type", index)
             yield ","
-            yield direct_parse_key(table_str, "generated_by")
+            yield direct_parse_key(table_str, "generated_by", index)
             yield ","
-            yield direct_parse_key(table_str, "date")
+            yield direct_parse_key(table_str, "date", index)
             yield ","
-            yield direct_parse_key(table_str, "matrix_type")
+            yield direct_parse_key(table_str, "matrix_type", index)
             yield ","
-            yield direct_parse_key(table_str, "matrix_element_type")
+            yield direct_parse_key(table_str, "matrix_element_type", index)
             yield ","
             yield new_data
             yield ","
@@ -91,9 +92,9 @@ class TableSubsetter(Command):
             yield ","
 
             if axis == "observations":
-                yield direct_parse_key(table_str, "columns")
+                yield direct_parse_key(table_str, "columns", index)
             else:
-                yield direct_parse_key(table_str, "rows")
+                yield direct_parse_key(table_str, "rows", index)
             yield "}"
 
         return {'subset_generator': subset_generator()}
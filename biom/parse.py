@@ -10,15 +10,17 @@
 
 from __future__ import division
 import os
+import re
 import numpy as np
 from biom import __version__
-from biom.exception import BiomParseException
+from biom.exception import BiomParseException, UnknownID
 from biom.table import table_factory, nparray_to_sparseobj
 from functools import partial
 import json
+from itertools import izip
 from numpy import asarray
 from scipy.sparse import csr_matrix, csc_matrix
-from biom.backends.scipysparse import ScipySparseMat
+from biom.backends.scipysparse import ScipySparseMat, H5ScipySparseMat
 
 __author__ = "Justin Kuczynski"
 __copyright__ = "Copyright 2011-2013, The BIOM Format Development Team"
@@ -37,11 +39,118 @@ JSON_OPEN = set(["[", "{"])
 JSON_CLOSE = set(["]", "}"])
 JSON_SKIP = set([" ","\t","\n",","])
 JSON_START = set(["0","1","2","3","4","5","6","7","8","9","{","[",'"'])
-def direct_parse_key(biom_str, key):
+JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+JSON_KEY = re.compile(r'\s*("[^"\\]*(?:\\.[^"\\]*)*")\s*:\s*')
+JSON_SCALAR = re.compile(r'[^,}\]\s]+')
+JSON_SEPARATOR = re.compile(r'\s*([,}])')
+
+def _find_container_end(biom_str, start, block_size=2**20):
+    """Returns the index just past the container opened at biom_str[start]
+
+    Runs of the string between JSON strings are bracket counted with
+    str.count, and only the run holding the closing bracket is walked.
+    """
+    depth = 0
+    pos = start
+    while True:
+        quote = biom_str.find('"', pos)
+        stop = len(biom_str) if quote == -1 else quote
+        run_depth = biom_str.count('[', pos, stop) + \
+                    biom_str.count('{', pos, stop) - \
+                    biom_str.count(']', pos, stop) - \
+                    biom_str.count('}', pos, stop)
+
+        if depth + run_depth > 0:
+            if quote == -1:
+                raise BiomParseException("Incomplete JSON BIOM table")
+            depth += run_depth
+            string_match = JSON_STRING.match(biom_str, quote)
+            if string_match is None:
+                raise BiomParseException("Incomplete JSON BIOM table")
+            pos = string_match.end()
+            continue
+
+        # the container closes within this run, locate it a block at a time
+        for block_start in xrange(pos, stop, block_size):
+            block_stop = min(block_start + block_size, stop)
+            block = biom_str[block_start:block_stop]
+            if isinstance(block, unicode):
+                block = block.encode('utf-32-le')
+                chars = np.frombuffer(block, dtype=np.uint32)
+            else:
+                chars = np.frombuffer(block, dtype=np.uint8)
+
+            delta = np.zeros(len(chars), dtype=np.int64)
+            delta[(chars == ord('[')) | (chars == ord('{'))] = 1
+            delta[(chars == ord(']')) | (chars == ord('}'))] = -1
+            running = np.cumsum(delta) + depth
+            closed = np.flatnonzero(running == 0)
+            if len(closed):
+                return block_start + closed[0] + 1
+            depth = running[-1]
+
+        raise BiomParseException("Incomplete JSON BIOM table")
+
+def direct_index_keys(biom_str):
+    """Returns {key: (start, stop)} for the top-level keys of a BIOM string
+
+    A single pass is made over biom_str. Each span covers the "key": value
+    pair, so biom_str[start:stop] is what direct_parse_key returns for that
+    key. The index can be handed to direct_parse_key, direct_slice_data and
+    get_axis_indices so the string does not have to be rescanned.
+    """
+    index = {}
+    pos = biom_str.find('{')
+    if pos == -1:
+        raise BiomParseException("biom_str does not appear to be JSON!")
+    pos += 1
+
+    while True:
+        key_match = JSON_KEY.match(biom_str, pos)
+        if key_match is None:
+            break
+
+        key_start = key_match.start(1)
+        key = json.loads(key_match.group(1))
+        pos = key_match.end()
+
+        if pos >= len(biom_str):
+            raise BiomParseException("Incomplete JSON BIOM table")
+
+        value_start = biom_str[pos]
+        if value_start in JSON_OPEN:
+            pos = _find_container_end(biom_str, pos)
+        else:
+            if value_start == QUOTE:
+                value_match = JSON_STRING.match(biom_str, pos)
+            else:
+                value_match = JSON_SCALAR.match(biom_str, pos)
+            if value_match is None:
+                raise BiomParseException("Incomplete JSON BIOM table")
+            pos = value_match.end()
+
+        index[key] = (key_start, pos)
+
+        separator = JSON_SEPARATOR.match(biom_str, pos)
+        if separator is None or separator.group(1) == '}':
+            break
+        pos = separator.end()
+
+    return index
+
+def direct_parse_key(biom_str, key, index=None):
     """Returns key:value from the biom string, or ""
 
-    This method pulls an arbitrary key/value pair out from a BIOM string
+    This method pulls an arbitrary key/value pair out from a BIOM string. If
+    an index from direct_index_keys is provided, it is used instead of
+    scanning biom_str.
     """
+    if index is not None:
+        if key not in index:
+            return ""
+        start, stop = index[key]
+        return biom_str[start:stop]
+
     base_idx = biom_str.find('"%s":' % key)
     if base_idx == -1:
         return ""
@@ -82,12 +191,13 @@ def direct_parse_key(biom_str, key):
 
     return biom_str[base_idx:cur_idx]
 
-def direct_slice_data(biom_str, to_keep, axis):
+def direct_slice_data(biom_str, to_keep, axis, index=None):
     """Pull out specific slices from a BIOM string
 
     biom_str : JSON-formatted BIOM string
     to_keep  : indices to keep
     axis     : either 'samples' or 'observations'
+    index    : optional key index from direct_index_keys
 
     Will raise IndexError if the inices are out of bounds. Fully zerod rows
     or columns are possible and this is _not_ checked.
@@ -95,17 +205,18 @@ def direct_slice_data(biom_str, to_keep, axis):
     if axis not in ['observations','samples']:
         raise IndexError, "Unknown axis type"
 
-    # it would be nice if all of these lookups could be done in a single
-    # traversal of biom_str, but it likely is at the cost of code complexity
-    shape_kv_pair = direct_parse_key(biom_str, "shape")
+    if index is None:
+        index = direct_index_keys(biom_str)
+
+    shape_kv_pair = direct_parse_key(biom_str, "shape", index)
     if shape_kv_pair == "":
         raise ValueError, "biom_str does not appear to be in BIOM format!"
 
-    data_fields = direct_parse_key(biom_str, "data")
+    data_fields = direct_parse_key(biom_str, "data", index)
     if data_fields == "":
         raise ValueError, "biom_str does not appear to be in BIOM format!"
 
-    matrix_type_kv_pair = direct_parse_key(biom_str, "matrix_type")
+    matrix_type_kv_pair = direct_parse_key(biom_str, "matrix_type", index)
     if matrix_type_kv_pair == "":
         raise ValueError, "biom_str does not appear to be in BIOM format!"
 
@@ -120,6 +231,14 @@ def direct_slice_data(biom_str, to_keep, axis):
     # determine matrix type
     matrix_type = matrix_type_kv_pair.split(':')[-1].strip()
 
+    # determine the element type, which defaults to float if unspecified
+    element_type_kv_pair = direct_parse_key(biom_str, "matrix_element_type",
+                                            index)
+    element_type = float
+    if element_type_kv_pair != "":
+        raw_element_type = json.loads(element_type_kv_pair.split(':', 1)[-1])
+        element_type = MATRIX_ELEMENT_TYPE.get(raw_element_type, float)
+
     # bounds check
     if min(to_keep) < 0:
         raise IndexError, "Observations to keep are out of bounds!"
@@ -139,9 +258,11 @@ def direct_slice_data(biom_str, to_keep, axis):
     new_data = []
 
     if axis == 'observations':
-        new_data = _direct_slice_data_sparse_obs(data_fields, to_keep)
+        new_data = _direct_slice_data_sparse_obs(data_fields, to_keep,
+                                                 element_type)
     elif axis == 'samples':
-        new_data = _direct_slice_data_sparse_samp(data_fields, to_keep)
+        new_data = _direct_slice_data_sparse_samp(data_fields, to_keep,
+                                                  element_type)
 
     return '"data": %s, "shape": %s' % (new_data, new_shape)
 
@@ -156,13 +277,83 @@ def _remap_axis_sparse_samp(rcv, lookup):
     row,col,value = map(STRIP_F, rcv.split(','))
     return "%s,%s,%s" % (row, lookup[col], value)
 
-def _direct_slice_data_sparse_obs(data, to_keep):
+def _parse_data_triples(data):
+    """Returns rows and cols arrays, and the value offsets, from raw data
+
+    data : raw data string from a biom file, without the enclosing brackets
+
+    Returns ``(rows, cols, text, starts, ends)``. ``text`` is data without
+    brackets or whitespace, and the value of triple i is
+    ``text[starts[i]:ends[i]]``, so that sliced triples are copied through
+    as written without creating a string for every value.
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    text = data.translate(None, '[] \t\r\n')
+    flat = np.fromstring(text, sep=',')
+    if len(flat) % 3:
+        raise BiomParseException("Malformed data triples in BIOM table")
+
+    commas = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == ord(','))
+    if len(flat) and len(commas) != len(flat) - 1:
+        raise BiomParseException("Malformed data triples in BIOM table")
+
+    starts = commas[1::3] + 1
+    ends = np.append(commas[2::3], len(text)) if len(flat) else commas
+
+    return (flat[0::3].astype(np.int64), flat[1::3].astype(np.int64), text,
+            starts, ends)
+
+def _format_data_triples(rows, cols, values):
+    """Returns the JSON data field for the given triples
+
+    values are the value strings of the triples
+    """
+    if not len(values):
+        return '[]'
+
+    triples = [None] * (3 * len(values))
+    triples[0::3] = rows.tolist()
+    triples[1::3] = cols.tolist()
+    triples[2::3] = values
+    return '[%s]' % ','.join(['[%d,%d,%s]'] * len(values)) % tuple(triples)
+
+def _direct_slice_data_sparse(data, to_keep, axis):
+    """slice observations or samples from data
+
+    data : raw data string from a biom file
+    to_keep : rows or columns to keep
+    axis : either 'samples' or 'observations'
+    """
+    rows, cols, text, starts, ends = _parse_data_triples(data)
+    to_keep = np.array(sorted(to_keep), dtype=np.int64)
+
+    if axis == 'observations':
+        keep = np.in1d(rows, to_keep)
+        rows = np.searchsorted(to_keep, rows[keep])
+        cols = cols[keep]
+    else:
+        keep = np.in1d(cols, to_keep)
+        rows = rows[keep]
+        cols = np.searchsorted(to_keep, cols[keep])
+
+    # only the retained values are taken from the text
+    values = [text[start:end] for start, end in
+              izip(starts[keep].tolist(), ends[keep].tolist())]
+    return _format_data_triples(rows, cols, values)
+
+def _direct_slice_data_sparse_obs(data, to_keep, element_type=float):
     """slice observations from data
 
     data : raw data string from a biom file
     to_keep : rows to keep
+    element_type : the matrix element type
     """
-    # interogate all the datas
+    if element_type in (int, float):
+        return _direct_slice_data_sparse(data, to_keep, 'observations')
+
+    # non-numeric values cannot be parsed in bulk
     new_data = []
     remap_lookup = dict([(str(v),i) for i,v in enumerate(sorted(to_keep))])
     for rcv in data.split('],'):
@@ -171,38 +362,42 @@ def _direct_slice_data_sparse_obs(data, to_keep):
             new_data.append(_remap_axis_sparse_obs(rcv, remap_lookup))
     return '[[%s]]' % '],['.join(new_data)
 
-def _direct_slice_data_sparse_samp(data, to_keep):
+def _direct_slice_data_sparse_samp(data, to_keep, element_type=float):
     """slice samples from data
 
     data : raw data string from a biom file
     to_keep : columns to keep
+    element_type : the matrix element type
     """
-    # could do sparse obs/samp in one forloop, but then theres the
-    # expense of the additional if-statement in the loop
+    if element_type in (int, float):
+        return _direct_slice_data_sparse(data, to_keep, 'samples')
+
+    # non-numeric values cannot be parsed in bulk
     new_data = []
     remap_lookup = dict([(str(v),i) for i,v in enumerate(sorted(to_keep))])
     for rcv in data.split('],'):
-        r,c,v = rcv.split(',')
+        r,c,v = STRIP_F(rcv).split(',')
         if c in remap_lookup:
             new_data.append(_remap_axis_sparse_samp(rcv, remap_lookup))
     return '[[%s]]' % '],['.join(new_data)
 
-def get_axis_indices(biom_str, to_keep, axis):
+def get_axis_indices(biom_str, to_keep, axis, index=None):
     """Returns the indices for the associated ids to keep
 
     biom_str : a BIOM formatted JSON string
     to_keep  : a list of IDs to get indices for
     axis     : either 'samples' or 'observations'
+    index    : optional key index from direct_index_keys
 
     Raises KeyError if unknown key is specified
     """
     to_keep = set(to_keep)
     if axis == 'observations':
         axis_key = 'rows'
-        axis_data = direct_parse_key(biom_str, axis_key)
+        axis_data = direct_parse_key(biom_str, axis_key, index)
     elif axis == "samples":
         axis_key = 'columns'
-        axis_data = direct_parse_key(biom_str, axis_key)
+        axis_data = direct_parse_key(biom_str, axis_key, index)
     else:
         raise ValueError, "Unknown axis!"
 
@@ -225,15 +420,249 @@ def get_axis_indices(biom_str, to_keep, axis):
 
     return idxs, json.dumps(subset)[1:-1] # trim off { and }
 
-def parse_biom_table(fp):
+def parse_biom_table(fp, streaming=False, int_dtype=None):
+    """Parse a JSON BIOM table
+
+    fp : a file-like object, a list of lines or a string
+    streaming : if True, the document is walked incrementally and the data
+        triples are never materialized as Python lists. See
+        parse_biom_table_stream.
+    int_dtype : the dtype to store "int" tables with. See
+        parse_biom_table_json.
+    """
+    if streaming:
+        return parse_biom_table_stream(fp, int_dtype=int_dtype)
+
+    if hasattr(fp, 'read'):
+        json_table = json.load(fp)
+    elif isinstance(fp, list):
+        json_table = json.loads(''.join(fp))
+    else:
+        json_table = json.loads(fp)
+
+    return parse_biom_table_json(json_table, int_dtype=int_dtype)
+
+JSON_TOKEN = re.compile(r'["\\\[\]{}]')
+JSON_DATA_KEY = re.compile(r'"data"\s*:\s*$')
+OPEN_BRACKET = ord('[')
+CLOSE_BRACKET = ord(']')
+
+def _iter_blocks(fp, block_size):
+    """Yield blocks of text from a file-like object, list or string"""
     if hasattr(fp, 'read'):
-        return parse_biom_table_json(json.load(fp))
+        for block in iter(partial(fp.read, block_size), ''):
+            yield block
     elif isinstance(fp, list):
-        return parse_biom_table_json(json.loads(''.join(fp)))
+        for block in fp:
+            yield block
     else:
-        return parse_biom_table_json(json.loads(fp))
+        for start in xrange(0, len(fp), block_size):
+            yield fp[start:start + block_size]
+
+class _COOAccumulator(object):
+    """Collects [row, col, value] triples from raw JSON text into arrays
 
-def parse_biom_table_hdf5(h5grp, order='observation'):
+    Text can be fed in arbitrary pieces; incomplete triples are carried over
+    to the next call. Storage is preallocated and doubled as needed.
+    """
+    def __init__(self, capacity=2**16):
+        self._pending = ''
+        self._n = 0
+        self._rows = np.empty(capacity, dtype=np.int64)
+        self._cols = np.empty(capacity, dtype=np.int64)
+        self._values = np.empty(capacity, dtype=np.float64)
+
+    def _reserve(self, n):
+        """Make sure there is room for n more triples"""
+        needed = self._n + n
+        capacity = len(self._values)
+        if needed <= capacity:
+            return
+
+        while capacity < needed:
+            capacity *= 2
+
+        for attr in ('_rows', '_cols', '_values'):
+            old = getattr(self, attr)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._n] = old[:self._n]
+            setattr(self, attr, new)
+
+    def feed(self, text, final=False):
+        """Parse the complete triples found in text"""
+        text = self._pending + text
+        if final:
+            self._pending = ''
+        else:
+            # only parse up to the last closed triple
+            cut = text.rfind(']')
+            if cut == -1:
+                self._pending = text
+                return
+            self._pending = text[cut + 1:]
+            text = text[:cut]
+
+        text = text.translate(None, '[]').strip(', \t\r\n')
+        if not text:
+            return
+
+        flat = np.fromstring(text, sep=',')
+        if flat.size % 3:
+            raise BiomParseException("Malformed data triples in BIOM table")
+
+        n = flat.size // 3
+        self._reserve(n)
+        self._rows[self._n:self._n + n] = flat[0::3]
+        self._cols[self._n:self._n + n] = flat[1::3]
+        self._values[self._n:self._n + n] = flat[2::3]
+        self._n += n
+
+    def arrays(self):
+        """Returns (values, (rows, cols))"""
+        n = self._n
+        return self._values[:n], (self._rows[:n], self._cols[:n])
+
+def parse_biom_table_stream(fp, block_size=2**20, int_dtype=None):
+    """Parse a JSON BIOM table incrementally
+
+    Everything but the top-level "data" value is collected and handed to
+    json.loads. The data triples are parsed block by block straight into
+    NumPy arrays, so the peak memory is bound by the nnz of the table rather
+    than by a Python list of lists.
+
+    fp : a file-like object, a list of lines or a string
+    block_size : number of characters to read from fp at a time
+    int_dtype : the dtype to store "int" tables with. See
+        parse_biom_table_json.
+
+    Only numeric (int or float) tables can be streamed.
+    """
+    head = []
+    head_tail = ''
+    depth = 0
+    in_string = False
+    escaped = False
+    in_data = False
+    found_data = False
+    data_depth = 0
+    coo = _COOAccumulator()
+
+    for block in _iter_blocks(fp, block_size):
+        if isinstance(block, unicode):
+            block = block.encode('utf-8')
+
+        pos = 0
+        seg_start = 0
+        if escaped:
+            pos = 1
+            escaped = False
+
+        while pos < len(block):
+            if in_data:
+                # only numbers, commas and brackets live in here, so the end
+                # of the data array can be found with a vectorized depth count
+                chars = np.frombuffer(block, dtype=np.uint8)[pos:]
+                steps = (chars == OPEN_BRACKET).astype(np.int64)
+                steps -= chars == CLOSE_BRACKET
+                trace = data_depth + np.cumsum(steps)
+                closed = np.flatnonzero(trace == 0)
+
+                if closed.size:
+                    stop = pos + closed[0]
+                    coo.feed(block[pos:stop], final=True)
+                    in_data = False
+                    pos = seg_start = stop + 1
+                else:
+                    coo.feed(block[pos:])
+                    data_depth = trace[-1]
+                    pos = seg_start = len(block)
+                continue
+
+            match = JSON_TOKEN.search(block, pos)
+            if match is None:
+                break
+
+            idx = match.start()
+            char = block[idx]
+            pos = idx + 1
+
+            if in_string:
+                if char == '\\':
+                    if pos < len(block):
+                        pos += 1
+                    else:
+                        escaped = True
+                elif char == QUOTE:
+                    in_string = False
+            elif char == QUOTE:
+                in_string = True
+            elif char in JSON_OPEN:
+                if char == '[' and depth == 1 and not found_data:
+                    if JSON_DATA_KEY.search(head_tail + block[seg_start:idx]):
+                        head.append(block[seg_start:idx])
+                        head.append('[]')
+                        found_data = in_data = True
+                        data_depth = 1
+                        seg_start = pos
+                        continue
+                depth += 1
+            else:
+                depth -= 1
+
+        head.append(block[seg_start:])
+        head_tail = (head_tail + block[seg_start:])[-32:]
+
+    if in_data or in_string or depth != 0:
+        raise BiomParseException("Incomplete JSON BIOM table")
+    if not found_data:
+        raise BiomParseException("No data found in JSON BIOM table")
+
+    json_table = json.loads(''.join(head))
+    if MATRIX_ELEMENT_TYPE[json_table['matrix_element_type']] is unicode:
+        raise BiomParseException("Cannot stream a table of unicode data")
+
+    return parse_biom_table_json(json_table, data_pump=coo.arrays(),
+                                 int_dtype=int_dtype)
+
+def _hdf5_axis_indices(all_ids, ids, axis):
+    """Returns the positions of ``ids`` within ``all_ids``, in ``ids`` order
+
+    Raises UnknownID if any of ``ids`` are not present
+    """
+    lookup = dict((id_, i) for i, id_ in enumerate(all_ids))
+    try:
+        return np.array([lookup[id_] for id_ in ids], dtype=np.int64)
+    except KeyError, e:
+        raise UnknownID, "ID %s is not a known %s ID!" % (e.args[0], axis)
+
+def _read_hdf5_vectors(grp, idxs):
+    """Returns ``(data, indices, indptr)`` for the vectors ``idxs`` of grp
+
+    ``grp`` is the observation (CSR) or sample (CSC) group of an HDF5 BIOM
+    table. Only the ``data`` and ``indices`` ranges of the requested vectors
+    are read.
+    """
+    all_indptr = grp['indptr'][:]
+    starts = all_indptr[idxs]
+    ends = all_indptr[idxs + 1]
+
+    indptr = np.zeros(len(idxs) + 1, dtype=np.int64)
+    np.cumsum(ends - starts, out=indptr[1:])
+
+    data_ds = grp['data']
+    indices_ds = grp['indices']
+    data = np.empty(indptr[-1], dtype=data_ds.dtype)
+    indices = np.empty(indptr[-1], dtype=indices_ds.dtype)
+    for i, (start, end) in enumerate(izip(starts, ends)):
+        if start == end:
+            continue
+        data[indptr[i]:indptr[i + 1]] = data_ds[start:end]
+        indices[indptr[i]:indptr[i + 1]] = indices_ds[start:end]
+
+    return data, indices, indptr
+
+def parse_biom_table_hdf5(h5grp, order='observation', lazy=False,
+                          sample_ids=None, observation_ids=None):
     """Parse an HDF5 formatted BIOM table
 
     The expected structure of this group is below. A few basic definitions,
@@ -271,12 +700,28 @@ def parse_biom_table_hdf5(h5grp, order='observation'):
     h5grp : a h5py ``Group`` or an open h5py ``File``
     order : 'observation' or 'sample' to indicate which data ordering to load
         the table as
+    lazy : if True, the matrix data are not loaded up front. Observation and
+        sample vectors are read from ``h5grp`` as they are requested, and the
+        full matrix is only loaded in ``order`` if an operation requires it.
+        ``h5grp`` must remain open for the lifetime of the table, and is
+        available as ``Table.H5Group``
+    sample_ids : optional list of sample IDs. If provided, only these samples
+        are loaded, in the order given
+    observation_ids : optional list of observation IDs. If provided, only
+        these observations are loaded, in the order given
 
     Returns
     -------
     Table
         A BIOM ``Table`` object
 
+    Raises
+    ------
+    UnknownID
+        If any of ``sample_ids`` or ``observation_ids`` are not in the table
+    ValueError
+        If a subset of IDs is requested together with ``lazy``
+
     See Also
     --------
     Table.format_hdf5
@@ -298,6 +743,19 @@ def parse_biom_table_hdf5(h5grp, order='observation'):
     obs_md = json.loads(h5grp['observation'].get('metadata', no_md)[0])
     samp_md = json.loads(h5grp['sample'].get('metadata', no_md)[0])
 
+    if sample_ids is not None or observation_ids is not None:
+        if lazy:
+            raise ValueError("A subset of the table cannot be loaded lazily!")
+        return _parse_biom_table_hdf5_subset(h5grp, order, obs_ids, samp_ids,
+                                             obs_md, samp_md, observation_ids,
+                                             sample_ids)
+
+    if lazy:
+        rep = H5ScipySparseMat(len(obs_ids), len(samp_ids), h5grp=h5grp,
+                               order=order)
+        return table_factory(rep, samp_ids, obs_ids, samp_md or None,
+                             obs_md or None, H5Group=h5grp)
+
     # construct the sparse representation
     rep = ScipySparseMat(len(obs_ids), len(samp_ids))
 
@@ -312,14 +770,84 @@ def parse_biom_table_hdf5(h5grp, order='observation'):
     return table_factory(rep, samp_ids, obs_ids, samp_md or None,
                          obs_md or None)
 
-def parse_biom_table_json(json_table, data_pump=None):
-    """Parse a biom otu table type"""
+def _parse_biom_table_hdf5_subset(h5grp, order, obs_ids, samp_ids, obs_md,
+                                  samp_md, obs_keep, samp_keep):
+    """Build a Table from only the requested IDs of an HDF5 BIOM table
+
+    The vectors are read from whichever axis is requested more selectively,
+    and the other axis, if requested, is then subset in memory.
+    """
+    obs_idx = None
+    samp_idx = None
+    if obs_keep is not None:
+        obs_idx = _hdf5_axis_indices(obs_ids, obs_keep, 'observation')
+    if samp_keep is not None:
+        samp_idx = _hdf5_axis_indices(samp_ids, samp_keep, 'sample')
+
+    n_obs = len(obs_ids) if obs_idx is None else len(obs_idx)
+    n_samp = len(samp_ids) if samp_idx is None else len(samp_idx)
+    rep = ScipySparseMat(n_obs, n_samp)
+
+    if not rep.is_empty:
+        read_samples = samp_idx is not None and (obs_idx is None or
+            len(samp_idx) * len(obs_ids) <= len(obs_idx) * len(samp_ids))
+
+        if read_samples:
+            cs = _read_hdf5_vectors(h5grp['sample'], samp_idx)
+            mat = csc_matrix(cs, shape=(len(obs_ids), n_samp))
+            if obs_idx is not None:
+                mat = mat.tocsr()[obs_idx, :]
+        else:
+            cs = _read_hdf5_vectors(h5grp['observation'], obs_idx)
+            mat = csr_matrix(cs, shape=(n_obs, len(samp_ids)))
+            if samp_idx is not None:
+                mat = mat.tocsc()[:, samp_idx]
+
+        rep._matrix = mat.asformat('csc' if order == 'sample' else 'csr')
+
+    if obs_idx is not None:
+        obs_ids = obs_ids[obs_idx]
+        obs_md = [obs_md[i] for i in obs_idx] if obs_md else obs_md
+    if samp_idx is not None:
+        samp_ids = samp_ids[samp_idx]
+        samp_md = [samp_md[i] for i in samp_idx] if samp_md else samp_md
+
+    return table_factory(rep, samp_ids, obs_ids, samp_md or None,
+                         obs_md or None)
+
+def _compact_int_dtype(values):
+    """Returns int32 if it can hold all of values, otherwise int64"""
+    values = np.asarray(values)
+    bounds = np.iinfo(np.int32)
+
+    if values.size and (values.min() < bounds.min or
+                        values.max() > bounds.max):
+        return np.int64
+    else:
+        return np.int32
+
+def parse_biom_table_json(json_table, data_pump=None, int_dtype=None):
+    """Parse a biom otu table type
+
+    "int" tables are stored with int_dtype. By default that is int32, or
+    int64 if a value does not fit in int32.
+    """
     sample_ids = [col['id'] for col in json_table['columns']]
     sample_metadata = [col['metadata'] for col in json_table['columns']]
     obs_ids = [row['id'] for row in json_table['rows']]
     obs_metadata = [row['metadata'] for row in json_table['rows']]
     dtype = MATRIX_ELEMENT_TYPE[json_table['matrix_element_type']]
 
+    if dtype is int:
+        if int_dtype is not None:
+            dtype = int_dtype
+        elif data_pump is not None:
+            dtype = _compact_int_dtype(data_pump[0])
+        elif json_table.get('matrix_type') == 'dense':
+            dtype = _compact_int_dtype(json_table['data'])
+        else:
+            dtype = _compact_int_dtype([t[2] for t in json_table['data']])
+
     if data_pump is None:
         table_obj = table_factory(json_table['data'], sample_ids, obs_ids,
                                   sample_metadata, obs_metadata,
@@ -15,25 +15,38 @@ import numpy as np
 from copy import deepcopy
 from datetime import datetime
 from json import dumps
-from operator import itemgetter, xor, add
+from operator import itemgetter, xor, add, mul, and_, or_
 from itertools import izip
 from collections import defaultdict, Hashable
 from numpy import ndarray, asarray, zeros, empty
 from numpy.lib.recfunctions import merge_arrays
 import h5py
 
-from biom import get_sparse_backend
+from biom import (get_sparse_backend, get_coo_arrays_to_sparseobj,
+        get_sparse_storage, sparse_storages)
 from biom.exception import TableException, UnknownID
 from biom.util import (get_biom_format_version_string,
         get_biom_format_url_string, flatten, natsort, prefer_self,
-        index_list)
+        index_list, sum_dtype)
 
 # Define a variable length string type
 H5PY_VLEN_STR = h5py.special_dtype(vlen=str)
 
+# Reductions that Table.reduce can compute on the nonzero values alone. Each is
+# commutative and associative, and combining with zero any number of times is
+# the same as combining with it once.
+SPARSE_REDUCE_UFUNCS = dict((ufunc, ufunc) for ufunc in
+        (np.add, np.multiply, np.maximum, np.minimum, np.fmax, np.fmin,
+         np.bitwise_and, np.bitwise_or, np.bitwise_xor, np.logical_and,
+         np.logical_or, np.logical_xor))
+SPARSE_REDUCE_UFUNCS.update({add: np.add, mul: np.multiply, max: np.maximum,
+                             min: np.minimum, and_: np.bitwise_and,
+                             or_: np.bitwise_or, xor: np.bitwise_xor})
+
 SparseObj, to_sparse, dict_to_sparseobj, list_dict_to_sparseobj, \
         list_nparray_to_sparseobj, nparray_to_sparseobj, \
         list_list_to_sparseobj = get_sparse_backend()
+coo_arrays_to_sparseobj = get_coo_arrays_to_sparseobj(SparseObj)
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2011-2013, The BIOM Format Development Team"
@@ -51,6 +64,12 @@ class Table(object):
     metadata, which can be modified in place via addSampleMetadata and
     addObservationMetadata.
 
+    Passing storage='compact' (or setting python_code_sparse_storage in the
+    biom config) stores sparse data in as few bytes as possible: floats as
+    float32 and integers as int32 if they fit. The default keeps the data as
+    given. Tables derived from a table, e.g. by filtering, collapsing or
+    merging, use the storage of that table.
+
     Code to simulate immutability taken from here:
         http://en.wikipedia.org/wiki/Immutable_object
     """
@@ -64,6 +83,17 @@ class Table(object):
         if Type is None:
             Type = 'Unspecified'
 
+        storage = kwargs.get('storage')
+        if storage is None:
+            storage = get_sparse_storage()
+
+        if storage not in sparse_storages:
+            raise TableException, "Unknown storage: %s" % storage
+
+        if storage == 'compact' and isinstance(Data, SparseObj):
+            Data = Data.compact()
+
+        super(Table, self).__setattr__('_storage', storage)
         super(Table, self).__setattr__('Type', Type)
         super(Table, self).__setattr__('TableId', TableId)
         super(Table, self).__setattr__('_data', Data)
@@ -285,18 +315,71 @@ class Table(object):
         """Reduce over axis with f
 
         ``axis`` can be either ``sample`` or ``observation``
+
+        Common reductions (``operator.add``, ``operator.mul``, ``max``,
+        ``min``, the bitwise ``operator`` functions and the matching NumPy
+        ufuncs) are computed directly on the nonzero values. Any other ``f``
+        is applied to each vector with the builtin ``reduce``.
         """
         if self.isEmpty():
             raise TableException, "Cannot reduce an empty table"
 
+        if axis not in ('sample', 'observation'):
+            raise TableException, "Unknown reduction axis"
+
+        ufunc = SPARSE_REDUCE_UFUNCS.get(f) if isinstance(f, Hashable) \
+                else None
+        if ufunc is not None:
+            return self._sparse_reduce(ufunc, axis)
+
         # np.apply_along_axis might reduce type conversions here and improve
         # speed. am opting for reduce right now as I think its more readable
         if axis == 'sample':
             return asarray([reduce(f,v) for v in self.iterSampleData()])
-        elif axis == 'observation':
+        else:
             return asarray([reduce(f,v) for v in self.iterObservationData()])
+
+    def _sparse_reduce(self, ufunc, axis):
+        """Reduce each vector along ``axis`` with ``ufunc``
+
+        The ufunc is reduced over the nonzero values of each vector, and the
+        result is then combined with a single zero if the vector has any
+        implicit zeros. Zero absorbs a product outright, so an overflowed
+        partial product does not turn into ``nan``. Sums and products of
+        integers are accumulated in ``sum_dtype``, as numpy does.
+        """
+        if axis == 'sample':
+            order = 'csc'
+            vec_len = len(self.ObservationIds)
         else:
-            raise TableException, "Unknown reduction axis"
+            order = 'csr'
+            vec_len = len(self.SampleIds)
+
+        pkd_ax, unpkd_ax, values = self._data.getCompressedArrays(order)
+        counts = np.diff(pkd_ax)
+        has_values = counts > 0
+
+        if ufunc is np.add or ufunc is np.multiply:
+            values = values.astype(sum_dtype(values.dtype), copy=False)
+
+        zero = values.dtype.type(0)
+        has_zeros = counts < vec_len
+
+        # a product that overflows is irrelevant if the vector has a zero
+        with np.errstate(over='ignore' if ufunc is np.multiply else 'warn'):
+            partial = ufunc.reduceat(values, pkd_ax[:-1][has_values]) \
+                      if has_values.any() else values[:0]
+
+        result = empty(len(counts), dtype=ufunc(values[:0], zero).dtype)
+        result[~has_values] = ufunc(zero, zero)
+        result[has_values] = partial
+
+        if ufunc is np.multiply:
+            result[has_zeros] = zero
+        else:
+            result[has_zeros] = ufunc(result[has_zeros], zero)
+
+        return result
 
     def sum(self, axis='whole'):
         """Returns the sum by axis
@@ -329,7 +412,7 @@ class Table(object):
 
         return self.__class__(self._data.T, self.ObservationIds[:],
                               self.SampleIds[:], obs_md_copy, sample_md_copy,
-                              self.TableId)
+                              self.TableId, storage=self._storage)
 
     def getSampleIndex(self, samp_id):
         """Returns the sample index for sample ``samp_id``"""
@@ -353,6 +436,29 @@ class Table(object):
 
         return self._data[self._obs_index[obs_id], self._sample_index[samp_id]]
 
+    def getValuesByIds(self, obs_ids, samp_ids):
+        """Return the values corresponding to each ``(obs_id, samp_id)`` pair
+
+        ``obs_ids`` and ``samp_ids`` are aligned by position. All of the
+        values are looked up in a single call on the data matrix and returned
+        as a numpy array in the order of the pairs.
+        """
+        if len(obs_ids) != len(samp_ids):
+            raise TableException, "obs_ids and samp_ids must be the same " + \
+                                  "length!"
+
+        try:
+            rows = [self._obs_index[obs_id] for obs_id in obs_ids]
+        except KeyError, e:
+            raise UnknownID, "ObservationId %s not found!" % e.args[0]
+
+        try:
+            cols = [self._sample_index[samp_id] for samp_id in samp_ids]
+        except KeyError, e:
+            raise UnknownID, "SampleId %s not found!" % e.args[0]
+
+        return self._data.getValues(rows, cols)
+
     def __str__(self):
         """Stringify self
 
@@ -416,8 +522,9 @@ class Table(object):
             output = ['# Constructed from biom file',
                       '%s%s%s' % (observation_column_name, delim, samp_ids)]
 
-        for obs_id, obs_values in zip(self.ObservationIds, self._iter_obs()):
-            str_obs_vals = delim.join(map(str, self._conv_to_np(obs_values)))
+        for obs_id, obs_view in izip(self.ObservationIds,
+                                     self._iter_obs_views()):
+            str_obs_vals = delim.join(map(str, obs_view.todense()))
 
             if header_key and self.ObservationMetadata is not None:
                 md = self.ObservationMetadata[self._obs_index[obs_id]]
@@ -453,6 +560,16 @@ class Table(object):
         for r in range(self._data.shape[0]):
             yield self._data.getRow(r)
 
+    def _iter_samp_views(self):
+        """Return read-only views of the sample vectors of the data matrix"""
+        for c in range(self._data.shape[1]):
+            yield self._data.getColView(c)
+
+    def _iter_obs_views(self):
+        """Return read-only views of the observation vectors of data matrix"""
+        for r in range(self._data.shape[0]):
+            yield self._data.getRowView(r)
+
     def getTableDensity(self):
         """Returns the fraction of nonzero elements in the table."""
         density = 0.0
@@ -463,6 +580,13 @@ class Table(object):
 
         return density
 
+    def getDataNbytes(self):
+        """Returns the number of bytes used to store the data matrix
+
+        Metadata and ids are not counted.
+        """
+        return self._data.nbytes
+
     def descriptiveEquality(self, other):
         """For use in testing, describe how the tables are not equal"""
         if self.ObservationIds != other.ObservationIds:
@@ -522,30 +646,30 @@ class Table(object):
         """Return observations associated with sample id ``id_``"""
         if id_ not in self._sample_index:
             raise UnknownID, "ID %s is not a known sample ID!" % id_
-        return self._conv_to_np(self._data[:,self._sample_index[id_]])
+        return self._data.getColView(self._sample_index[id_]).todense()
 
     def observationData(self, id_):
         """Return samples associated with observation id ``id_``"""
         if id_ not in self._obs_index:
             raise UnknownID, "ID %s is not a known observation ID!" % id_
-        return self._conv_to_np(self._data[self._obs_index[id_],:])
+        return self._data.getRowView(self._obs_index[id_]).todense()
 
     def copy(self):
         """Returns a copy of the table"""
         #### NEEDS TO BE A DEEP COPY, MIGHT NOT GET METADATA! NEED TEST!
         return self.__class__(self._data.copy(), self.SampleIds[:],
                 self.ObservationIds[:], self.SampleMetadata,
-                self.ObservationMetadata, self.TableId)
+                self.ObservationMetadata, self.TableId, storage=self._storage)
 
     def iterSampleData(self):
         """Yields sample values"""
-        for samp_v in self._iter_samp():
-            yield self._conv_to_np(samp_v)
+        for samp_v in self._iter_samp_views():
+            yield samp_v.todense()
 
     def iterObservationData(self):
         """Yields observation values"""
-        for obs_v in self._iter_obs():
-            yield self._conv_to_np(obs_v)
+        for obs_v in self._iter_obs_views():
+            yield obs_v.todense()
 
     def iterSamples(self, conv_to_np=True):
         """Yields ``(sample_value, sample_id, sample_metadata)``
@@ -558,12 +682,12 @@ class Table(object):
         else:
             samp_metadata = self.SampleMetadata
 
-        iterator = izip(self._iter_samp(), self.SampleIds, samp_metadata)
-        for samp_v, samp_id, samp_md in iterator:
-            if conv_to_np:
-                yield (self._conv_to_np(samp_v), samp_id, samp_md)
-            else:
-                yield (samp_v, samp_id, samp_md)
+        if conv_to_np:
+            samp_vectors = (v.todense() for v in self._iter_samp_views())
+        else:
+            samp_vectors = self._iter_samp()
+
+        return izip(samp_vectors, self.SampleIds, samp_metadata)
 
     def iterObservations(self, conv_to_np=True):
         """Yields ``(observation_value, observation_id, observation_metadata)``
@@ -576,50 +700,95 @@ class Table(object):
         else:
             obs_metadata = self.ObservationMetadata
 
-        iterator = izip(self._iter_obs(), self.ObservationIds, obs_metadata)
-        for obs_v, obs_id, obs_md in iterator:
-            if conv_to_np:
-                yield (self._conv_to_np(obs_v), obs_id, obs_md)
-            else:
-                yield (obs_v, obs_id, obs_md)
+        if conv_to_np:
+            obs_vectors = (v.todense() for v in self._iter_obs_views())
+        else:
+            obs_vectors = self._iter_obs()
 
-    def sortSampleOrder(self, sample_order):
-        """Return a new table with samples in ``sample_order``"""
-        samp_md = []
-        vals = []
+        return izip(obs_vectors, self.ObservationIds, obs_metadata)
 
-        for id_ in sample_order:
-            cur_idx = self._sample_index[id_]
-            vals.append(self._conv_to_np(self[:,cur_idx]))
+    def iterSampleBlocks(self, block_size=1000, conv_to_np=True):
+        """Yields ``(sample_values, sample_ids, sample_metadata)`` in blocks
 
-            if self.SampleMetadata is not None:
-                samp_md.append(self.SampleMetadata[cur_idx])
+        Each block holds up to ``block_size`` consecutive samples. If
+        ``conv_to_np`` is ``True``, ``sample_values`` is a dense 2-D array
+        with one row per sample. Otherwise it is a sparse matrix holding the
+        samples as columns, as they are stored in the table.
 
-        if not samp_md:
-            samp_md = None
+        NOTE: will return ``None`` in ``sample_metadata`` positions if
+        ``self.SampleMetadata`` is set to ``None``
+        """
+        return self._iter_blocks('sample', block_size, conv_to_np)
 
-        return self.__class__(self._conv_to_self_type(vals,transpose=True),
-                sample_order[:], self.ObservationIds[:], samp_md,
-                self.ObservationMetadata, self.TableId)
+    def iterObservationBlocks(self, block_size=1000, conv_to_np=True):
+        """Yields ``(obs_values, obs_ids, obs_metadata)`` in blocks
 
-    def sortObservationOrder(self, obs_order):
-        """Return a new table with observations in ``observation order``"""
-        obs_md = []
-        vals = []
+        Each block holds up to ``block_size`` consecutive observations. If
+        ``conv_to_np`` is ``True``, ``obs_values`` is a dense 2-D array with
+        one row per observation. Otherwise it is a sparse matrix holding the
+        observations as rows.
+
+        NOTE: will return ``None`` in ``obs_metadata`` positions if
+        ``self.ObservationMetadata`` is set to ``None``
+        """
+        return self._iter_blocks('observation', block_size, conv_to_np)
 
-        for id_ in obs_order:
-            cur_idx = self._obs_index[id_]
-            vals.append(self[cur_idx,:])
+    def _iter_blocks(self, axis, block_size, conv_to_np):
+        """Yields blocks of vectors along ``axis``
 
-            if self.ObservationMetadata is not None:
-                obs_md.append(self.ObservationMetadata[cur_idx])
+        Each block is cut from a single contiguous range of the compressed
+        sparse arrays.
+        """
+        if block_size < 1:
+            raise TableException, "block_size must be positive"
+
+        if axis == 'sample':
+            order = 'csc'
+            ids = self.SampleIds
+            md = self.SampleMetadata
+            vec_len = len(self.ObservationIds)
+        else:
+            order = 'csr'
+            ids = self.ObservationIds
+            md = self.ObservationMetadata
+            vec_len = len(self.SampleIds)
+
+        if md is None:
+            md = (None,) * len(ids)
+
+        if conv_to_np:
+            pkd_ax, unpkd_ax, values = self._data.getCompressedArrays(order)
+
+        for start in xrange(0, len(ids), block_size):
+            end = min(start + block_size, len(ids))
+
+            if conv_to_np:
+                lo, hi = pkd_ax[start], pkd_ax[end]
+                block = zeros((end - start, vec_len), dtype=values.dtype)
+                block_idxs = np.repeat(np.arange(end - start),
+                                       np.diff(pkd_ax[start:end + 1]))
+                block[block_idxs, unpkd_ax[lo:hi]] = values[lo:hi]
+            else:
+                block = self._data.take(np.arange(start, end),
+                                        1 if axis == 'sample' else 0)
 
-        if not obs_md:
-            obs_md = None
+            yield block, ids[start:end], md[start:end]
 
-        return self.__class__(self._conv_to_self_type(vals),
-                self.SampleIds[:], obs_order[:], self.SampleMetadata,
-                obs_md, self.TableId)
+    def sortSampleOrder(self, sample_order):
+        """Return a new table with samples in ``sample_order``
+
+        The samples are permuted directly on the sparse matrix.
+        """
+        idxs = [self._sample_index[id_] for id_ in sample_order]
+        return self.filter(idxs, axis='sample')
+
+    def sortObservationOrder(self, obs_order):
+        """Return a new table with observations in ``observation order``
+
+        The observations are permuted directly on the sparse matrix.
+        """
+        idxs = [self._obs_index[id_] for id_ in obs_order]
+        return self.filter(idxs, axis='observation')
 
     def sortBySampleId(self, sort_f=natsort):
         """Return a table where samples are sorted by ``sort_f``
@@ -636,9 +805,6 @@ class Table(object):
         """
         return self.sortObservationOrder(sort_f(self.ObservationIds))
 
-    # a good refactor in the future is a general filter() method and then
-    # specify the axis, like Table.reduce
-
     # take() is tempting here as well...
     def filterSamples(self, f, invert=False):
         """Filter samples from self based on ``f``
@@ -650,34 +816,10 @@ class Table(object):
         invert: if ``invert == True``, a return value of ``True`` from ``f``
         indicates that a sample should be discarded
         """
-        samp_ids = []
-        samp_vals = []
-        samp_metadata = []
-
-        # builtin filter puts all of this into memory and then return to the for
-        # loop. This will impact memory substantially on large sparse matrices
-        for s_val, s_id, s_md in self.iterSamples():
-            if not xor(f(s_val, s_id, s_md), invert):
-                continue
-
-            # there is an implicit converstion to numpy types, want to make
-            # sure to convert back to underlying representation.
-            samp_vals.append(self._conv_to_self_type(s_val))
-            samp_metadata.append(s_md)
-            samp_ids.append(s_id)
+        keep = [xor(f(s_val, s_id, s_md), invert)
+                for s_val, s_id, s_md in self.iterSamples()]
 
-        # if we don't have any values to keep, throw an exception as we can
-        # create an inconsistancy in which there are observation ids but no
-        # matrix data in the resulting table
-        if not samp_ids:
-            raise TableException, "All samples were filtered out!"
-
-        # the additional call to _conv_to_self_type is to convert a list of
-        # vectors to a matrix
-        # transpose is necessary as the underlying storage is sample == col
-        return self.__class__(self._conv_to_self_type(samp_vals,transpose=True),
-                samp_ids[:], self.ObservationIds[:], samp_metadata,
-                self.ObservationMetadata, self.TableId)
+        return self.filter(asarray(keep, dtype=bool), axis='sample')
 
     def filterObservations(self, f, invert=False):
         """Filter observations from self based on ``f``
@@ -690,30 +832,133 @@ class Table(object):
         invert: if ``invert == True``, a return value of ``True`` from ``f``
         indicates that an observation should be discarded
         """
-        obs_ids = []
-        obs_vals = []
-        obs_metadata = []
+        keep = [xor(f(o_val, o_id, o_md), invert)
+                for o_val, o_id, o_md in self.iterObservations()]
+
+        return self.filter(asarray(keep, dtype=bool), axis='observation')
+
+    def filter(self, keep, axis='sample', invert=False):
+        """Filter samples or observations from self in a single operation
+
+        ``keep`` can be:
+
+        a boolean mask : ``True`` indicates that a sample (or observation)
+        should be retained
+
+        an index array : the indices of the samples (or observations) to
+        retain, in the order they should appear in the result
+
+        a function : passed the per-sample (or per-observation) sums and the
+        underlying matrix, and must return a boolean mask or an index array
+
+        ``axis`` is either ``sample`` or ``observation``.
+
+        invert: if ``invert == True``, the samples (or observations) selected
+        by ``keep`` are discarded instead
+
+        The new table is built with a single ``take`` on the underlying matrix
+        rather than by converting each retained vector.
+        """
+        if axis == 'sample':
+            ids = self.SampleIds
+        elif axis == 'observation':
+            ids = self.ObservationIds
+        else:
+            raise TableException, "Unknown axis '%s'" % axis
 
-        # builtin filter puts all of this into memory and then return to the for
-        # loop. This will impact memory substantially on large sparse matrices
-        for o_val, o_id, o_md in self.iterObservations():
-            if not xor(f(o_val, o_id, o_md), invert):
-                continue
+        if callable(keep):
+            keep = keep(asarray(self.sum(axis)), self._data)
 
-            # there is an implicit converstion to numpy types, want to make
-            # sure to convert back to underlying representation.
-            obs_vals.append(self._conv_to_self_type(o_val))
-            obs_metadata.append(o_md)
-            obs_ids.append(o_id)
+        keep = asarray(keep)
+
+        if keep.dtype == bool:
+            if keep.shape != (len(ids),):
+                raise TableException, "Mask length %d does not match %d " \
+                                      "%ss" % (keep.size, len(ids), axis)
+            if invert:
+                keep = ~keep
+            idxs = np.flatnonzero(keep)
+        else:
+            idxs = keep.astype(int)
+            if invert:
+                mask = np.ones(len(ids), dtype=bool)
+                mask[idxs] = False
+                idxs = np.flatnonzero(mask)
 
         # if we don't have any values to keep, throw an exception as we can
-        # create an inconsistancy in which there are sample ids but no
+        # create an inconsistancy in which there are ids on one axis but no
         # matrix data in the resulting table
-        if not obs_vals:
-            raise TableException, "All observations were filtered out!"
+        if not len(idxs):
+            raise TableException, "All %ss were filtered out!" % axis
+
+        new_ids = [ids[i] for i in idxs]
+
+        if axis == 'sample':
+            samp_md = self.SampleMetadata
+            if samp_md is not None:
+                samp_md = [samp_md[i] for i in idxs]
+
+            return self.__class__(self._data.take(idxs, 1), new_ids,
+                    self.ObservationIds[:], samp_md, self.ObservationMetadata,
+                    self.TableId, storage=self._storage)
+        else:
+            obs_md = self.ObservationMetadata
+            if obs_md is not None:
+                obs_md = [obs_md[i] for i in idxs]
+
+            return self.__class__(self._data.take(idxs, 0), self.SampleIds[:],
+                    new_ids, self.SampleMetadata, obs_md, self.TableId,
+                    storage=self._storage)
+
+    def _collapse_by_indicator(self, data, idxs, bin_idxs, n_bins, dtype,
+                               axis):
+        """Returns ``data`` collapsed by an indicator matrix
+
+        ``idxs`` and ``bin_idxs`` are aligned lists of the sample (or
+        observation) index and the bin it collapses into. Duplicate entries
+        are summed, so a sample listed twice for a bin counts twice. ``axis``
+        is either ``sample`` or ``observation``. The bins are summed in
+        ``sum_dtype`` of ``dtype``.
+        """
+        if not n_bins:
+            raise TableException, "Collapsed table is empty!"
+
+        dtype = sum_dtype(dtype).type
+
+        weights = np.ones(len(idxs), dtype=dtype)
+        idxs = asarray(idxs, dtype=int)
+        bin_idxs = asarray(bin_idxs, dtype=int)
+
+        if axis == 'sample':
+            indicator = coo_arrays_to_sparseobj((weights, (idxs, bin_idxs)),
+                    dtype=dtype, shape=(data.shape[1], n_bins))
+            return data.dot(indicator)
+        elif axis == 'observation':
+            indicator = coo_arrays_to_sparseobj((weights, (bin_idxs, idxs)),
+                    dtype=dtype, shape=(n_bins, data.shape[0]))
+            return indicator.dot(data)
+        else:
+            raise TableException, "Unknown axis '%s'" % axis
+
+    def _divide_axis(self, data, divisors, axis):
+        """Returns ``data`` with each sample (or observation) divided
+
+        ``divisors`` holds a value per sample if ``axis`` is ``sample``, or
+        per observation if ``axis`` is ``observation``. Only the nonzero values
+        are divided, and the result shares the index arrays of ``data``.
+        """
+        if axis == 'sample':
+            order = 'csc'
+        elif axis == 'observation':
+            order = 'csr'
+        else:
+            raise TableException, "Unknown axis '%s'" % axis
 
-        return self.__class__(self._conv_to_self_type(obs_vals),self.SampleIds[:],
-                obs_ids[:], self.SampleMetadata, obs_metadata, self.TableId)
+        pkd_ax, unpkd_ax, values = data.getCompressedArrays(order)
+        expanded = np.repeat(np.arange(len(pkd_ax) - 1), np.diff(pkd_ax))
+        values = values / asarray(divisors, dtype=float)[expanded]
+
+        return data.withValues(values, order)
 
     def binSamplesByMetadata(self, f, constructor=None):
         """Yields tables by metadata
@@ -749,7 +994,7 @@ class Table(object):
             data = self._conv_to_self_type(samp_values, transpose=True)
             yield bin, table_factory(data, samp_ids[:], self.ObservationIds[:],
                     samp_md, self.ObservationMetadata, self.TableId,
-                    constructor=constructor)
+                    constructor=constructor, storage=self._storage)
 
     def binObservationsByMetadata(self, f, constructor=None):
         """Yields tables by metadata
@@ -784,7 +1029,8 @@ class Table(object):
         for bin, (obs_ids, obs_values, obs_md) in bins.iteritems():
             yield bin, table_factory(self._conv_to_self_type(obs_values),
                     self.SampleIds[:], obs_ids[:], self.SampleMetadata,
-                    obs_md, self.TableId, constructor=constructor)
+                    obs_md, self.TableId, constructor=constructor,
+                    storage=self._storage)
 
     def collapseSamplesByMetadata(self, metadata_f, reduce_f=add, norm=True,
             min_group_size=2, include_collapsed_metadata=True,
@@ -847,14 +1093,11 @@ class Table(object):
 
         ``one_to_many`` and ``min_group_size`` are not supported together.
 
-        A final note on space consumption. At present, the ``one_to_many``
-        functionality requires a temporary dense matrix representation. This
-        was done so as it initially seems like true support requires rapid
-        ``__setitem__`` functionality on the ``SparseObj`` and at the time of
-        implementation, ``CSMat`` was O(N) to the number of nonzero elements.
-        This is a work around until either a better ``__setitem__``
-        implementation is in play on ``CSMat`` or a hybrid solution that allows
-        for multiple ``SparseObj`` types is used.
+        A final note on performance. When ``reduce_f`` is ``add``, and always
+        for ``one_to_many``, the collapse is computed as a single sparse
+        product of the table with a (samples x bins) indicator matrix, and
+        ``norm`` and the ``divide`` mode only scale the sparse values. Other
+        ``reduce_f`` functions are applied per bin.
         """
         if constructor is None:
             constructor = self.__class__
@@ -875,13 +1118,16 @@ class Table(object):
             if norm:
                 raise AttributeError, "norm and one_to_many are not supported together"
 
-            # determine the collapsed pathway
+            # determine the collapsed pathway and the bins of each sample
             # we drop all other associated metadata
             new_s_md = {}
-            s_md_count = {}
-            for id_, md in zip(self.SampleIds, self.SampleMetadata):
+            s_md_count = []
+            samp_idxs = []
+            samp_bins = []
+            for samp_idx, (id_, md) in enumerate(zip(self.SampleIds,
+                                                     self.SampleMetadata)):
                 md_iter = metadata_f(md)
-                num_md = 0
+                bins = []
                 while True:
                     try:
                         pathway, bin = md_iter.next()
@@ -899,56 +1145,22 @@ class Table(object):
                         break
 
                     new_s_md[bin] = pathway
-                    num_md += 1
+                    bins.append(bin)
 
-                s_md_count[id_] = num_md
+                samp_idxs.extend([samp_idx] * len(bins))
+                samp_bins.extend(bins)
+                s_md_count.append(max(len(bins), 1))
 
-            n_s = len(new_s_md)
             s_idx = dict([(bin,i) for i,bin in enumerate(sorted(new_s_md))])
 
             # We need to store floats, not ints, as things won't always divide
             # evenly.
             if one_to_many_mode == 'divide':
                 dtype = float
+                data = self._divide_axis(self._data, s_md_count, 'sample')
             else:
                 dtype = self._dtype
-
-            # allocate new data. using a dense representation allows for a
-            # workaround on CSMat.__setitem__ O(N) lookup. Assuming the number
-            # of collapsed samples is reasonable, then this doesn't suck too
-            # much.
-            new_data = zeros((len(self.ObservationIds), n_s), dtype=dtype)
-
-            # for each sample
-            # for each bin in the metadata
-            # for each value associated with the sample
-            for s_v, s_id, s_md in self.iterSamples():
-                md_iter = metadata_f(s_md)
-                while True:
-                    try:
-                        pathway, bin = md_iter.next()
-                    except IndexError:
-                        # if a pathway is incomplete
-                        if strict:
-                            # bail if strict, should never get here...
-                            err = "Incomplete pathway, ID: %s, metadata: %s" %\
-                                  (id_,md)
-                            raise IndexError, err
-                        else:
-                            # otherwise ignore
-                            continue
-                    except StopIteration:
-                        break
-
-                    if one_to_many_mode == 'add':
-                        new_data[:, s_idx[bin]] += s_v
-                    elif one_to_many_mode == 'divide':
-                        new_data[:, s_idx[bin]] += s_v / s_md_count[s_id]
-                    else:
-                        # Should never get here.
-                        raise ValueError("Unrecognized one-to-many mode '%s'. "
-                                         "Must be either 'add' or 'divide'." %
-                                         one_to_many_mode)
+                data = self._data
 
             if include_collapsed_metadata:
                 # reassociate pathway information
@@ -960,18 +1172,69 @@ class Table(object):
             collapsed_sample_ids = [k for k,i in sorted(s_idx.items(),
                                                         key=itemgetter(1))]
 
-            # convert back to self type
-            data = self._conv_to_self_type(new_data)
+            # a sample mapping to the same bin multiple times is counted
+            # multiple times
+            bin_idxs = [s_idx[bin] for bin in samp_bins]
+            data = self._collapse_by_indicator(data, samp_idxs, bin_idxs,
+                                               len(s_idx), dtype, 'sample')
+        elif reduce_f is add:
+            # bin the sample indices, the iteration order of bins matches
+            # binSamplesByMetadata
+            if self.SampleMetadata is None:
+                samp_metadata = (None,) * len(self.SampleIds)
+            else:
+                samp_metadata = self.SampleMetadata
+
+            bins = {}
+            for samp_idx, samp_md in enumerate(samp_metadata):
+                bin = metadata_f(samp_md)
+
+                # try to make it hashable...
+                if not isinstance(bin, Hashable):
+                    bin = tuple(bin)
+
+                if bin not in bins:
+                    bins[bin] = []
+                bins[bin].append(samp_idx)
+
+            samp_idxs = []
+            bin_idxs = []
+            bin_sizes = []
+            for bin, bin_samp_idxs in bins.iteritems():
+                n_bin_samps = len(bin_samp_idxs)
+                if n_bin_samps < min_group_size:
+                    continue
+
+                samp_idxs.extend(bin_samp_idxs)
+                bin_idxs.extend([len(collapsed_sample_ids)] * n_bin_samps)
+                bin_sizes.append(n_bin_samps)
+                collapsed_sample_ids.append(bin)
+
+                if include_collapsed_metadata:
+                    # retain metadata but store by original sample id
+                    tmp_md = {}
+                    for i in bin_samp_idxs:
+                        tmp_md[self.SampleIds[i]] = samp_metadata[i]
+                    collapsed_sample_md.append(tmp_md)
+
+            data = self._collapse_by_indicator(self._data, samp_idxs,
+                                               bin_idxs,
+                                               len(collapsed_sample_ids),
+                                               self._dtype, 'sample')
+            if norm:
+                data = self._divide_axis(data, bin_sizes, 'sample')
         else:
+            dtype = self._dtype
             for bin, table in self.binSamplesByMetadata(metadata_f):
                 if len(table.SampleIds) < min_group_size:
                     continue
 
                 redux_data = table.reduce(reduce_f, 'observation')
                 if norm:
-                    redux_data /= len(table.SampleIds)
+                    redux_data = redux_data / float(len(table.SampleIds))
 
-                collapsed_data.append(self._conv_to_self_type(redux_data))
+                dtype = np.result_type(dtype, redux_data.dtype).type
+                collapsed_data.append(redux_data)
                 collapsed_sample_ids.append(bin)
 
                 if include_collapsed_metadata:
@@ -981,7 +1244,10 @@ class Table(object):
                         tmp_md[id_] = md
                     collapsed_sample_md.append(tmp_md)
 
-            data = self._conv_to_self_type(collapsed_data, transpose=True)
+            collapsed_data = [self._conv_to_self_type(v, dtype=dtype)
+                              for v in collapsed_data]
+            data = self._conv_to_self_type(collapsed_data, transpose=True,
+                                           dtype=dtype)
 
         # if the table is empty
         if 0 in data.shape:
@@ -990,7 +1256,7 @@ class Table(object):
         return table_factory(data, collapsed_sample_ids,
                              self.ObservationIds[:], collapsed_sample_md,
                              self.ObservationMetadata, self.TableId,
-                             constructor=constructor)
+                             constructor=constructor, storage=self._storage)
 
     def collapseObservationsByMetadata(self, metadata_f, reduce_f=add,
             norm=True, min_group_size=2, include_collapsed_metadata=True,
@@ -1054,14 +1320,10 @@ class Table(object):
 
         ``one_to_many`` and ``min_group_size`` are not supported together.
 
-        A final note on space consumption. At present, the ``one_to_many``
-        functionality requires a temporary dense matrix representation. This
-        was done so as it initially seems like true support requires rapid
-        ``__setitem__`` functionality on the ``SparseObj`` and at the time of
-        implementation, ``CSMat`` was O(N) to the number of nonzero elements.
-        This is a work around until either a better ``__setitem__``
-        implementation is in play on ``CSMat`` or a hybrid solution that allows
-        for multiple ``SparseObj`` types is used.
+        A final note on space consumption. The ``one_to_many`` collapse is
+        computed as a single sparse product of a (bins x observations)
+        membership matrix with the table, so memory scales with the number of
+        nonzero elements rather than with the size of the collapsed table.
         """
         if constructor is None:
             constructor = self.__class__
@@ -1082,13 +1344,16 @@ class Table(object):
             if norm:
                 raise AttributeError, "norm and one_to_many are not supported together"
 
-            # determine the collapsed pathway
+            # determine the collapsed pathway and the bins of each observation
             # we drop all other associated metadata
             new_obs_md = {}
-            obs_md_count = {}
-            for id_,md in zip(self.ObservationIds, self.ObservationMetadata):
+            obs_md_count = []
+            obs_idxs = []
+            obs_bins = []
+            for obs_idx, (id_, md) in enumerate(zip(self.ObservationIds,
+                                                    self.ObservationMetadata)):
                 md_iter = metadata_f(md)
-                num_md = 0
+                bins = []
                 while True:
                     try:
                         pathway, bin = md_iter.next()
@@ -1106,79 +1371,51 @@ class Table(object):
                         break
 
                     new_obs_md[bin] = pathway # keyed by last field in hierarchy
-                    num_md += 1
+                    bins.append(bin)
 
-                obs_md_count[id_] = num_md
+                obs_idxs.extend([obs_idx] * len(bins))
+                obs_bins.extend(bins)
+                obs_md_count.append(max(len(bins), 1))
 
-            n_obs = len(new_obs_md)
-            obs_idx = dict([(bin,i) for i,bin in enumerate(sorted(new_obs_md))])
+            bin_idx = dict([(bin,i) for i,bin in enumerate(sorted(new_obs_md))])
 
             # We need to store floats, not ints, as things won't always divide
             # evenly.
             if one_to_many_mode == 'divide':
                 dtype = float
+                data = self._divide_axis(self._data, obs_md_count,
+                                         'observation')
             else:
                 dtype = self._dtype
-
-            # allocate new data. using a dense representation allows for a
-            # workaround on CSMat.__setitem__ O(N) lookup. Assuming the number
-            # of collapsed observations is reasonable, then this doesn't suck
-            # too much.
-            new_data = zeros((n_obs, len(self.SampleIds)), dtype=dtype)
-
-            # for each observation
-            # for each bin in the metadata
-            # for each value associated with the observation
-            for obs_v, obs_id, obs_md in self.iterObservations():
-                md_iter = metadata_f(obs_md)
-                while True:
-                    try:
-                        pathway, bin = md_iter.next()
-                    except IndexError:
-                        # if a pathway is incomplete
-                        if strict:
-                            # bail if strict, should never get here...
-                            err = "Incomplete pathway, ID: %s, metadata: %s" %\
-                                  (id_,md)
-                            raise IndexError, err
-                        else:
-                            # otherwise ignore
-                            continue
-                    except StopIteration:
-                        break
-
-                    if one_to_many_mode == 'add':
-                        new_data[obs_idx[bin], :] += obs_v
-                    elif one_to_many_mode == 'divide':
-                        new_data[obs_idx[bin], :] += \
-                                obs_v / obs_md_count[obs_id]
-                    else:
-                        # Should never get here.
-                        raise ValueError("Unrecognized one-to-many mode '%s'. "
-                                         "Must be either 'add' or 'divide'." %
-                                         one_to_many_mode)
+                data = self._data
 
             if include_collapsed_metadata:
                 # associate the pathways back
-                for k,i in sorted(obs_idx.items(), key=itemgetter(1)):
+                for k,i in sorted(bin_idx.items(), key=itemgetter(1)):
                     collapsed_obs_md.append({one_to_many_md_key:new_obs_md[k]})
 
             # get the new observation IDs
-            collapsed_obs_ids = [k for k,i in sorted(obs_idx.items(),
+            collapsed_obs_ids = [k for k,i in sorted(bin_idx.items(),
                                                      key=itemgetter(1))]
 
-            # convert back to self type
-            data = self._conv_to_self_type(new_data)
+            # an observation mapping to the same bin multiple times is counted
+            # multiple times
+            bin_idxs = [bin_idx[bin] for bin in obs_bins]
+            data = self._collapse_by_indicator(data, obs_idxs, bin_idxs,
+                                               len(bin_idx), dtype,
+                                               'observation')
         else:
+            dtype = self._dtype
             for bin, table in self.binObservationsByMetadata(metadata_f):
                 if len(table.ObservationIds) < min_group_size:
                     continue
 
                 redux_data = table.reduce(reduce_f, 'sample')
                 if norm:
-                    redux_data /= len(table.ObservationIds)
+                    redux_data = redux_data / float(len(table.ObservationIds))
 
-                collapsed_data.append(self._conv_to_self_type(redux_data))
+                dtype = np.result_type(dtype, redux_data.dtype).type
+                collapsed_data.append(redux_data)
                 collapsed_obs_ids.append(bin)
 
                 if include_collapsed_metadata:
@@ -1189,7 +1426,9 @@ class Table(object):
                         tmp_md[id_] = md
                     collapsed_obs_md.append(tmp_md)
 
-            data = self._conv_to_self_type(collapsed_data)
+            collapsed_data = [self._conv_to_self_type(v, dtype=dtype)
+                              for v in collapsed_data]
+            data = self._conv_to_self_type(collapsed_data, dtype=dtype)
 
         # if the table is empty
         if 0 in data.shape:
@@ -1197,7 +1436,7 @@ class Table(object):
 
         return table_factory(data, self.SampleIds[:], collapsed_obs_ids,
                 self.SampleMetadata, collapsed_obs_md, self.TableId,
-                constructor=constructor)
+                constructor=constructor, storage=self._storage)
 
     def transformSamples(self, f):
         """Iterate over samples, applying a function ``f`` to each value
@@ -1207,13 +1446,21 @@ class Table(object):
         float) that replaces the provided sample value
         """
         new_m = []
+        dtype = self._dtype
 
         for s_v, s_id, s_md in self.iterSamples():
-            new_m.append(self._conv_to_self_type(f(s_v, s_id, s_md)))
+            new_v = asarray(f(s_v, s_id, s_md))
+            dtype = np.result_type(dtype, new_v.dtype).type
+            new_m.append(new_v)
 
-        return self.__class__(self._conv_to_self_type(new_m, transpose=True),
+        # the table takes the type of the returned values, so an int table
+        # transformed by a float function holds floats
+        new_m = [self._conv_to_self_type(v, dtype=dtype) for v in new_m]
+
+        return self.__class__(self._conv_to_self_type(new_m, transpose=True,
+                                                      dtype=dtype),
                 self.SampleIds[:], self.ObservationIds[:], self.SampleMetadata,
-                self.ObservationMetadata, self.TableId)
+                self.ObservationMetadata, self.TableId, storage=self._storage)
 
     def transformObservations(self, f):
         """Iterate over observations, applying a function ``f`` to each value
@@ -1224,46 +1471,166 @@ class Table(object):
 
         """
         new_m = []
+        dtype = self._dtype
 
         for obs_v, obs_id, obs_md in self.iterObservations():
-            new_m.append(self._conv_to_self_type(f(obs_v, obs_id, obs_md)))
+            new_v = asarray(f(obs_v, obs_id, obs_md))
+            dtype = np.result_type(dtype, new_v.dtype).type
+            new_m.append(new_v)
 
-        return self.__class__(self._conv_to_self_type(new_m), self.SampleIds[:],
-                self.ObservationIds[:], self.SampleMetadata,
-                self.ObservationMetadata, self.TableId)
+        new_m = [self._conv_to_self_type(v, dtype=dtype) for v in new_m]
+
+        return self.__class__(self._conv_to_self_type(new_m, dtype=dtype),
+                self.SampleIds[:], self.ObservationIds[:],
+                self.SampleMetadata, self.ObservationMetadata, self.TableId,
+                storage=self._storage)
+
+    def transformSamplesVectorized(self, f, preserves_zeros=True):
+        """Apply ``f`` to the values of all samples at once
+
+        ``f`` is either a NumPy ufunc, which is given the values, or a
+        function that is given ``(values, indptr)`` where the values of sample
+        ``i`` are ``values[indptr[i]:indptr[i+1]]``. It must return an array of
+        new values of the same length.
+
+        preserves_zeros: if ``True``, ``f`` must map zero to zero and only the
+        nonzero values are passed. If ``False``, every value, including the
+        zeros, is passed and the table is expanded to a dense array while
+        ``f`` is applied.
+        """
+        return self._transform_vectorized(f, 'sample', preserves_zeros)
+
+    def transformObservationsVectorized(self, f, preserves_zeros=True):
+        """Apply ``f`` to the values of all observations at once
+
+        ``f`` is either a NumPy ufunc, which is given the values, or a
+        function that is given ``(values, indptr)`` where the values of
+        observation ``i`` are ``values[indptr[i]:indptr[i+1]]``. It must return
+        an array of new values of the same length.
+
+        preserves_zeros: if ``True``, ``f`` must map zero to zero and only the
+        nonzero values are passed. If ``False``, every value, including the
+        zeros, is passed and the table is expanded to a dense array while
+        ``f`` is applied.
+        """
+        return self._transform_vectorized(f, 'observation', preserves_zeros)
+
+    def _transform_vectorized(self, f, axis, preserves_zeros):
+        """Returns a new table with ``f`` applied to the values along ``axis``
+        """
+        if axis == 'sample':
+            order = 'csc'
+            n_vecs = len(self.SampleIds)
+            vec_len = len(self.ObservationIds)
+        elif axis == 'observation':
+            order = 'csr'
+            n_vecs = len(self.ObservationIds)
+            vec_len = len(self.SampleIds)
+        else:
+            raise TableException, "Unknown axis '%s'" % axis
+
+        pkd_ax, unpkd_ax, values = self._data.getCompressedArrays(order)
+        expanded = np.repeat(np.arange(n_vecs), np.diff(pkd_ax))
+
+        if not preserves_zeros:
+            # every position is stored, so the vectors are the rows of a
+            # dense array
+            dense = zeros((n_vecs, vec_len), dtype=values.dtype)
+            dense[expanded, unpkd_ax] = values
+
+            values = dense.ravel()
+            pkd_ax = np.arange(0, values.size + 1, vec_len)
+            expanded = np.repeat(np.arange(n_vecs), vec_len)
+            unpkd_ax = np.tile(np.arange(vec_len), n_vecs)
+
+        if isinstance(f, np.ufunc):
+            new_values = asarray(f(values))
+        else:
+            new_values = asarray(f(values, pkd_ax))
+
+        if new_values.shape != values.shape:
+            raise TableException, "Expected %d values, got %d" % \
+                                  (values.size, new_values.size)
+
+        # share the index arrays unless zeros have to be dropped
+        if preserves_zeros and new_values.all():
+            data = self._data.withValues(new_values, order)
+        else:
+            if axis == 'sample':
+                coords = (unpkd_ax, expanded)
+            else:
+                coords = (expanded, unpkd_ax)
+
+            data = coo_arrays_to_sparseobj((new_values, coords),
+                    dtype=new_values.dtype.type, shape=self._data.shape)
+
+        return self._with_data(data)
 
     def normObservationBySample(self):
         """Return new table with vals as relative abundances within each sample
+
+        Samples that sum to zero are left as zeros.
         """
-        def f(samp_v, samp_id, samp_md):
-            return samp_v / float(samp_v.sum())
-        return self.transformSamples(f)
+        sums = asarray(self.sum('sample'), dtype=float)
+        sums[sums == 0] = 1
+        return self._with_data(self._divide_axis(self._data, sums, 'sample'))
 
     def normSampleByObservation(self):
         """Return new table with vals as relative abundances within each obs
+
+        Observations that sum to zero are left as zeros.
         """
-        def f(obs_v,obs_id,obs_md):
-            return obs_v / float(obs_v.sum())
-        #f = lambda x: x / float(x.sum())
-        return self.transformObservations(f)
+        sums = asarray(self.sum('observation'), dtype=float)
+        sums[sums == 0] = 1
+        return self._with_data(self._divide_axis(self._data, sums,
+                                                 'observation'))
 
     def normObservationByMetadata(self,obs_metadata_id):
         """Return new table with vals divided by obs_metadata_id
         """
-        def f(obs_v,obs_id,obs_md):
-            return obs_v / obs_md[obs_metadata_id]
-        return self.transformObservations(f)
+        divisors = [md[obs_metadata_id] for md in self.ObservationMetadata]
+        return self._with_data(self._divide_axis(self._data, divisors,
+                                                 'observation'))
+
+    def _with_data(self, data):
+        """Returns a new table of self type holding ``data``
+
+        The ids and metadata of self are retained.
+        """
+        return self.__class__(data, self.SampleIds[:], self.ObservationIds[:],
+                self.SampleMetadata, self.ObservationMetadata, self.TableId,
+                storage=self._storage)
 
-    def nonzero(self):
+    def nonzero(self, chunk_size=2**16):
         """Returns locations of nonzero elements within the data matrix
 
-        The values returned are ``(observation_id, sample_id)``
+        The values returned are ``(observation_id, sample_id)``, ordered by
+        observation and then by sample. The ids are gathered from the sparse
+        structure ``chunk_size`` elements at a time.
         """
-        # this is naively implemented. If performance is a concern, private
-        # methods can be written to hit against the underlying types directly
-        for o_idx, samp_vals in enumerate(self.iterObservationData()):
-            for s_idx in samp_vals.nonzero()[0]:
-                yield (self.ObservationIds[o_idx], self.SampleIds[s_idx])
+        pkd_ax, unpkd_ax, values = self._data.getCompressedArrays('csr')
+        obs_idxs = np.repeat(np.arange(len(pkd_ax) - 1), np.diff(pkd_ax))
+
+        # explicitly stored zeros are not reported
+        is_nonzero = values != 0
+        obs_idxs = obs_idxs[is_nonzero]
+        samp_idxs = unpkd_ax[is_nonzero]
+
+        obs_ids = self._id_array(self.ObservationIds)
+        samp_ids = self._id_array(self.SampleIds)
+
+        for start in xrange(0, len(obs_idxs), chunk_size):
+            end = start + chunk_size
+            for pair in izip(obs_ids.take(obs_idxs[start:end]),
+                             samp_ids.take(samp_idxs[start:end])):
+                yield pair
+
+    def _id_array(self, ids):
+        """Returns ``ids`` as a 1-D object array"""
+        id_array = empty(len(ids), dtype=object)
+        for idx, id_ in enumerate(ids):
+            id_array[idx] = id_
+        return id_array
 
     def nonzeroCounts(self, axis, binary=False):
         """Get nonzero summaries about an axis
@@ -1275,27 +1642,29 @@ class Table(object):
         """
         if binary:
             dtype = 'int'
-            op = lambda x: x.nonzero()[0].size
         else:
-            dtype = self._data.dtype
-            op = lambda x: x.sum()
-
-        if axis is 'sample':
-            # can use np.bincount for CSMat or ScipySparse
-            result = zeros(len(self.SampleIds), dtype=dtype)
-            for idx, vals in enumerate(self.iterSampleData()):
-                result[idx] = op(vals)
-        elif axis is 'observation':
-            # can use np.bincount for CSMat or ScipySparse
-            result = zeros(len(self.ObservationIds), dtype=dtype)
-            for idx, vals in enumerate(self.iterObservationData()):
-                result[idx] = op(vals)
+            dtype = sum_dtype(self._data.dtype)
+
+        if axis == 'sample':
+            order = 'csc'
         else:
-            result = zeros(1, dtype=dtype)
-            for vals in self.iterSampleData():
-                result[0] += op(vals)
+            order = 'csr'
 
-        return result
+        pkd_ax, unpkd_ax, values = self._data.getCompressedArrays(order)
+        n_vecs = len(pkd_ax) - 1
+        vec_idxs = np.repeat(np.arange(n_vecs), np.diff(pkd_ax))
+
+        if binary:
+            weights = values != 0
+        else:
+            weights = values
+
+        result = np.bincount(vec_idxs, weights=weights, minlength=n_vecs)
+
+        if axis not in ('sample', 'observation'):
+            result = asarray([result.sum()])
+
+        return result.astype(dtype)
 
     def _union_id_order(self, a, b):
         """Determines merge order for id lists A and B"""
@@ -1320,6 +1689,26 @@ class Table(object):
                 idx += 1
         return new_order
 
+    def _remap_coo(self, obs_order, samp_order):
+        """Returns ``(rows, cols, values)`` of self in a new id space
+
+        ``obs_order`` and ``samp_order`` map ids to their index in the new
+        space. Values whose observation or sample is not present there are
+        dropped.
+        """
+        obs_map = asarray([obs_order.get(id_, -1)
+                           for id_ in self.ObservationIds], dtype=int)
+        samp_map = asarray([samp_order.get(id_, -1)
+                            for id_ in self.SampleIds], dtype=int)
+
+        pkd_ax, unpkd_ax, values = self._data.getCompressedArrays('csr')
+        rows = obs_map.take(np.repeat(np.arange(len(pkd_ax) - 1),
+                                      np.diff(pkd_ax)))
+        cols = samp_map.take(unpkd_ax)
+
+        keep = (rows >= 0) & (cols >= 0)
+        return rows[keep], cols[keep], values[keep]
+
     def merge(self, other, Sample='union', Observation='union',
             sample_metadata_f=prefer_self, observation_metadata_f=prefer_self):
         """Merge two tables together
@@ -1333,7 +1722,8 @@ class Table(object):
         other. These functions are given both metadata dictsand must return
         a single metadata dict
 
-        NOTE: There is an implicit type conversion to ``float``. Tables using
+        NOTE: The values are stored with the common type of both tables, so
+        merging two integer tables gives an integer table. Tables using
         strings as the type are not supported. No check is currently in
         place.
 
@@ -1359,11 +1749,6 @@ class Table(object):
         else:
             raise TableException, "Unknown observation merge type: %s" % Observation
 
-        # convert these to lists, no need to be dictionaries and reduces
-        # calls to items() and allows for pre-caluculating insert order
-        new_samp_order = sorted(new_samp_order.items(), key=itemgetter(1))
-        new_obs_order = sorted(new_obs_order.items(), key=itemgetter(1))
-
         # if we don't have any samples, complain loudly. This is likely from
         # performing an intersection without overlapping ids
         if not new_samp_order:
@@ -1371,25 +1756,35 @@ class Table(object):
         if not new_obs_order:
             raise TableException, "No observations in resulting table!"
 
+        # remap the values of both tables into the new id space. Overlapping
+        # values are summed when the new matrix is constructed
+        rows = []
+        cols = []
+        values = []
+        for table in (self, other):
+            t_rows, t_cols, t_values = table._remap_coo(new_obs_order,
+                                                         new_samp_order)
+            rows.append(t_rows)
+            cols.append(t_cols)
+            values.append(t_values)
+
+        data = coo_arrays_to_sparseobj((np.concatenate(values),
+                (np.concatenate(rows), np.concatenate(cols))),
+                dtype=sum_dtype(np.result_type(self._dtype,
+                                               other._dtype)).type,
+                shape=(len(new_obs_order), len(new_samp_order)))
+
+        # convert these to lists, no need to be dictionaries and reduces
+        # calls to items() and allows for pre-caluculating insert order
+        new_samp_order = sorted(new_samp_order.items(), key=itemgetter(1))
+        new_obs_order = sorted(new_obs_order.items(), key=itemgetter(1))
+
         # helper index lookups
         other_obs_idx = other._obs_index
         self_obs_idx = self._obs_index
         other_samp_idx = other._sample_index
         self_samp_idx = self._sample_index
 
-        # pre-calculate sample order from each table. We only need to do this
-        # once which dramatically reduces the number of dict lookups necessary
-        # within the inner loop
-        other_samp_order = []
-        self_samp_order = []
-        for samp_id, nsi in new_samp_order: # nsi -> new_sample_index
-            other_samp_order.append((nsi, other_samp_idx.get(samp_id, None)))
-            self_samp_order.append((nsi, self_samp_idx.get(samp_id,None)))
-
-        # pre-allocate the a list for placing the resulting vectors as the
-        # placement id is not ordered
-        vals = [None for i in range(len(new_obs_order))]
-
         ### POSSIBLE DECOMPOSITION
         # resulting sample ids and sample metadata
         sample_ids = []
@@ -1434,77 +1829,12 @@ class Table(object):
 
             obs_md.append(observation_metadata_f(self_md, other_md))
 
-        # length used for construction of new vectors
-        vec_length = len(new_samp_order)
-
-        # walk over observations in our new order
-        for obs_id, new_obs_idx in new_obs_order:
-            # create new vector for matrix values
-            new_vec = zeros(vec_length, dtype='float')
+        return self.__class__(data, sample_ids[:], obs_ids[:], sample_md,
+                              obs_md, storage=self._storage)
 
-            # This method allows for the creation of a matrix of self type.
-            # See note above
-            #new_vec = data_f()
-
-            # see if the observation exists in other, if so, pull it out.
-            # if not, set to the placeholder missing
-            if other.observationExists(obs_id):
-                other_vec = other.observationData(obs_id)
-            else:
-                other_vec = None
-
-            # see if the observation exists in self, if so, pull it out.
-            # if not, set to the placeholder missing
-            if self.observationExists(obs_id):
-                self_vec = self.observationData(obs_id)
-            else:
-                self_vec = None
-
-            # short circuit. If other doesn't have any values, then we can just
-            # take all values from self
-            if other_vec is None:
-                for (n_idx, s_idx) in self_samp_order:
-                    if s_idx is not None:
-                        new_vec[n_idx] = self_vec[s_idx]
-
-            # short circuit. If self doesn't have any values, then we can just
-            # take all values from other
-            elif self_vec is None:
-                for (n_idx, o_idx) in other_samp_order:
-                    if o_idx is not None:
-                        new_vec[n_idx] = other_vec[o_idx]
-
-            else:
-                # NOTE: DM 7.5.12, no observed improvement at the profile level
-                # was made on this inner loop by using self_samp_order and
-                # other_samp_order lists.
-
-                # walk over samples in our new order
-                for samp_id, new_samp_idx in new_samp_order:
-                    # pull out each individual sample value. This is expensive,
-                    # but the vectors are in a different alignment. It is
-                    # possible that this could be improved with numpy take but
-                    # needs to handle missing values appropriately
-                    if samp_id not in self_samp_idx:
-                        self_vec_value = 0
-                    else:
-                        self_vec_value = self_vec[self_samp_idx[samp_id]]
-
-                    if samp_id not in other_samp_idx:
-                        other_vec_value = 0
-                    else:
-                        other_vec_value = other_vec[other_samp_idx[samp_id]]
-
-                    new_vec[new_samp_idx] = self_vec_value + other_vec_value
-
-            # convert our new vector to self type as to make sure we don't
-            # accidently force a dense representation in memory
-            vals[new_obs_idx] = self._conv_to_self_type(new_vec)
-
-        return self.__class__(self._conv_to_self_type(vals), sample_ids[:],
-                              obs_ids[:], sample_md, obs_md)
-
-    def format_hdf5(self, h5grp, generated_by):
+    def format_hdf5(self, h5grp, generated_by, compression=None,
+                    compression_opts=None, shuffle=False, chunks=None,
+                    narrow_dtypes=False):
         """Store CSC and CSR in place
 
         The expected structure of this group is below. A few basic definitions,
@@ -1515,8 +1845,6 @@ class Table(object):
 
         ### ADD IN SCIPY SPARSE CSC/CSR URLS
         ### ADD IN WIKIPEDIA PAGE LINK TO CSR
-        ### ALL THESE INTS CAN BE UINT, SCIPY DOES NOT BY DEFAULT STORE AS THIS
-        ###     THOUGH
         ### METADATA ARE NOT REPRESENTED HERE YET
         ./id                     : str, an arbitrary ID
         ./type                   : str, the table type (e.g, OTU table)
@@ -1528,21 +1856,41 @@ class Table(object):
         ./nnz                    : int32 or int64, number of non zero elements
         ./observation            : Group
         ./observation/ids        : (N,) dataset of str or vlen str
-        ./observation/data       : (N,) dataset of float64
+        ./observation/data       : (N,) dataset of float64, or of the integer
+                                   type of an integer table
         ./observation/indices    : (N,) dataset of int32
         ./observation/indptr     : (M+1,) dataset of int32
         [./observation/metadata] : Optional, JSON str, in index order with ids
         ./sample                 : Group
         ./sample/ids             : (M,) dataset of str or vlen str
-        ./sample/data            : (M,) dataset of float64
+        ./sample/data            : (M,) dataset of float64, or of the integer
+                                   type of an integer table
         ./sample/indices         : (M,) dataset of int32
         ./sample/indptr          : (N+1,) dataset of int32
         [./sample/metadata]      : Optional, JSON str, in index order with ids
 
+        If ``narrow_dtypes`` is set, ``indices`` and ``indptr`` are stored
+        in the smallest unsigned integer type that holds them, and ``data``
+        of an integer table is stored as uint32 (or int32) where the values
+        fit, and as 64-bit integers otherwise.
+
         Paramters
         ---------
         h5grp : a h5py ``Group`` or an open h5py ``File``
         generated_by : str
+        compression : None, 'gzip' or 'lzf', the compression filter applied to
+            the ``data``, ``indices`` and ``indptr`` datasets
+        compression_opts : compression settings, e.g. the gzip level (0-9)
+        shuffle : bool, apply the HDF5 shuffle filter, which generally
+            improves compression of numeric data
+        chunks : None, True, int or tuple. The chunk shape of the ``data``,
+            ``indices`` and ``indptr`` datasets. True lets h5py pick a chunk
+            shape. If None, h5py chunks the datasets automatically only when
+            a filter is requested
+        narrow_dtypes : bool, store with the smallest dtypes that hold the
+            table
+
+        Filters and chunking are not applied to empty datasets.
 
         See Also
         --------
@@ -1553,23 +1901,58 @@ class Table(object):
         ### is it okay to actually create files in doctest?
 
         """
+        if isinstance(chunks, (int, long)) and not isinstance(chunks, bool):
+            chunks = (chunks,)
+
+        def narrowed_dtype(values, default):
+            """The dtype to store values with"""
+            if not narrow_dtypes:
+                return default
+            if not len(values):
+                return np.dtype(np.uint8)
+            return np.min_scalar_type(values.max())
+
+        def data_dtype(values):
+            """The dtype to store the matrix values with"""
+            if np.dtype(self._dtype).kind not in 'iu':
+                return np.float64
+            if not narrow_dtypes:
+                return values.dtype
+            if not len(values):
+                return np.dtype(np.uint32)
+            if values.min() >= 0:
+                return np.promote_types(np.min_scalar_type(values.max()),
+                                        np.uint32)
+            return np.promote_types(np.promote_types(
+                np.min_scalar_type(values.min()),
+                np.min_scalar_type(values.max())), np.int32)
+
+        def create_dataset(grp, name, values, dtype):
+            """Create a dataset, with filters if it is not empty"""
+            kwargs = {}
+            if len(values):
+                dset_chunks = chunks
+                if isinstance(chunks, tuple):
+                    # h5py does not allow chunks larger than the dataset
+                    dset_chunks = (min(chunks[0], len(values)),)
+                kwargs = {'compression': compression,
+                          'compression_opts': compression_opts,
+                          'shuffle': shuffle,
+                          'chunks': dset_chunks}
+            grp.create_dataset(name, shape=(len(values),), dtype=dtype,
+                               data=values, **kwargs)
+
         def axis_dump(grp, ids, md, order):
             """Store for an axis"""
-            self._data.convert(order)
+            indptr, indices, data = self._data.getCompressedArrays(order)
 
             len_ids = len(ids)
-            len_indptr = len(self._data._matrix.indptr)
-            len_data = self._data.size
-
-            grp.create_dataset('data', shape=(len_data,),
-                               dtype=np.float64,
-                               data=self._data._matrix.data)
-            grp.create_dataset('indices', shape=(len_data,),
-                               dtype=np.int32,
-                               data=self._data._matrix.indices)
-            grp.create_dataset('indptr', shape=(len_indptr,),
-                               dtype=np.int32,
-                               data=self._data._matrix.indptr)
+
+            create_dataset(grp, 'data', data, data_dtype(data))
+            create_dataset(grp, 'indices', indices,
+                           narrowed_dtype(indices, np.int32))
+            create_dataset(grp, 'indptr', indptr,
+                           narrowed_dtype(indptr, np.int32))
 
             ### if we store IDs in the table as numpy arrays then this store
             ### is cleaner, as is the parse
@@ -1598,6 +1981,35 @@ class Table(object):
         axis_dump(h5grp.create_group('sample'), self.SampleIds,
                   self.SampleMetadata, 'csc')
 
+    def _get_matrix_element_type(self, has_data):
+        """Returns ``(type, name)`` of the matrix elements for the writers
+
+        Integer and float dtypes of any width are written as ``int`` and
+        ``float``. Otherwise the type is that of the first element, or an
+        integer if the matrix has no data.
+        """
+        if has_data:
+            kind = np.dtype(self._dtype).kind
+            if kind in 'iu':
+                return int, "int"
+            elif kind == 'f':
+                return float, "float"
+
+        # Default the matrix element type to test to be an integer in case we
+        # don't have any data in the matrix to test.
+        test_element = 0
+        if has_data:
+            test_element = self[0,0]
+
+        if isinstance(test_element, int):
+            return int, "int"
+        elif isinstance(test_element, float):
+            return float, "float"
+        elif isinstance(test_element, unicode):
+            return unicode, "unicode"
+        else:
+            raise TableException("Unsupported matrix data type.")
+
     def getBiomFormatObject(self, generated_by):
         """Returns a dictionary representing the table in BIOM format.
 
@@ -1633,21 +2045,8 @@ class Table(object):
             num_rows = num_cols = 0
         hasData = True if num_rows > 0 and num_cols > 0 else False
 
-        # Default the matrix element type to test to be an integer in case we
-        # don't have any data in the matrix to test.
-        test_element = 0
-        if hasData:
-            test_element = self[0,0]
-
         # Determine the type of elements the matrix is storing.
-        if isinstance(test_element, int):
-            dtype, matrix_element_type = int, "int"
-        elif isinstance(test_element, float):
-            dtype, matrix_element_type = float, "float"
-        elif isinstance(test_element, unicode):
-            dtype, matrix_element_type = unicode, "unicode"
-        else:
-            raise TableException("Unsupported matrix data type.")
+        dtype, matrix_element_type = self._get_matrix_element_type(hasData)
 
         # Fill in details about the matrix.
         biom_format_obj["matrix_element_type"] = "%s" % matrix_element_type
@@ -1716,21 +2115,8 @@ class Table(object):
             num_rows = num_cols = 0
         hasData = True if num_rows > 0 and num_cols > 0 else False
 
-        # Default the matrix element type to test to be an integer in case we
-        # don't have any data in the matrix to test.
-        test_element = 0
-        if hasData:
-            test_element = self[0,0]
-
         # Determine the type of elements the matrix is storing.
-        if isinstance(test_element, int):
-            dtype, matrix_element_type = int, "int"
-        elif isinstance(test_element, float):
-            dtype, matrix_element_type = float, "float"
-        elif isinstance(test_element, unicode):
-            dtype, matrix_element_type = unicode, "unicode"
-        else:
-            raise TableException("Unsupported matrix data type.")
+        dtype, matrix_element_type = self._get_matrix_element_type(hasData)
 
         # Fill in details about the matrix.
         if direct_io:
@@ -1741,69 +2127,53 @@ class Table(object):
             shape = '"shape": [%d, %d],' % (num_rows, num_cols)
 
         # Fill in details about the rows in the table and fill in the matrix's
-        # data.
+        # data. The data triples are formatted in blocks straight from the
+        # sparse representation, so zeros are never visited.
         if direct_io:
             direct_io.write('"data": [')
+            for block_idx, block in enumerate(self._iter_json_data_blocks()):
+                if block_idx:
+                    direct_io.write(',')
+                direct_io.write(block)
+            direct_io.write("],")
         else:
-            data = ['"data": [']
+            data = ['"data": [', ','.join(self._iter_json_data_blocks()),
+                    "],"]
 
         max_row_idx = len(self.ObservationIds) - 1
         max_col_idx = len(self.SampleIds) - 1
+
+        if self.ObservationMetadata is None:
+            obs_metadata = (None,) * len(self.ObservationIds)
+        else:
+            obs_metadata = self.ObservationMetadata
+
         rows = ['"rows": [']
-        have_written = False
-        for obs_index, obs in enumerate(self.iterObservations()):
+        for obs_index, (obs_id, obs_md) in enumerate(izip(self.ObservationIds,
+                                                          obs_metadata)):
             # i'm crying on the inside
             if obs_index != max_row_idx:
-                rows.append('{"id": "%s", "metadata": %s},' % (obs[1],
-                                                               dumps(obs[2])))
+                rows.append('{"id": "%s", "metadata": %s},' % (obs_id,
+                                                               dumps(obs_md)))
             else:
-                rows.append('{"id": "%s", "metadata": %s}],' % (obs[1],
-                                                                dumps(obs[2])))
-
-            # if we are not on the last row
-            #if obs_index != max_row_idx:
-            #    data.append("[%s]," % ','.join(map(repr, obs[0])))
-            #else:
-            #    data.append("[%s]]," % ','.join(map(repr, obs[0])))
-
-            # turns out its a pain to figure out when to place commas. the
-            # simple work around, at the expense of a little memory
-            # (bound by the number of samples) is to build of what will be
-            # written, and then add in the commas where necessary.
-            built_row = []
-            for col_index, val in enumerate(obs[0]):
-                if float(val) != 0.0:
-                    built_row.append("[%d,%d,%r]" % (obs_index, col_index,
-                                                     val))
-            if built_row:
-                # if we have written a row already, its safe to add a comma
-                if have_written:
-                    if direct_io:
-                        direct_io.write(',')
-                    else:
-                        data.append(',')
-                if direct_io:
-                    direct_io.write(','.join(built_row))
-                else:
-                    data.append(','.join(built_row))
+                rows.append('{"id": "%s", "metadata": %s}],' % (obs_id,
+                                                                dumps(obs_md)))
 
-                have_written = True
-
-        # finalize the data block
-        if direct_io:
-            direct_io.write("],")
+        if self.SampleMetadata is None:
+            samp_metadata = (None,) * len(self.SampleIds)
         else:
-            data.append("],")
+            samp_metadata = self.SampleMetadata
 
         # Fill in details about the columns in the table.
         columns = ['"columns": [']
-        for samp_index, samp in enumerate(self.iterSamples()):
+        for samp_index, (samp_id, samp_md) in enumerate(izip(self.SampleIds,
+                                                             samp_metadata)):
             if samp_index != max_col_idx:
-                columns.append('{"id": "%s", "metadata": %s},' % (samp[1],
-                        dumps(samp[2])))
+                columns.append('{"id": "%s", "metadata": %s},' % (samp_id,
+                        dumps(samp_md)))
             else:
-                columns.append('{"id": "%s", "metadata": %s}]' % (samp[1],
-                        dumps(samp[2])))
+                columns.append('{"id": "%s", "metadata": %s}]' % (samp_id,
+                        dumps(samp_md)))
 
         rows = ''.join(rows)
         columns = ''.join(columns)
@@ -1818,6 +2188,44 @@ class Table(object):
                                       matrix_element_type, shape,
                                       ''.join(data), rows, columns])
 
+    def _iter_json_data_blocks(self, block_size=2**16):
+        """Yields the nonzero data as BIOM JSON ``[row,col,value]`` triples
+
+        Each yielded string holds up to ``block_size`` comma separated triples
+        in row-major order. The triples are formatted directly from the CSR
+        arrays of the underlying matrix, so the cost is bound by the number of
+        nonzero elements rather than by the shape of the table.
+        """
+        indptr, indices, values = self._data.getCompressedArrays('csr')
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+        nonzero = values != 0
+        if not nonzero.all():
+            rows = rows[nonzero]
+            indices = indices[nonzero]
+            values = values[nonzero]
+
+        # Python scalars format faster than numpy scalars, and format the same
+        # for these types
+        dtype = values.dtype
+        as_python = dtype == np.float64 or dtype.kind == 'i' or \
+                (dtype.kind == 'u' and dtype.itemsize < 8)
+
+        for start in xrange(0, len(values), block_size):
+            stop = start + block_size
+            block_values = values[start:stop]
+            n_triples = len(block_values)
+
+            triples = [None] * (3 * n_triples)
+            triples[0::3] = rows[start:stop].tolist()
+            triples[1::3] = indices[start:stop].tolist()
+            if as_python:
+                triples[2::3] = block_values.tolist()
+            else:
+                triples[2::3] = list(block_values)
+
+            yield ','.join(['[%d,%d,%r]'] * n_triples) % tuple(triples)
+
     def getBiomFormatPrettyPrint(self,generated_by):
         """Returns a 'pretty print' format of a BIOM file
 
@@ -1941,10 +2349,7 @@ def table_factory(data, sample_ids, observation_ids, sample_metadata=None,
         data = dict_to_sparseobj(data, dtype)
 
     elif isinstance(data, tuple) and isinstance(data[0], ndarray):
-        # give it a go...
-        # there isn't a CSMat equivilent
-        from biom.backends.scipysparse import coo_arrays_to_scipy
-        data = coo_arrays_to_scipy(data)
+        data = coo_arrays_to_sparseobj(data, dtype=dtype, shape=shape)
 
     elif isinstance(data, SparseObj):
         pass
@@ -1957,11 +2362,147 @@ def table_factory(data, sample_ids, observation_ids, sample_metadata=None,
             ObservationMetadata=observation_metadata,
             TableId=table_id, **kwargs)
 
+def merge_tables(tables, sample='union', observation='union',
+                 sample_metadata_f=prefer_self,
+                 observation_metadata_f=prefer_self):
+    """Merge many tables in a single pass
+
+    ``tables`` is an iterable of ``Table`` objects or paths to JSON BIOM
+    files. Paths are parsed one at a time, so only a single input table is
+    held in memory. The axes, ``sample`` and ``observation``, can be either
+    ``union`` or ``intersection`` and the resulting id order is the same as
+    merging the tables pairwise with ``Table.merge``.
+
+    ``sample_metadata_f`` and ``observation_metadata_f`` define how to merge
+    metadata between tables, and are called exactly as in the pairwise
+    merges: for each table after the first, every id merged so far is given
+    its merged metadata (or ``None``) and the metadata of that table (or
+    ``None`` if the table lacks the id). They must return a single metadata
+    dict.
+
+    The values of every table are remapped into the global id space as the
+    table is read, and the result is constructed once at the end. The type
+    of the result is that of the first table.
+    """
+    if sample not in ('union', 'intersection'):
+        raise TableException, "Unknown Sample merge type: %s" % sample
+    if observation not in ('union', 'intersection'):
+        raise TableException, "Unknown observation merge type: %s" % observation
+
+    samp_order = {}
+    obs_order = {}
+    samp_ids = []
+    obs_ids = []
+    samp_md = []
+    obs_md = []
+    samp_counts = []
+    obs_counts = []
+    rows = []
+    cols = []
+    values = []
+
+    table_class = None
+    dtype = None
+    n_tables = 0
+
+    for table in tables:
+        if isinstance(table, basestring):
+            from biom.parse import parse_biom_table
+            with open(table, 'U') as table_f:
+                table = parse_biom_table(table_f, streaming=True)
+
+        if table_class is None:
+            table_class = table.__class__
+            storage = table._storage
+            dtype = table._dtype
+        else:
+            dtype = np.result_type(dtype, table._dtype).type
+        n_tables += 1
+
+        for ids, md, order, new_ids, new_md, counts, md_f in \
+                ((table.SampleIds, table.SampleMetadata, samp_order, samp_ids,
+                  samp_md, samp_counts, sample_metadata_f),
+                 (table.ObservationIds, table.ObservationMetadata, obs_order,
+                  obs_ids, obs_md, obs_counts, observation_metadata_f)):
+            if md is None:
+                md = (None,) * len(ids)
+
+            table_md = [None] * len(new_ids)
+            for id_, id_md in izip(ids, md):
+                if id_ not in order:
+                    order[id_] = len(new_ids)
+                    new_ids.append(id_)
+                    new_md.append(None)
+                    table_md.append(None)
+                    counts.append(0)
+
+                idx = order[id_]
+                table_md[idx] = id_md
+                counts[idx] += 1
+
+            # as with Table.merge, the metadata of the first table is taken
+            # as is, and every id merged so far is combined with the metadata
+            # of each following table, which is None if it lacks the id
+            if n_tables == 1:
+                new_md[:] = table_md
+            else:
+                new_md[:] = [md_f(merged_md, next_md)
+                             for merged_md, next_md in izip(new_md, table_md)]
+
+        t_rows, t_cols, t_values = table._remap_coo(obs_order, samp_order)
+        rows.append(t_rows)
+        cols.append(t_cols)
+        values.append(t_values)
+
+    if not n_tables:
+        raise TableException, "No tables to merge!"
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    values = np.concatenate(values)
+
+    # an intersection keeps the ids found in every table, in the order of the
+    # first table
+    keep = np.ones(len(values), dtype=bool)
+
+    if sample == 'intersection':
+        samp_keep = asarray(samp_counts) == n_tables
+        samp_ids = [id_ for id_, k in izip(samp_ids, samp_keep) if k]
+        samp_md = [md for md, k in izip(samp_md, samp_keep) if k]
+        keep &= samp_keep[cols]
+        cols = np.cumsum(samp_keep)[cols] - 1
+
+    if observation == 'intersection':
+        obs_keep = asarray(obs_counts) == n_tables
+        obs_ids = [id_ for id_, k in izip(obs_ids, obs_keep) if k]
+        obs_md = [md for md, k in izip(obs_md, obs_keep) if k]
+        keep &= obs_keep[rows]
+        rows = np.cumsum(obs_keep)[rows] - 1
+
+    rows = rows[keep]
+    cols = cols[keep]
+    values = values[keep]
+
+    # if we don't have any samples, complain loudly. This is likely from
+    # performing an intersection without overlapping ids
+    if not samp_ids:
+        raise TableException, "No samples in resulting table!"
+    if not obs_ids:
+        raise TableException, "No observations in resulting table!"
+
+    # overlapping values are summed, so integers are widened to sum_dtype
+    data = coo_arrays_to_sparseobj((values, (rows, cols)),
+                                   dtype=sum_dtype(dtype).type,
+                                   shape=(len(obs_ids), len(samp_ids)))
+
+    return table_class(data, samp_ids, obs_ids, samp_md, obs_md,
+                       storage=storage)
+
 def get_zerod_matrix(mat, dtype=float):
     """Returns a zerod matrix"""
     if isinstance(mat, ndarray):
-        return zeros(mat.shape, dtype=float)
+        return zeros(mat.shape, dtype=dtype)
     elif isinstance(mat, SparseObj):
-        return SparseObj(*mat.shape, dtype=float)
+        return SparseObj(*mat.shape, dtype=dtype)
     else:
         raise TableException, "Unknown mat type"
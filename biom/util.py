@@ -15,7 +15,9 @@ from os.path import (abspath, dirname, exists, split, splitext)
 import re
 from hashlib import md5
 from gzip import open as gzip_open
-from numpy import mean, median, min, max
+from numpy import (mean, median, min, max, asarray, iinfo, int32, float32,
+                   dtype as np_dtype, issubdtype, integer, unsignedinteger,
+                   can_cast, int_, uint)
 from pyqi.util import pyqi_system_call
 from pyqi.core.log import StdErrLogger
 
@@ -128,6 +130,42 @@ def index_list(l):
     """Takes a list and returns {l[idx]:idx}"""
     return dict([(id_,idx) for idx,id_ in enumerate(l)])
 
+def compact_dtype(values):
+    """Returns the smallest dtype that compact storage can hold values in
+
+    Floating point values wider than float32 are stored as float32, and
+    integer values wider than int32 as int32 if they all fit. Values of any
+    other type keep their dtype.
+    """
+    values = asarray(values)
+    kind = values.dtype.kind
+
+    if kind == 'f' and values.dtype.itemsize > 4:
+        return float32
+    elif kind in 'iu' and values.dtype.itemsize > 4:
+        bounds = iinfo(int32)
+        if values.size and (values.min() < bounds.min or
+                            values.max() > bounds.max):
+            return values.dtype.type
+        return int32
+    else:
+        return values.dtype.type
+
+def sum_dtype(dtype):
+    """Returns the dtype that values of dtype are summed in
+
+    Like numpy and scipy, integers are summed in at least the platform
+    integer so that sums of compact integer values do not wrap around.
+    """
+    dtype = np_dtype(dtype)
+
+    if issubdtype(dtype, unsignedinteger) and can_cast(dtype, uint):
+        return np_dtype(uint)
+    elif issubdtype(dtype, integer) and can_cast(dtype, int_):
+        return np_dtype(int_)
+    else:
+        return dtype
+
 def load_biom_config():
     """Returns biom-format configuration read in from file.
 
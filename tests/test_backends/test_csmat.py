@@ -8,13 +8,13 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 #-----------------------------------------------------------------------------
 
-from numpy import zeros, ndarray, array
+from numpy import zeros, ndarray, array, float32, float64, int32
 from biom.unit_test import TestCase, main
 from biom.table import flatten
 from biom.backends.csmat import CSMat, to_csmat, \
     list_nparray_to_csmat, list_list_to_csmat, \
     list_csmat_to_csmat, nparray_to_csmat, \
-    dict_to_csmat, list_dict_to_csmat
+    dict_to_csmat, list_dict_to_csmat, coo_arrays_to_csmat
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2011-2013, The BIOM Format Development Team"
@@ -188,6 +188,36 @@ class CSMatTests(TestCase):
         exp = sorted([((1,2),1),((2,2),42),((3,2),3)])
         self.assertEqual(sorted(self.empty_cols.items()), exp)
 
+    def test_setitem_staged(self):
+        """Writes are staged and packed on read"""
+        self.obj.convert("csr")
+        self.obj[0,0] = 5
+        self.obj[2,0] = 6
+        self.obj[2,0] = 7
+        self.assertEqual(self.obj._dok, {(0,0):5, (2,0):7})
+        self.assertEqual(self.obj._order, "csr")
+
+        # scalar reads do not pack
+        self.assertEqual(self.obj[2,0], 7)
+        self.assertEqual(self.obj[1,2], 3)
+        self.assertTrue((0,0) in self.obj)
+        self.assertEqual(self.obj._order, "csr")
+        self.assertRaises(ValueError, self.obj.__setitem__, (2,0), 0)
+
+        self.assertEqual(self.obj.size, 5)
+        self.assertEqual(self.obj._dok, {})
+        exp = sorted([((0,0),5),((0,1),2),((1,2),3),((2,0),7),((2,3),4)])
+        self.assertEqual(sorted(self.obj.items()), exp)
+
+        obj = CSMat(2,3)
+        obj[0,2] = 1
+        obj[1,0] = 2
+        self.assertEqual(obj.sum(), 3)
+        exp = CSMat(3,2)
+        exp[2,0] = 1
+        exp[0,1] = 2
+        self.assertEqual(obj.T, exp)
+
     def test_getitem_simple(self):
         """Tests simple getitem"""
         self.assertEqual(self.obj[(1,2)], 3)
@@ -227,6 +257,24 @@ class CSMatTests(TestCase):
         exp[0,2] = 3
         self.assertEqual(self.empty_cols[3,:], exp)
 
+    def test_getitem_search(self):
+        """Finds elements in csr and csc order"""
+        for order in ("csr", "csc"):
+            self.empty_row_mid.convert(order)
+            self.assertEqual(self.empty_row_mid[0,1], 9)
+            self.assertEqual(self.empty_row_mid[2,2], 2)
+            self.assertEqual(self.empty_row_mid[1,0], 0)
+            self.assertEqual(self.empty_row_mid[2,3], 0)
+
+    def test_getValues(self):
+        """Get many elements at once"""
+        obs = self.obj.getValues([0,1,2,2,0], [1,2,3,0,3])
+        self.assertEqual(obs, array([2,3,4,0,0]))
+        self.assertEqual(self.empty.getValues([1], [1]), array([0]))
+        self.assertEqual(self.obj.getValues([], []).shape, (0,))
+        self.assertRaises(IndexError, self.obj.getValues, [3], [0])
+        self.assertRaises(IndexError, self.obj.getValues, [0], [-1])
+
     def test_getitem_direct(self):
         """test _getitem"""
         self.assertEqual(self.obj._order, "coo")
@@ -476,6 +524,35 @@ class CSMatTests(TestCase):
         obs = self.empty.getRow(2)
         self.assertEqual(obs, exp)
 
+    def test_getRowView(self):
+        """Get a read-only view of a row"""
+        obs = self.obj.getRowView(0)
+        self.assertEqual(obs.shape, (1,4))
+        self.assertEqual(obs.todense(), array([1,2,0,0]))
+        self.assertEqual(list(obs), [(0,1), (1,2)])
+
+        obs = self.empty_row_mid.getRowView(1)
+        self.assertEqual(obs.size, 0)
+        self.assertEqual(obs.todense(), array([0,0,0,0]))
+
+        self.assertEqual(self.empty.getRowView(2).todense(), zeros(4))
+        self.assertRaises(IndexError, self.obj.getRowView, 3)
+        self.assertRaises(IndexError, self.obj.getRowView, -1)
+
+    def test_getColView(self):
+        """Get a read-only view of a col"""
+        obs = self.obj.getColView(2)
+        self.assertEqual(obs.shape, (3,1))
+        self.assertEqual(obs.todense(), array([0,3,0]))
+        self.assertEqual(CSMat.convertVectorToDense(obs), array([0,3,0]))
+
+        obs = self.empty_col_start.getColView(1)
+        exp = CSMat.convertVectorToDense(self.empty_col_start.getCol(1))
+        self.assertEqual(obs.todense(), exp)
+
+        self.assertRaises(IndexError, self.obj.getColView, 4)
+        self.assertRaises(IndexError, self.obj.getColView, -1)
+
     def test_getCol(self):
         """Get a col"""
         exp = CSMat(3,1)
@@ -518,6 +595,83 @@ class CSMatTests(TestCase):
         obs = self.empty.getCol(2)
         self.assertEqual(obs, exp)
 
+    def test_withValues(self):
+        """Replaces the values of a CSMat"""
+        pkd_ax, unpkd_ax, values = self.empty_row_mid.getCompressedArrays('csr')
+        obs = self.empty_row_mid.withValues(values * 2, 'csr')
+        exp = nparray_to_csmat(array([[2,18,0,0],[0,0,0,0],[2,2,4,0]]))
+        self.assertTrue(obs._unpkd_ax is unpkd_ax)
+        self.assertEqual(obs, exp)
+
+        self.assertRaises(ValueError, self.empty_row_mid.withValues,
+                          array([1,2]), 'csr')
+
+    def test_compact(self):
+        """Stores the values of a CSMat in as few bytes as possible"""
+        obs = self.obj.compact()
+        self.assertEqual(obs, self.obj)
+        self.assertEqual(obs._values.dtype, float32)
+        self.assertEqual(obs[0,2], 0)
+        self.assertTrue(obs.compact() is obs)
+
+        obs = self.obj.compact(int32)
+        self.assertEqual(obs._values.dtype, int32)
+        self.assertEqual(obs[2,3], 4)
+
+    def test_nbytes(self):
+        """Counts the bytes held by the compressed arrays"""
+        self.assertEqual(self.obj.nbytes, 4 * 4 + 4 * 4 + 4 * 8)
+        self.assertEqual(self.obj._order, "csr")
+        self.assertEqual(self.obj.compact().nbytes, 4 * 4 + 4 * 4 + 4 * 4)
+
+    def test_dot(self):
+        """Multiplies two CSMats"""
+        other = nparray_to_csmat(array([[1,0],[0,2],[3,0],[0,0]]))
+        exp = nparray_to_csmat(array([[1,4],[9,0],[0,0]]))
+        obs = self.obj.dot(other)
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs.shape, (3,2))
+        self.assertEqual(obs[1,1], 0)
+        self.assertEqual(obs.dtype, float64)
+
+        obs = self.empty_row_mid.dot(self.empty_row_mid.T)
+        exp = nparray_to_csmat(array([[82,0,10],[0,0,0],[10,0,6]]))
+        self.assertEqual(obs, exp)
+
+        self.assertRaises(ValueError, self.obj.dot, self.obj)
+
+    def test_take(self):
+        """Takes rows and columns by index"""
+        obs = self.empty_row_mid.take([2,1,2], 0)
+        exp = nparray_to_csmat(array([[1,1,2,0],[0,0,0,0],[1,1,2,0]]))
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs.shape, (3,4))
+
+        obs = self.empty_row_mid.take([3,1], 1)
+        exp = nparray_to_csmat(array([[0,9],[0,0],[0,1]]))
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs.shape, (3,2))
+
+        obs = self.empty.take([], 0)
+        self.assertEqual(obs.shape, (0,self.empty.shape[1]))
+        self.assertEqual(obs.size, 0)
+
+        self.assertRaises(ValueError, self.empty_row_mid.take, [0], 2)
+
+    def test_getCompressedArrays(self):
+        """Returns the raw compressed sparse arrays"""
+        pkd_ax, unpkd_ax, values = self.empty_row_mid.getCompressedArrays('csr')
+        self.assertEqual(pkd_ax, array([0,2,2,5]))
+        self.assertEqual(unpkd_ax, array([0,1,0,1,2]))
+        self.assertEqual(values, array([1,9,1,1,2]))
+
+        pkd_ax, unpkd_ax, values = self.empty_row_mid.getCompressedArrays('csc')
+        self.assertEqual(pkd_ax, array([0,2,4,5,5]))
+        self.assertEqual(unpkd_ax, array([0,2,0,2,2]))
+        self.assertEqual(values, array([1,1,9,1,2]))
+
+        self.assertRaises(ValueError, self.obj.getCompressedArrays, 'coo')
+
     def test_update(self):
         """updates should work on new and inplace values"""
         self.obj.update({(0,0):10,(0,3):6})
@@ -598,6 +752,16 @@ class CSMatTests(TestCase):
         obs = self.single_ele.sum(1)
         self.assertEqual(obs, exp)
 
+        # axis sums of integers are accumulated in at least the platform int
+        obj = to_csmat({(0,1):2, (2,1):3}, dtype=int)
+        self.assertEqual(obj.sum(0), array([0,5]))
+        self.assertEqual(obj.sum(0).dtype, int)
+        self.assertEqual(obj.sum(1), array([2,0,3]))
+
+        obj = to_csmat({(0,0):2**30, (1,0):2**30, (2,0):2**30}, dtype=int32)
+        self.assertEqual(obj.sum(0), array([3 * 2**30]))
+        self.assertEqual(obj.sum(0).dtype, int)
+
     def test_bulkCOOUpdate(self):
         """Stages data"""
         self.obj.convert("csr")
@@ -1005,12 +1169,26 @@ class CSMatTests(TestCase):
         self.assertEqual(self.empty._values, array([]))
 
     def test_toCSR(self):
-        """implicitly tested in test_convert_* functions"""
-        pass
+        """build csr from unsorted coo with empty rows"""
+        obj = CSMat(4,3)
+        pkd_ax, unpkd_ax, values = obj._toCSR([2,0,2,0], [2,1,0,0],
+                                              [1,2,3,4])
+        self.assertEqual(pkd_ax, array([0,2,2,4,4]))
+        self.assertEqual(unpkd_ax, array([0,1,0,2]))
+        self.assertEqual(values, array([4.,2.,3.,1.]))
+
+        pkd_ax, unpkd_ax, values = obj._toCSR([], [], [])
+        self.assertEqual(pkd_ax, array([0,0,0,0,0]))
+        self.assertEqual(values, array([]))
 
     def test_toCSC(self):
-        """implicitly tested in test_convert_* functions"""
-        pass
+        """build csc from unsorted coo with empty cols"""
+        obj = CSMat(4,3)
+        pkd_ax, unpkd_ax, values = obj._toCSC([2,0,3,0], [2,2,0,0],
+                                              [1,2,3,4])
+        self.assertEqual(pkd_ax, array([0,2,2,4]))
+        self.assertEqual(unpkd_ax, array([0,3,0,2]))
+        self.assertEqual(values, array([4.,3.,2.,1.]))
 
     def test_toCOO(self):
         """implicitly tested in test_convert_* functions"""
@@ -1064,6 +1242,19 @@ class SupportTests(TestCase):
         obs = list_list_to_csmat(input)
         self.assertEqual(obs, exp)
 
+    def test_coo_arrays_to_csmat(self):
+        """Convert (values, (rows, cols)) arrays to csmat"""
+        input = (array([1,2,5,-5,3]), (array([0,0,1,1,2]), array([2,2,0,0,1])))
+        exp = CSMat(3,3)
+        exp.update({(0,2):3,(2,1):3})
+        obs = coo_arrays_to_csmat(input, dtype=int)
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs.size, 2)
+
+        obs = coo_arrays_to_csmat(input, shape=(4,5))
+        self.assertEqual(obs.shape, (4,5))
+        self.assertEqual(obs[0,2], 3.0)
+
     def test_nparray_to_csmat(self):
         """Convert nparray to csmat"""
         input = array([[1,2,3,4],[-1,6,7,8],[9,10,11,12]])
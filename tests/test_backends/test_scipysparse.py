@@ -8,14 +8,18 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 #-----------------------------------------------------------------------------
 
-from numpy import array
+from uuid import uuid4
+import h5py
+from numpy import array, may_share_memory, int32, int64, float32
 from scipy.sparse import lil_matrix
+from biom import biom_config
 from biom.unit_test import TestCase, main
 from biom.backends.scipysparse import (ScipySparseMat, to_scipy,
                                        list_nparray_to_scipy,
                                        list_list_to_scipy, list_scipy_to_scipy,
                                        nparray_to_scipy, dict_to_scipy,
-                                       list_dict_to_scipy, coo_arrays_to_scipy)
+                                       list_dict_to_scipy, coo_arrays_to_scipy,
+                                       H5ScipySparseMat)
 
 __author__ = "Jai Ram Rideout"
 __copyright__ = "Copyright 2011-2013, The BIOM Format Development Team"
@@ -131,6 +135,37 @@ class ScipySparseMatTests(TestCase):
             m.convert('coo')
             self.assertEqual(m.fmt, None)
 
+    def test_convert_dual_cache(self):
+        """Test keeping both csr and csc formats."""
+        key = 'python_code_sparse_dual_cache_max_bytes'
+        orig = biom_config[key]
+        try:
+            biom_config[key] = '0'
+            self.mat1.convert('csr')
+            csr = self.mat1._matrix
+            self.mat1.convert('csc')
+            self.mat1.convert('csr')
+            self.assertFalse(self.mat1._matrix is csr)
+
+            biom_config[key] = '1000000'
+            csr = self.mat1._matrix
+            self.mat1.convert('csc')
+            csc = self.mat1._matrix
+            self.mat1.convert('coo')
+            self.mat1.convert('csr')
+            self.assertTrue(self.mat1._matrix is csr)
+            self.mat1.convert('csc')
+            self.assertTrue(self.mat1._matrix is csc)
+
+            # changing the matrix drops the cached formats
+            self.mat1[1,1] = 42
+            self.mat1.convert('csr')
+            self.assertEqual(self.mat1[1,1], 42)
+            self.mat1.convert('csc')
+            self.assertEqual(self.mat1.getCol(1).sum(), 42)
+        finally:
+            biom_config[key] = orig
+
     def test_transpose(self):
         """Test transposition."""
         obs = self.null1.T
@@ -190,6 +225,130 @@ class ScipySparseMatTests(TestCase):
 
         self.assertEqual(self.col_vec.getCol(0), self.col_vec)
 
+    def test_getRowView(self):
+        """Test viewing a row of the matrix."""
+        for m in self.nulls:
+            with self.assertRaises(IndexError):
+                _ = m.getRowView(0)
+
+        obs = self.mat1.getRowView(1)
+        self.assertEqual(obs.shape, (1,3))
+        self.assertEqual(obs.todense(), array([3,0,4]))
+        self.assertEqual(ScipySparseMat.convertVectorToDense(obs),
+                         array([3,0,4]))
+        self.assertTrue(may_share_memory(obs.values, self.mat1._matrix.data))
+
+        with self.assertRaises(IndexError):
+            _ = self.mat1.getRowView(2)
+
+    def test_getColView(self):
+        """Test viewing a column of the matrix."""
+        for m in self.nulls:
+            with self.assertRaises(IndexError):
+                _ = m.getColView(0)
+
+        obs = self.mat1.getColView(2)
+        self.assertEqual(obs.shape, (2,1))
+        self.assertEqual(obs.todense(), array([2,4]))
+        self.assertEqual(self.mat1.getColView(1).size, 0)
+        self.assertEqual(self.single_ele.getColView(0).todense(), array([42]))
+
+        with self.assertRaises(IndexError):
+            _ = self.mat1.getColView(-1)
+
+    def test_withValues(self):
+        """Test replacing the values of a matrix."""
+        indptr, indices, data = self.mat1.getCompressedArrays('csc')
+        obs = self.mat1.withValues(data / 2., 'csc')
+        exp = ScipySparseMat(2,3,data=array([[0.5,0,1],[1.5,0,2]]))
+        self.assertTrue(may_share_memory(obs._matrix.indices, indices))
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs.dtype, float)
+
+        obs = self.null2.withValues(array([]), 'csr')
+        self.assertEqual(obs.shape, (0,42))
+
+        with self.assertRaises(ValueError):
+            _ = self.mat1.withValues(array([1,2]), 'csr')
+
+    def test_compact(self):
+        """Test storing a matrix in as few bytes as possible."""
+        obs = self.mat1.compact()
+        self.assertEqual(obs.dtype, float32)
+        self.assertEqual(obs._matrix.indices.dtype, int32)
+        self.assertTrue(obs.compact() is obs)
+        self.assertEqual(sorted(obs.items()), sorted(self.mat1.items()))
+
+        obs = self.mat1.compact(int32)
+        self.assertEqual(obs.dtype, int32)
+        self.assertEqual(obs[1,2], 4)
+
+        big = ScipySparseMat(1,2,dtype=int64,data=array([[2**40,1]]))
+        self.assertEqual(big.compact().dtype, int64)
+        self.assertTrue(self.null2.compact() is self.null2)
+
+    def test_nbytes(self):
+        """Test counting the bytes held by a matrix."""
+        self.mat1.convert('csr')
+        mat = self.mat1._matrix
+        exp = mat.data.nbytes + mat.indices.nbytes + mat.indptr.nbytes
+        self.assertEqual(self.mat1.nbytes, exp)
+
+        compact = self.mat1.compact(float32)
+        self.assertEqual(compact.nbytes, 4 * 4 + 4 * 4 + 3 * 4)
+        self.assertEqual(self.null1.nbytes, 0)
+
+    def test_dot(self):
+        """Test multiplying two matrices."""
+        other = ScipySparseMat(3,2,data=array([[1,0],[0,2],[3,0]]))
+        exp = ScipySparseMat(2,2,data=array([[7,0],[15,0]]))
+        obs = self.mat1.dot(other)
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs.fmt, 'csr')
+
+        obs = self.null3.dot(self.null2)
+        self.assertEqual(obs.shape, (42,42))
+        self.assertEqual(obs.size, 0)
+
+        with self.assertRaises(ValueError):
+            _ = self.mat1.dot(self.mat1)
+
+    def test_take(self):
+        """Test taking rows and columns by index."""
+        obs = self.mat1.take([1,1,0], 0)
+        exp = ScipySparseMat(3,3,data=array([[3,0,4],[3,0,4],[1,0,2]]))
+        self.assertEqual(obs, exp)
+
+        obs = self.mat1.take([2,0], 1)
+        exp = ScipySparseMat(2,2,data=array([[2,1],[4,3]]))
+        self.assertEqual(obs, exp)
+
+        obs = self.null2.take([], 1)
+        self.assertEqual(obs.shape, (0,0))
+
+        with self.assertRaises(ValueError):
+            _ = self.mat1.take([0], 2)
+
+    def test_getCompressedArrays(self):
+        """Test getting the raw compressed sparse arrays."""
+        indptr, indices, data = self.mat1.getCompressedArrays('csr')
+        self.assertEqual(indptr, array([0,2,4]))
+        self.assertEqual(indices, array([0,2,0,2]))
+        self.assertEqual(data, array([1,2,3,4]))
+
+        indptr, indices, data = self.mat1.getCompressedArrays('csc')
+        self.assertEqual(indptr, array([0,2,2,4]))
+        self.assertEqual(indices, array([0,1,0,1]))
+        self.assertEqual(data, array([1,3,2,4]))
+
+        indptr, indices, data = self.null2.getCompressedArrays('csc')
+        self.assertEqual(len(indptr), 43)
+        self.assertEqual(len(indices), 0)
+        self.assertEqual(len(data), 0)
+
+        with self.assertRaises(ValueError):
+            _ = self.mat1.getCompressedArrays('coo')
+
     def test_items_iteritems(self):
         """Test getting a list of non-zero elements."""
         exp = []
@@ -339,6 +498,89 @@ class ScipySparseMatTests(TestCase):
         with self.assertRaises(IndexError):
             _ = self.mat1[1,3]
 
+        self.assertEqual(self.mat1[-1,-1], 4)
+        self.mat1.convert('csc')
+        self.assertEqual(self.mat1[1,0], 3)
+        self.assertEqual(self.mat1[0,1], 0)
+
+    def test_getValues(self):
+        """Test getting many elements from the matrix."""
+        obs = self.mat1.getValues([1,0,0,1], [2,1,0,0])
+        self.assertEqual(obs, array([4,0,1,3]))
+        self.assertEqual(self.mat1.getValues([], []).shape, (0,))
+
+        with self.assertRaises(ValueError):
+            _ = self.mat1.getValues([0], [0,1])
+
+
+class H5ScipySparseMatTests(TestCase):
+    def setUp(self):
+        # 1 0 2
+        # 3 0 4
+        self.mat = ScipySparseMat(2,3,data=array([[1,0,2],[3,0,4]]))
+        self.h5 = h5py.File(uuid4().hex, 'w', driver='core',
+                            backing_store=False)
+        for name, fmt in (('observation', 'csr'), ('sample', 'csc')):
+            self.mat.convert(fmt)
+            grp = self.h5.create_group(name)
+            grp.create_dataset('data', data=self.mat._matrix.data)
+            grp.create_dataset('indices', data=self.mat._matrix.indices)
+            grp.create_dataset('indptr', data=self.mat._matrix.indptr)
+        self.lazy = H5ScipySparseMat(2, 3, h5grp=self.h5)
+
+    def tearDown(self):
+        self.h5.close()
+
+    def test_lazy_vectors(self):
+        """Rows and columns are read without loading the matrix"""
+        self.assertEqual(self.lazy.shape, (2,3))
+        self.assertEqual(self.lazy.size, 4)
+        self.assertEqual(self.lazy.dtype, self.mat.dtype)
+        self.assertEqual(self.lazy.getRow(1), self.mat.getRow(1))
+        self.assertEqual(self.lazy[:,1], self.mat[:,1])
+        self.assertEqual(self.lazy[:,2], self.mat[:,2])
+        self.assertTrue(self.lazy.is_lazy)
+
+        with self.assertRaises(IndexError):
+            _ = self.lazy.getCol(3)
+
+    def test_lazy_take(self):
+        """Test taking rows and columns without loading the matrix."""
+        self.assertEqual(self.lazy.take([2,0], 1), self.mat.take([2,0], 1))
+        self.assertEqual(self.lazy.take([1], 0), self.mat.take([1], 0))
+        self.assertEqual(self.lazy.take([1], 1).size, 0)
+        self.assertTrue(self.lazy.is_lazy)
+
+    def test_lazy_views(self):
+        """Test viewing rows and columns without loading the matrix."""
+        self.assertEqual(self.lazy.getRowView(1).todense(), array([3,0,4]))
+        self.assertEqual(self.lazy.getColView(2).todense(), array([2,4]))
+        self.assertEqual(self.lazy.getColView(1).size, 0)
+        self.assertTrue(self.lazy.is_lazy)
+
+        with self.assertRaises(IndexError):
+            _ = self.lazy.getRowView(2)
+
+    def test_lazy_compact(self):
+        """Test that lazy matrices are not loaded to be compacted."""
+        self.assertTrue(self.lazy.compact() is self.lazy)
+        self.assertEqual(self.lazy.nbytes, 0)
+        _ = self.lazy.getRow(1)
+        self.assertEqual(self.lazy.nbytes,
+                         self.h5['observation/indptr'][:].nbytes)
+        self.assertTrue(self.lazy.is_lazy)
+
+    def test_load(self):
+        """Other operations load the full matrix"""
+        self.assertEqual(self.lazy[1,2], 4)
+        self.assertFalse(self.lazy.is_lazy)
+        self.assertEqual(self.lazy, self.mat)
+        self.assertEqual(self.mat, self.lazy)
+
+        lazy = H5ScipySparseMat(2, 3, h5grp=self.h5, order='sample')
+        self.assertEqual(lazy.T, self.mat.T)
+        self.assertEqual(lazy.fmt, 'csc')
+
 # These tests are pretty much copied from CSMat's conversion tests...
 class SupportTests(TestCase):
     def test_coo_arrays_to_scipy(self):
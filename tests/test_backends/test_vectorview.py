@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2011-2013, The BIOM Format Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from numpy import array
+from biom.unit_test import TestCase, main
+from biom.backends.vectorview import SparseVectorView
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2011-2013, The BIOM Format Development Team"
+__credits__ = ["Daniel McDonald", "Jai Ram Rideout"]
+__license__ = "BSD"
+__url__ = "http://biom-format.org"
+__maintainer__ = "Daniel McDonald"
+__email__ = "daniel.mcdonald@colorado.edu"
+
+class SparseVectorViewTests(TestCase):
+    def setUp(self):
+        # 0 5 0 7
+        self.row = SparseVectorView(array([1,3]), array([5.,7.]), (1,4))
+        # 0 0 0
+        self.empty_col = SparseVectorView(array([], dtype=int),
+                                          array([], dtype=int), (3,1))
+
+    def test_dtype(self):
+        """The view has the type of its values"""
+        self.assertEqual(self.row.dtype, float)
+        self.assertEqual(self.empty_col.dtype, int)
+
+    def test_size(self):
+        """The size is the number of stored values"""
+        self.assertEqual(self.row.size, 2)
+        self.assertEqual(self.empty_col.size, 0)
+
+    def test_len(self):
+        """The length includes zeros"""
+        self.assertEqual(len(self.row), 4)
+        self.assertEqual(len(self.empty_col), 3)
+
+    def test_iter(self):
+        """Iterates over (index, value)"""
+        self.assertEqual(list(self.row), [(1,5.), (3,7.)])
+        self.assertEqual(list(self.empty_col), [])
+
+    def test_todense(self):
+        """Densifies to a 1-dimensional array"""
+        self.assertEqual(self.row.todense(), array([0.,5.,0.,7.]))
+        self.assertEqual(self.empty_col.todense(), array([0,0,0]))
+
+    def test_sum(self):
+        """Sums the stored values"""
+        self.assertEqual(self.row.sum(), 12.)
+        self.assertEqual(self.empty_col.sum(), 0)
+
+    def test_nonzero(self):
+        """Nonzero skips explicitly stored zeros"""
+        v = SparseVectorView(array([0,2,3]), array([1,0,2]), (1,5))
+        self.assertEqual(v.nonzero()[0], array([0,3]))
+
+
+if __name__ == '__main__':
+    main()
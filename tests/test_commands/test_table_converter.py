@@ -139,20 +139,20 @@ biom1 = """{"id": "None","format": "Biological Observation Matrix 1.0.0","format
 
 classic1 = """# Constructed from biom file
 #OTU ID\tf2\tf1\tf3\tf4\tp2\tp1\tt1\tnot16S.1\tt2\ttaxonomy
-295053\t20.0\t18.0\t18.0\t22.0\t4.0\t0.0\t0.0\t0.0\t0.0\tk__Bacteria
-42684\t0.0\t0.0\t0.0\t0.0\t1.0\t0.0\t0.0\t0.0\t0.0\tk__Bacteria; p__Proteobacteria
-None11\t1.0\t0.0\t0.0\t0.0\t1.0\t1.0\t0.0\t0.0\t0.0\tUnclassified
-None10\t0.0\t0.0\t0.0\t0.0\t0.0\t0.0\t1.0\t0.0\t0.0\tUnclassified
-None7\t0.0\t0.0\t0.0\t0.0\t1.0\t0.0\t0.0\t0.0\t0.0\tUnclassified
-None6\t0.0\t0.0\t0.0\t0.0\t0.0\t0.0\t0.0\t20.0\t0.0\tUnclassified
-None5\t0.0\t0.0\t0.0\t0.0\t1.0\t0.0\t0.0\t0.0\t0.0\tk__Bacteria
-None4\t0.0\t0.0\t0.0\t0.0\t1.0\t1.0\t0.0\t0.0\t0.0\tUnclassified
-None3\t0.0\t0.0\t0.0\t0.0\t1.0\t0.0\t2.0\t0.0\t3.0\tk__Bacteria
-None2\t0.0\t0.0\t0.0\t0.0\t0.0\t0.0\t0.0\t2.0\t0.0\tk__Bacteria
-None1\t0.0\t0.0\t0.0\t0.0\t0.0\t1.0\t0.0\t0.0\t0.0\tUnclassified
-879972\t0.0\t0.0\t0.0\t0.0\t9.0\t20.0\t1.0\t0.0\t4.0\tk__Bacteria
-None9\t0.0\t0.0\t0.0\t0.0\t3.0\t0.0\t19.0\t0.0\t15.0\tUnclassified
-None8\t1.0\t4.0\t4.0\t0.0\t0.0\t0.0\t0.0\t0.0\t0.0\tk__Bacteria"""
+295053\t20\t18\t18\t22\t4\t0\t0\t0\t0\tk__Bacteria
+42684\t0\t0\t0\t0\t1\t0\t0\t0\t0\tk__Bacteria; p__Proteobacteria
+None11\t1\t0\t0\t0\t1\t1\t0\t0\t0\tUnclassified
+None10\t0\t0\t0\t0\t0\t0\t1\t0\t0\tUnclassified
+None7\t0\t0\t0\t0\t1\t0\t0\t0\t0\tUnclassified
+None6\t0\t0\t0\t0\t0\t0\t0\t20\t0\tUnclassified
+None5\t0\t0\t0\t0\t1\t0\t0\t0\t0\tk__Bacteria
+None4\t0\t0\t0\t0\t1\t1\t0\t0\t0\tUnclassified
+None3\t0\t0\t0\t0\t1\t0\t2\t0\t3\tk__Bacteria
+None2\t0\t0\t0\t0\t0\t0\t0\t2\t0\tk__Bacteria
+None1\t0\t0\t0\t0\t0\t1\t0\t0\t0\tUnclassified
+879972\t0\t0\t0\t0\t9\t20\t1\t0\t4\tk__Bacteria
+None9\t0\t0\t0\t0\t3\t0\t19\t0\t15\tUnclassified
+None8\t1\t4\t4\t0\t0\t0\t0\t0\t0\tk__Bacteria"""
 
 sample_md1 = """#SampleID\tfoo
 f4\ta;b;c
@@ -87,8 +87,8 @@ Table density (fraction of non-zero values): 0.238
 Table md5 (unzipped): 27c6ffe253527068c82cc1835adeda8f
 
 Counts/sample summary:
- Min: 22.0
- Max: 23.0
+ Min: 22
+ Max: 23
  Median: 22.000
  Mean: 22.222
  Std. dev.: 0.416
@@ -96,15 +96,15 @@ Counts/sample summary:
  Observation Metadata Categories: taxonomy
 
 Counts/sample detail:
- p2: 22.0
- f1: 22.0
- f2: 22.0
- f3: 22.0
- f4: 22.0
- t2: 22.0
- not16S.1: 22.0
- t1: 23.0
- p1: 23.0"""
+ p2: 22
+ f1: 22
+ f2: 22
+ f3: 22
+ f4: 22
+ t2: 22
+ not16S.1: 22
+ t1: 23
+ p1: 23"""
 
 summary_suppress_md5 = """Num samples: 9
 Num observations: 14
@@ -112,8 +112,8 @@ Total count: 200
 Table density (fraction of non-zero values): 0.238
 
 Counts/sample summary:
- Min: 22.0
- Max: 23.0
+ Min: 22
+ Max: 23
  Median: 22.000
  Mean: 22.222
  Std. dev.: 0.416
@@ -121,15 +121,15 @@ Counts/sample summary:
  Observation Metadata Categories: taxonomy
 
 Counts/sample detail:
- p2: 22.0
- f1: 22.0
- f2: 22.0
- f3: 22.0
- f4: 22.0
- t2: 22.0
- not16S.1: 22.0
- t1: 23.0
- p1: 23.0"""
+ p2: 22
+ f1: 22
+ f2: 22
+ f3: 22
+ f4: 22
+ t2: 22
+ not16S.1: 22
+ t1: 23
+ p1: 23"""
 
 summary_qualitative = """Num samples: 9
 Num observations: 14
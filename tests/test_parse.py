@@ -11,7 +11,7 @@
 import h5py
 import os
 from biom import __version__
-from numpy import array, nan
+from numpy import array, nan, dtype, int32, int64
 from StringIO import StringIO
 import json
 from biom.unit_test import TestCase,main
@@ -19,10 +19,11 @@ from biom.parse import (parse_biom_table_json, parse_biom_table,
         parse_classic_table_to_rich_table,
         convert_biom_to_table, convert_table_to_biom,
         parse_classic_table, generatedby, MetadataMap,
-        parse_biom_table_hdf5)
+        parse_biom_table_hdf5, parse_biom_table_stream, direct_index_keys,
+        direct_parse_key, direct_slice_data, get_axis_indices)
 
 from biom.table import Table
-from biom.exception import BiomParseException
+from biom.exception import BiomParseException, UnknownID
 
 __author__ = "Justin Kuczynski"
 __copyright__ = "Copyright 2011-2013, The BIOM Format Development Team"
@@ -129,6 +130,71 @@ class ParseTests(TestCase):
                array([0., 1., 1., 0., 0., 0.])]
         self.assertEqual(list(t.iterObservationData()), exp)
 
+    def test_parse_biom_table_hdf5_lazy(self):
+        """Lazily parse a hdf5 formatted BIOM table"""
+        cwd = os.getcwd()
+        if '/' in __file__:
+            os.chdir(__file__.rsplit('/', 1)[0])
+        h5grp = h5py.File('test_data/test.biom', 'r')
+        os.chdir(cwd)
+
+        exp = parse_biom_table_hdf5(h5grp)
+        t = parse_biom_table_hdf5(h5grp, lazy=True)
+        self.assertTrue(t.H5Group is h5grp)
+        self.assertEqual(t.SampleIds, exp.SampleIds)
+        self.assertEqual(t.ObservationMetadata, exp.ObservationMetadata)
+
+        self.assertEqual(t.sampleData('Sample4'), array([0., 2., 4., 0., 0.]))
+        self.assertEqual(t.observationData('GG_OTU_3'),
+                         array([0., 0., 1., 4., 0., 2.]))
+        self.assertEqual(list(t.iterSampleData()), list(exp.iterSampleData()))
+        obs = t.filterSamples(lambda v, id_, md: v.sum() > 4)
+        self.assertEqual(obs.SampleIds, ('Sample1', 'Sample4'))
+        self.assertTrue(t._data.is_lazy)
+
+        # anything else loads the matrix
+        self.assertEqual(t, exp)
+        self.assertEqual(t.sum('sample'), exp.sum('sample'))
+        self.assertFalse(t._data.is_lazy)
+        h5grp.close()
+
+    def test_parse_biom_table_hdf5_subset(self):
+        """Parse only the requested IDs of a hdf5 formatted BIOM table"""
+        cwd = os.getcwd()
+        if '/' in __file__:
+            os.chdir(__file__.rsplit('/', 1)[0])
+        h5grp = h5py.File('test_data/test.biom', 'r')
+        os.chdir(cwd)
+
+        full = parse_biom_table_hdf5(h5grp)
+
+        t = parse_biom_table_hdf5(h5grp, sample_ids=['Sample4', 'Sample2'])
+        self.assertEqual(t.SampleIds, ('Sample4', 'Sample2'))
+        self.assertEqual(t.ObservationIds, full.ObservationIds)
+        self.assertEqual(t.SampleMetadata, (full.SampleMetadata[3],
+                                            full.SampleMetadata[1]))
+        self.assertEqual(t.sampleData('Sample4'), full.sampleData('Sample4'))
+        self.assertEqual(t.sampleData('Sample2'), full.sampleData('Sample2'))
+
+        t = parse_biom_table_hdf5(h5grp, order='sample',
+                                  observation_ids=['GG_OTU_3'])
+        self.assertEqual(t.SampleIds, full.SampleIds)
+        self.assertEqual(t.ObservationIds, ('GG_OTU_3',))
+        self.assertEqual(t.ObservationMetadata, (full.ObservationMetadata[2],))
+        self.assertEqual(t.observationData('GG_OTU_3'),
+                         array([0., 0., 1., 4., 0., 2.]))
+
+        t = parse_biom_table_hdf5(h5grp, sample_ids=['Sample6', 'Sample1'],
+                                  observation_ids=['GG_OTU_4', 'GG_OTU_2'])
+        self.assertEqual(t.observationData('GG_OTU_4'), array([1., 2.]))
+        self.assertEqual(t.observationData('GG_OTU_2'), array([1., 5.]))
+
+        self.assertRaises(UnknownID, parse_biom_table_hdf5, h5grp,
+                          sample_ids=['Sample1', 'foo'])
+        self.assertRaises(ValueError, parse_biom_table_hdf5, h5grp,
+                          lazy=True, sample_ids=['Sample1'])
+        h5grp.close()
+
     def test_generatedby(self):
         """get a generatedby string"""
         exp = "BIOM-Format %s" % __version__
@@ -233,6 +299,128 @@ class ParseTests(TestCase):
         self.assertEqual(tab.SampleMetadata,None)
         self.assertEqual(tab.ObservationMetadata,None)
 
+    def test_parse_biom_table_stream(self):
+        """Streamed parse matches the full json parse"""
+        exp = parse_biom_table(self.biom_minimal_sparse)
+        for block_size in [1, 7, 64, 2**20]:
+            obs = parse_biom_table_stream(StringIO(self.biom_minimal_sparse),
+                                          block_size=block_size)
+            self.assertEqual(obs, exp)
+            self.assertEqual(dtype(obs._dtype), int32)
+
+        obs = parse_biom_table(self.biom_minimal_sparse.splitlines(True),
+                               streaming=True)
+        self.assertEqual(obs, exp)
+
+    def test_parse_biom_table_int_dtype(self):
+        """int tables are stored compactly unless a dtype is given"""
+        for streaming in (False, True):
+            obs = parse_biom_table(self.biom_minimal_sparse,
+                                   streaming=streaming)
+            self.assertEqual(dtype(obs._dtype), int32)
+
+            obs = parse_biom_table(self.biom_minimal_sparse,
+                                   streaming=streaming, int_dtype=int64)
+            self.assertEqual(dtype(obs._dtype), int64)
+
+            big = self.biom_minimal_sparse.replace('[0,2,1]', '[0,2,3000000000]')
+            self.assertNotEqual(big, self.biom_minimal_sparse)
+            obs = parse_biom_table(big, streaming=streaming)
+            self.assertEqual(dtype(obs._dtype), int64)
+            self.assertEqual(obs.getValueByIds('GG_OTU_1', 'Sample3'),
+                             3000000000)
+
+    def test_parse_biom_table_stream_nested_data_key(self):
+        """Only the top-level data key is streamed"""
+        exp = parse_biom_table(biom_tricky_metadata)
+        for block_size in [1, 5, 2**20]:
+            obs = parse_biom_table_stream(biom_tricky_metadata,
+                                          block_size=block_size)
+            self.assertEqual(obs, exp)
+        self.assertEqual(obs.ObservationMetadata[0]['note'],
+                         '"data": [[9, 9, 9]] \\')
+        self.assertEqual(obs.sampleData('S2'), array([0.5, 0.0]))
+
+    def test_parse_biom_table_stream_incomplete(self):
+        """Streamed parse complains about truncated input"""
+        self.assertRaises(BiomParseException, parse_biom_table_stream,
+                          self.biom_minimal_sparse[:-20])
+        self.assertRaises(BiomParseException, parse_biom_table_stream,
+                          '{"id": null, "shape": [1, 1]}')
+
+    def test_direct_index_keys(self):
+        """Indexes the top-level keys in a single pass"""
+        index = direct_index_keys(self.biom_minimal_sparse)
+        self.assertEqual(sorted(index), ['columns', 'data', 'date',
+            'format', 'format_url', 'generated_by', 'id', 'matrix_element_type',
+            'matrix_type', 'rows', 'shape', 'type'])
+        # the unindexed scan does not handle null values
+        self.assertEqual(direct_parse_key(self.biom_minimal_sparse, 'id',
+                                          index), '"id":null')
+        for key in set(index) - set(['id']):
+            self.assertEqual(
+                direct_parse_key(self.biom_minimal_sparse, key, index),
+                direct_parse_key(self.biom_minimal_sparse, key).rstrip())
+        self.assertEqual(direct_parse_key(self.biom_minimal_sparse, 'foo',
+                                          index), "")
+
+        # nested keys and escaped quotes are not indexed
+        index = direct_index_keys(biom_tricky_metadata)
+        self.assertEqual(direct_parse_key(biom_tricky_metadata, 'data', index),
+            '"data" : [[0, 0, 1.0], [0, 1, 0.5],\n          [1, 0, 2.0]]')
+        self.assertEqual(direct_parse_key(biom_tricky_metadata, 'id', index),
+                         '"id": null')
+        obs = json.loads('{%s}' % direct_parse_key(biom_tricky_metadata,
+                                                   'rows', index))
+        self.assertEqual(obs['rows'][1]['metadata'], {'data': [[1, 2, 3]]})
+
+        self.assertRaises(BiomParseException, direct_index_keys,
+                          self.biom_minimal_sparse[:-20])
+
+    def test_direct_slice_data(self):
+        """Slices and remaps the data triples"""
+        obs = direct_slice_data(self.biom_minimal_sparse, [3, 1],
+                                'observations')
+        self.assertEqual(obs, '"data": [[0,0,5],[0,1,1],[0,3,2],[0,4,3],'
+                              '[0,5,1],[1,0,2],[1,1,1],[1,2,1],[1,5,1]], '
+                              '"shape": [2, 6]')
+
+        obs = direct_slice_data(self.biom_minimal_sparse, [4], 'samples')
+        self.assertEqual(obs, '"data": [[1,0,3],[2,0,2]], "shape": [5, 1]')
+
+        obs = direct_slice_data(biom_tricky_metadata, [1], 'samples')
+        self.assertEqual(obs, '"data": [[0,0,0.5]], "shape": [2, 1]')
+
+        obs = direct_slice_data(biom_tricky_metadata, [1], 'observations')
+        self.assertEqual(obs, '"data": [[0,0,2.0]], "shape": [1, 2]')
+
+        # retained values are copied through as written
+        float_sparse = self.biom_minimal_sparse.replace(
+                '"matrix_element_type": "int"', '"matrix_element_type": "float"')
+        float_sparse = float_sparse.replace('[1,0,5]', '[1,0,5e-1]')
+        obs = direct_slice_data(float_sparse, [1, 2], 'observations')
+        self.assertEqual(obs, '"data": [[0,0,5e-1],[0,1,1],[0,3,2],[0,4,3],'
+                              '[0,5,1],[1,2,1],[1,3,4],[1,4,2]], '
+                              '"shape": [2, 6]')
+
+        self.assertRaises(IndexError, direct_slice_data,
+                          self.biom_minimal_sparse, [5], 'observations')
+
+    def test_direct_slice_data_index(self):
+        """Slicing with a key index matches slicing without one"""
+        index = direct_index_keys(self.biom_minimal_sparse)
+        for axis, to_keep in [('observations', [1, 3]), ('samples', [0, 5])]:
+            self.assertEqual(
+                direct_slice_data(self.biom_minimal_sparse, to_keep, axis,
+                                  index),
+                direct_slice_data(self.biom_minimal_sparse, to_keep, axis))
+
+        self.assertEqual(
+            get_axis_indices(self.biom_minimal_sparse, ['GG_OTU_2'],
+                             'observations', index),
+            get_axis_indices(self.biom_minimal_sparse, ['GG_OTU_2'],
+                             'observations'))
+
     def test_parse_biom_table_str(self):
         """tests for parse_biom_table_str"""
         # this method is tested through parse_biom_table tests
@@ -351,6 +539,15 @@ biom_minimal_sparse="""
     }
 """
 
+biom_tricky_metadata = r"""{"id": null, "format": "Biological Observation Matrix 1.0.0",
+"data" : [[0, 0, 1.0], [0, 1, 0.5],
+          [1, 0, 2.0]],
+"rows": [{"id": "O1", "metadata": {"note": "\"data\": [[9, 9, 9]] \\"}},
+         {"id": "O2", "metadata": {"data": [[1, 2, 3]]}}],
+"columns": [{"id": "S1", "metadata": null}, {"id": "S2", "metadata": null}],
+"matrix_type": "sparse", "matrix_element_type": "float", "shape": [2, 2]}
+"""
+
 classic_otu_table1_w_tax = """#Full OTU Counts
 #OTU ID	PC.354	PC.355	PC.356	PC.481	PC.593	PC.607	PC.634	PC.635	PC.636	Consensus Lineage
 0	0	0	0	0	0	0	0	1	0	Root;Bacteria;Firmicutes;Clostridia;Clostridiales;Lachnospiraceae
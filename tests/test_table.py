@@ -10,7 +10,9 @@
 
 import h5py
 import os
+from StringIO import StringIO
 from tempfile import mktemp
+import numpy as np
 from numpy import where, zeros, array
 from biom.unit_test import TestCase, main
 from biom.util import unzip
@@ -19,8 +21,8 @@ from biom.table import (TableException, Table, UnknownID,
                         list_dict_to_nparray, table_factory,
                         list_list_to_nparray, to_sparse,
                         nparray_to_sparseobj, list_nparray_to_sparseobj,
-                        SparseObj, get_zerod_matrix)
-from biom.parse import parse_biom_table_hdf5
+                        SparseObj, get_zerod_matrix, merge_tables)
+from biom.parse import parse_biom_table_hdf5, parse_biom_table
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2011-2013, The BIOM Format Development Team"
@@ -49,6 +51,11 @@ class SupportTests(TestCase):
         obs = get_zerod_matrix(foo)
         self.assertEqual(obs,exp)
 
+        obs = get_zerod_matrix(array([[1,2]]), dtype=int)
+        self.assertEqual(obs.dtype, int)
+        obs = get_zerod_matrix(foo, dtype=int)
+        self.assertEqual(obs.dtype, int)
+
     def test_table_factory_sparseobj_nparray(self):
         """beat the table_factory sparsely to death"""
         # nparray test
@@ -264,6 +271,56 @@ class TableTests(TestCase):
         obs = parse_biom_table_hdf5(h5)
         self.assertEqual(obs, self.st_rich)
 
+    def test_format_hdf5_filters(self):
+        """Write a compressed, chunked file with narrowed dtypes"""
+        fname = mktemp()
+        self.to_remove.append(fname)
+        int_table = Table(to_sparse(self.vals, dtype=int), ['a','b'],['1','2'])
+        h5 = h5py.File(fname, 'w')
+        int_table.format_hdf5(h5, 'tests', compression='gzip',
+                              compression_opts=4, shuffle=True, chunks=16,
+                              narrow_dtypes=True)
+        h5.close()
+
+        h5 = h5py.File(fname, 'r')
+        data = h5['observation/data']
+        self.assertEqual(data.compression, 'gzip')
+        self.assertEqual(data.compression_opts, 4)
+        self.assertTrue(data.shuffle)
+        self.assertEqual(data.chunks, (4,))
+        self.assertEqual(data.dtype, np.uint32)
+        self.assertEqual(h5['observation/indices'].dtype, np.uint8)
+        self.assertEqual(h5['sample/indptr'].dtype, np.uint8)
+
+        obs = parse_biom_table_hdf5(h5)
+        self.assertEqual(obs, int_table)
+        self.assertEqual(obs._data.dtype, np.uint32)
+        h5.close()
+
+        # integer tables keep their dtype without narrowing
+        fname = mktemp()
+        self.to_remove.append(fname)
+        int32_table = Table(to_sparse(self.vals, dtype=np.int32), ['a','b'],
+                            ['1','2'])
+        h5 = h5py.File(fname, 'w')
+        int32_table.format_hdf5(h5, 'tests')
+        self.assertEqual(h5['sample/data'].dtype, np.int32)
+        self.assertEqual(parse_biom_table_hdf5(h5)._data.dtype, np.int32)
+        h5.close()
+
+        # floats are not narrowed and empty datasets are not filtered
+        fname = mktemp()
+        self.to_remove.append(fname)
+        empty_table = Table(to_sparse({(0,0):0.0}, transpose=False),
+                            ['a'], ['1'])
+        h5 = h5py.File(fname, 'w')
+        empty_table.format_hdf5(h5, 'tests', compression='lzf',
+                                narrow_dtypes=True)
+        self.assertEqual(h5['sample/data'].dtype, np.float64)
+        self.assertEqual(h5['sample/data'].compression, None)
+        self.assertEqual(h5['sample/indptr'].compression, 'lzf')
+        h5.close()
+
     def test_getSampleIndex(self):
         """returns the sample index"""
         self.assertEqual(0, self.simple_derived.getSampleIndex(1))
@@ -515,6 +572,19 @@ class TableTests(TestCase):
         self.assertRaises(UnknownID, t1.getValueByIds, 'a', 1)
         self.assertRaises(UnknownID, t2.getValueByIds, 0, 0)
 
+    def test_getValuesByIds(self):
+        """Return the values located in the matrix by pairs of ids"""
+        t = Table(to_sparse({(0,0):5,(0,1):0,(1,0):7,(1,1):8}), ['a','b'],
+                  ['c','d'])
+
+        obs = t.getValuesByIds(['c','d','d','c'], ['a','b','a','b'])
+        self.assertEqual(obs, array([5,8,7,0]))
+        self.assertEqual(len(t.getValuesByIds([], [])), 0)
+
+        self.assertRaises(UnknownID, t.getValuesByIds, ['c','x'], ['a','a'])
+        self.assertRaises(UnknownID, t.getValuesByIds, ['c'], ['c'])
+        self.assertRaises(TableException, t.getValuesByIds, ['c'], [])
+
     def test_getitem(self):
         """getitem should work as expeceted"""
         self.assertEqual(self.simple_derived[0,0], 5)
@@ -560,6 +630,13 @@ class SparseTableTests(TestCase):
 
         self.empty_st = Table(to_sparse([]), [], [])
 
+        # an "int" table as parsed from JSON, stored in a compact int dtype
+        int_rich = Table(to_sparse(self.vals, dtype=int), ['a','b'],['1','2'],
+                [{'barcode':'aatt'},{'barcode':'ttgg'}],
+                [{'taxonomy':['k__a','p__b']},{'taxonomy':['k__a','p__c']}])
+        self.parsed_int_st = parse_biom_table(
+                int_rich.getBiomFormatJsonString('foo'))
+
         self.vals5 = to_sparse({(0,1):2,(1,1):4})
         self.st5 = Table(self.vals5, ['a','b'],['5','6'])
 
@@ -595,6 +672,29 @@ class SparseTableTests(TestCase):
         self.assertEqual(self.st1.reduce(f, 'sample'), array([17,20]))
         self.assertEqual(self.st1.reduce(f, 'observation'), array([16,22]))
 
+    def test_reduce_sparse(self):
+        """Reduce with common reductions computed on the nonzero values"""
+        from operator import add, mul, and_, or_, xor
+        data = nparray_to_sparseobj(array([[1,0,3],[5,6,0],[0,0,0],[-2,1,7]]),
+                                    int)
+        st = Table(data, ['a','b','c'], ['w','x','y','z'])
+
+        for f in (add, mul, max, min, and_, or_, xor, np.add, np.maximum,
+                  np.logical_or):
+            for axis, vectors in (('sample', st.iterSampleData()),
+                                  ('observation', st.iterObservationData())):
+                exp = array([reduce(f, v) for v in vectors])
+                obs = st.reduce(f, axis)
+                self.assertEqual(obs, exp)
+                self.assertEqual(obs.dtype, exp.dtype)
+
+        # an overflowing product is still zero if the vector has a zero
+        big = nparray_to_sparseobj(array([[1e300, 1e300, 0]]))
+        st = Table(big, ['a','b','c'], ['x'])
+        self.assertEqual(st.reduce(mul, 'observation'), array([0.]))
+
+        self.assertRaises(TableException, st.reduce, add, 'foo')
+
     def test_transpose(self):
         """Should transpose a sparse table"""
         obs = self.st1.transpose()
@@ -635,6 +735,13 @@ class SparseTableTests(TestCase):
         obs = self.st1.sortSampleOrder(['b','a'])
         self.assertEqual(obs,exp)
 
+        obs = self.st_rich.sortSampleOrder(['b','a'])
+        self.assertEqual(obs.SampleMetadata,
+                         ({'barcode':'ttgg'}, {'barcode':'aatt'}))
+        self.assertEqual(obs.ObservationMetadata,
+                         self.st_rich.ObservationMetadata)
+        self.assertEqual(obs.sampleData('b'), array([6, 8]))
+
     def test_sortBySampleId(self):
         """sort by samples by a function"""
         sort_f = sorted
@@ -683,6 +790,14 @@ class SparseTableTests(TestCase):
         obs = list(st.nonzero())
         self.assertEqual(obs, exp)
 
+        obs = list(st.nonzero(chunk_size=2))
+        self.assertEqual(obs, exp)
+
+        # ids are returned as is
+        st = Table(to_sparse({(0,0):0,(0,1):2,(1,0):1,(1,1):0}),
+                   [('a',1),('b',2)], [1,2])
+        self.assertEqual(list(st.nonzero()), [(1,('b',2)), (2,('a',1))])
+
     def test_nonzeroCounts(self):
         """Returns nonzero counts over an axis"""
         data = {(0,0):5,(0,1):6,(0,2):0,(0,3):3,
@@ -702,6 +817,32 @@ class SparseTableTests(TestCase):
         self.assertEqual(obs_obs, exp_obs)
         self.assertEqual(obs_whole, exp_whole)
 
+    def test_int32_sums_do_not_wrap(self):
+        """Sums of int32 tables are accumulated in the platform int"""
+        from operator import add
+        st = Table(to_sparse({(0,0):2**30,(1,0):2**30,(2,0):2**30,(0,1):1},
+                             dtype=np.int32), ['a','b'], ['1','2','3'])
+        exp = array([3 * 2**30, 1])
+        self.assertEqual(st.reduce(add, 'sample'), exp)
+        self.assertEqual(st.nonzeroCounts('sample'), exp)
+        self.assertEqual(st.sum('sample'), exp)
+        self.assertEqual(st.reduce(np.maximum, 'sample'), array([2**30, 1]))
+
+        big = 2**31 - 10
+        st = Table(to_sparse({(0,0):big,(0,1):big}, dtype=np.int32),
+                   ['a','b'], ['1'], [{'g':1},{'g':1}])
+        self.assertEqual(st.merge(st).sampleData('a'), array([2 * big]))
+        self.assertEqual(merge_tables([st, st]).sampleData('a'),
+                         array([2 * big]))
+
+        f = lambda md: md['g']
+        obs = st.collapseSamplesByMetadata(f, norm=False)
+        self.assertEqual(obs.sampleData(1), array([2 * big]))
+        obs = st.collapseSamplesByMetadata(f)
+        self.assertEqual(obs.sampleData(1), array([big]))
+        obs = st.transpose().collapseObservationsByMetadata(f, norm=False)
+        self.assertEqual(obs.observationData(1), array([2 * big]))
+
     def test_nonzeroCounts_binary(self):
         """Returns nonzero counts over an axis"""
         data = {(0,0):5,(0,1):6,(0,2):0,(0,3):3,
@@ -721,6 +862,75 @@ class SparseTableTests(TestCase):
         self.assertEqual(obs_obs, exp_obs)
         self.assertEqual(obs_whole, exp_whole)
 
+    def test_remap_coo(self):
+        """Remap values into a new id space"""
+        rows, cols, values = self.st1._remap_coo({'2':0, '3':1},
+                                                 {'c':0, 'b':1, 'a':2})
+        obs = sorted(zip(rows, cols, values))
+        self.assertEqual(obs, [(0,1,8), (0,2,7)])
+
+        rows, cols, values = self.st1._remap_coo({}, {'a':0})
+        self.assertEqual(len(rows), 0)
+        self.assertEqual(len(values), 0)
+
+    def test_merge_tables(self):
+        """Merge many tables at once"""
+        u = 'union'
+        i = 'intersection'
+
+        tables = [self.st1, self.st3, self.st_rich]
+        for samp in (u, i):
+            for obs in (u, i):
+                exp = self.st1.merge(self.st3, samp, obs).merge(self.st_rich,
+                                                                samp, obs)
+                self.assertEqual(merge_tables(tables, samp, obs), exp)
+
+        data = to_sparse({(0,0):15,(0,1):18,(1,0):21,(1,1):24})
+        exp = Table(data, ['a','b'], ['1','2'],
+                [{'barcode':'aatt'},{'barcode':'ttgg'}],
+                [{'taxonomy':['k__a','p__b']},{'taxonomy':['k__a','p__c']}])
+        obs = merge_tables([self.st1, self.st_rich, self.st1])
+        self.assertEqual(obs, exp)
+
+        # metadata functions are called as in the pairwise merges
+        f = lambda x, y: {'n': 2 * (x['n'] if x else 0) + (y['n'] if y else 1)}
+        tables = [Table(to_sparse(dict(((0,j),j + 1) for j in range(len(ns)))),
+                        ids, ['1'], [{'n':n} for n in ns])
+                  for ids, ns in ((['a','b'], [1,2]), (['b','c'], [3,4]),
+                                  (['a','b','c'], [5,6,7]))]
+        for samp in (u, i):
+            exp = tables[0].merge(tables[1], samp, sample_metadata_f=f)
+            exp = exp.merge(tables[2], samp, sample_metadata_f=f)
+            obs = merge_tables(tables, samp, sample_metadata_f=f)
+            self.assertEqual(obs.SampleIds, exp.SampleIds)
+            self.assertEqual(obs.SampleMetadata, exp.SampleMetadata)
+
+        # integer tables stay integer and are summed in the platform int,
+        # mixing in a float table promotes
+        int_table = Table(to_sparse(self.vals, dtype=np.int32), ['a','b'],
+                          ['1','2'])
+        obs = merge_tables([int_table, int_table])
+        self.assertEqual(np.dtype(obs._dtype), np.int64)
+        self.assertEqual(np.dtype(int_table.merge(int_table)._dtype),
+                         np.int64)
+        float_table = Table(to_sparse({(0,0):0.5}), ['a'], ['1'])
+        obs = merge_tables([int_table, float_table])
+        self.assertEqual(np.dtype(obs._dtype), np.float64)
+
+        fname = mktemp()
+        try:
+            with open(fname, 'w') as f:
+                f.write(self.st3.getBiomFormatJsonString('tests'))
+            obs = merge_tables([self.st1, fname], i, u)
+            self.assertEqual(obs, self.st1.merge(self.st3, i, u))
+        finally:
+            os.remove(fname)
+
+        self.assertRaises(TableException, merge_tables, [self.st1, self.st4],
+                          i, i)
+        self.assertRaises(TableException, merge_tables, [self.st1], 'foo')
+        self.assertRaises(TableException, merge_tables, [])
+
     def test_merge(self):
         """Merge two tables"""
         u = 'union'
@@ -943,6 +1153,41 @@ class SparseTableTests(TestCase):
         obs = list(gen)
         self.assertEqual(obs, exp)
 
+    def test_iterSampleBlocks(self):
+        """Iterates samples in blocks"""
+        data = nparray_to_sparseobj(array([[1,0,3],[0,0,6]]))
+        st = Table(data, ['a','b','c'], ['1','2'],
+                   [{'x':1},{'x':2},{'x':3}], None)
+
+        obs = list(st.iterSampleBlocks(2))
+        self.assertEqual(len(obs), 2)
+        self.assertEqual(obs[0][0], array([[1,0],[0,0]]))
+        self.assertEqual(obs[0][1], ('a','b'))
+        self.assertEqual(obs[0][2], ({'x':1},{'x':2}))
+        self.assertEqual(obs[1][0], array([[3,6]]))
+        self.assertEqual(obs[1][1], ('c',))
+
+        blocks = list(st.iterSampleBlocks(2, conv_to_np=False))
+        self.assertEqual(blocks[0][0].shape, (2,2))
+        self.assertEqual(blocks[1][0], nparray_to_sparseobj(array([[3],[6]])))
+
+        self.assertRaises(TableException, list, st.iterSampleBlocks(0))
+
+    def test_iterObservationBlocks(self):
+        """Iterates observations in blocks"""
+        obs = list(self.st_rich.iterObservationBlocks(5))
+        self.assertEqual(len(obs), 1)
+        self.assertEqual(obs[0][0], array([[5,6],[7,8]]))
+        self.assertEqual(obs[0][1], ('1','2'))
+        self.assertEqual(obs[0][2], self.st_rich.ObservationMetadata)
+
+        obs = list(self.st1.iterObservationBlocks(1))
+        self.assertEqual(obs[1][0], array([[7,8]]))
+        self.assertEqual(obs[1][2], (None,))
+
+        blocks = list(self.st1.iterObservationBlocks(1, conv_to_np=False))
+        self.assertEqual(blocks[0][0], nparray_to_sparseobj(array([[5,6]])))
+
     def test_iterSampleData(self):
         """Iterates data by samples"""
         gen = self.st1.iterSampleData()
@@ -1063,6 +1308,43 @@ class SparseTableTests(TestCase):
         self.assertRaises(TableException, self.st_rich.filterObservations, \
                 lambda x,y,z: False)
 
+    def test_filter(self):
+        """Filters by a mask, an index array or a vectorized function"""
+        exp_b = Table(to_sparse({(0,0):6,(1,0):8}), ['b'], ['1','2'],
+                [{'barcode':'ttgg'}], [{'taxonomy':['k__a','p__b']},
+                                       {'taxonomy':['k__a','p__c']}])
+        exp_2 = Table(to_sparse({(0,0):7,(0,1):8}), ['a','b'], ['2'],
+                [{'barcode':'aatt'},{'barcode':'ttgg'}],
+                [{'taxonomy':['k__a','p__c']}])
+
+        obs = self.st_rich.filter(array([False, True]))
+        self.assertEqual(obs, exp_b)
+        obs = self.st_rich.filter([1])
+        self.assertEqual(obs, exp_b)
+        obs = self.st_rich.filter([0], invert=True)
+        self.assertEqual(obs, exp_b)
+        obs = self.st_rich.filter(lambda sums, data: sums > 12)
+        self.assertEqual(obs, exp_b)
+
+        obs = self.st_rich.filter(lambda sums, data: sums > 11,
+                                  axis='observation')
+        self.assertEqual(obs, exp_2)
+        obs = self.st_rich.filter(array([True, False]), axis='observation',
+                                  invert=True)
+        self.assertEqual(obs, exp_2)
+
+        # index arrays can reorder
+        obs = self.st_rich.filter([1, 0])
+        self.assertEqual(obs.SampleIds, ('b','a'))
+        self.assertEqual(obs.sampleData('a'), array([5, 7]))
+
+        self.assertRaises(TableException, self.st_rich.filter,
+                          array([False, False]))
+        self.assertRaises(TableException, self.st_rich.filter,
+                          array([True]))
+        self.assertRaises(TableException, self.st_rich.filter, [0],
+                          axis='foo')
+
     def test_transformObservations(self):
         """Transform observations by arbitrary function"""
         def transform_f(v, id, md):
@@ -1081,6 +1363,72 @@ class SparseTableTests(TestCase):
         obs = self.st1.transformSamples(transform_f)
         self.assertEqual(obs, exp)
 
+    def test_transform_parsed_int_table(self):
+        """Transforms returning floats on int tables are not truncated"""
+        self.assertEqual(self.parsed_int_st._dtype, np.int32)
+
+        obs = self.parsed_int_st.transformSamples(lambda v, id_, md: v / 2.)
+        self.assertEqual(obs.sampleData('a'), array([2.5, 3.5]))
+
+        obs = self.parsed_int_st.transformObservations(
+                lambda v, id_, md: v / float(v.sum()))
+        self.assertFloatEqual(obs.observationData('1'), array([5/11., 6/11.]))
+
+        obs = self.parsed_int_st.transformSamples(lambda v, id_, md: v * 2)
+        self.assertEqual(obs.sampleData('a'), array([10, 14]))
+        self.assertEqual(obs._dtype, np.int32)
+
+    def test_transformSamplesVectorized(self):
+        """Transform samples by a vectorized function"""
+        obs = self.st1.transformSamplesVectorized(np.sqrt)
+        exp = self.st1.transformSamples(lambda v, id_, md: np.sqrt(v))
+        self.assertEqual(obs, exp)
+
+        # per-sample operations through indptr
+        def max_f(values, indptr):
+            maxes = np.maximum.reduceat(values, indptr[:-1])
+            return values / maxes.repeat(np.diff(indptr))
+        obs = self.st1.transformSamplesVectorized(max_f)
+        exp = Table(to_sparse({(0,0):5/7.,(0,1):6/8.,(1,0):1.,(1,1):1.}),
+                    ['a','b'], ['1','2'])
+        self.assertEqual(obs, exp)
+
+        # values mapped to zero are dropped
+        st = Table(to_sparse({(0,0):1,(0,1):2,(1,0):4,(1,1):1}),
+                   ['a','b'], ['1','2'])
+        obs = st.transformSamplesVectorized(np.log2)
+        self.assertEqual(obs.sampleData('a'), array([0., 2.]))
+        self.assertEqual(obs._data.size, 2)
+        self.assertEqual(obs.getValueByIds('1', 'a'), 0)
+
+        obs = st.transformSamplesVectorized(lambda v, p: v - 1)
+        self.assertEqual(obs.getValueByIds('2', 'b'), 0)
+
+        obs = self.st1.transformSamplesVectorized(lambda v, p: v + 1,
+                                                  preserves_zeros=False)
+        exp = self.st1.transformSamples(lambda v, id_, md: v + 1)
+        self.assertEqual(obs, exp)
+
+        self.assertRaises(TableException, self.st1.transformSamplesVectorized,
+                          lambda v, p: v[:1])
+
+    def test_transformObservationsVectorized(self):
+        """Transform observations by a vectorized function"""
+        obs = self.st1.transformObservationsVectorized(np.negative)
+        exp = self.st1.transformObservations(lambda v, id_, md: -v)
+        self.assertEqual(obs, exp)
+
+        def sum_f(values, indptr):
+            sums = np.add.reduceat(values, indptr[:-1])
+            return values / sums.repeat(np.diff(indptr))
+        obs = self.st_rich.transformObservationsVectorized(sum_f)
+        exp = self.st_rich.normSampleByObservation()
+        self.assertEqual(obs, exp)
+
+        obs = self.st5.transformObservationsVectorized(lambda v, p: v * 2 + 1,
+                                                       preserves_zeros=False)
+        self.assertEqual(obs.observationData('5'), array([1, 5]))
+
     def test_normObservationBySample(self):
         """normalize observations by sample"""
         data = to_sparse({(0,0):2,(0,1):0,(1,0):6,(1,1):1})
@@ -1090,6 +1438,15 @@ class SparseTableTests(TestCase):
         obs = st.normObservationBySample()
         self.assertEqual(obs, exp)
 
+        # samples summing to zero remain zero
+        data = to_sparse({(0,0):2,(0,1):0,(1,0):6,(1,1):0})
+        data_exp = to_sparse({(0,0):0.25,(0,1):0,(1,0):0.75,(1,1):0})
+        st = Table(data, ['a','b'],['1','2'])
+        exp = Table(data_exp, ['a','b'], ['1','2'])
+        obs = st.normObservationBySample()
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs.sampleData('b'), array([0., 0.]))
+
     def test_normObservationByMetadata(self):
         """normalize observations by sample"""
         data = to_sparse({(0,0):6,(0,1):0,(1,0):6,(1,1):1})
@@ -1108,6 +1465,13 @@ class SparseTableTests(TestCase):
         obs = st.normSampleByObservation()
         self.assertEqual(obs, exp)
 
+        # integer tables are normalized to floats
+        data = nparray_to_sparseobj(array([[0,2],[2,6],[0,0]]), int)
+        st = Table(data, ['a','b'],['1','2','3'])
+        obs = st.normSampleByObservation()
+        self.assertEqual(obs.observationData('2'), array([0.25, 0.75]))
+        self.assertEqual(obs.observationData('3'), array([0., 0.]))
+
     def test_binSamplesByMetadata(self):
         """Yield tables binned by sample metadata"""
         f = lambda x: x['age']
@@ -1238,6 +1602,109 @@ class SparseTableTests(TestCase):
         self.assertEqual(obs_phy, [exp_phy1, exp_phy2])
         self.assertEqual(obs_bins, [('k__a','p__b'),('k__a','p__c')])
 
+    def test_collapseSamplesByMetadata(self):
+        """Collapse samples by sample metadata"""
+        f = lambda x: x['age']
+        data = {(0,0):1,(0,1):2,(0,2):3,(0,3):4,
+                (1,0):5,(1,1):6,(1,2):7,(1,3):8,
+                (2,0):8,(2,1):9,(2,2):10,(2,3):11,
+                (3,0):12,(3,1):13,(3,2):14,(3,3):15}
+        samp_md = [{'age':2,'foo':10},{'age':4},{'age':2,'bar':5},{}]
+        t = Table(to_sparse(data), ['1','2','3','4'], ['a','b','c','d'],
+                  samp_md)
+
+        obs = t.collapseSamplesByMetadata(f)
+        self.assertEqual(obs.SampleIds, (2,))
+        self.assertEqual(obs.sampleData(2), array([2., 6., 9., 13.]))
+        self.assertEqual(obs.SampleMetadata[0]['3'], {'age':2,'bar':5})
+
+        obs = t.collapseSamplesByMetadata(f, norm=False, min_group_size=1,
+                                          include_collapsed_metadata=False)
+        self.assertEqual(sorted(obs.SampleIds), [None, 2, 4])
+        self.assertEqual(obs.sampleData(2), array([4., 12., 18., 26.]))
+        self.assertEqual(obs.sampleData(4), array([2., 6., 9., 13.]))
+        self.assertEqual(obs.sampleData(None), array([4., 8., 11., 15.]))
+        self.assertEqual(obs.SampleMetadata, None)
+
+        self.assertRaises(TableException, t.collapseSamplesByMetadata, f,
+                          min_group_size=3)
+
+    def test_collapseByMetadata_parsed_int_table(self):
+        """Normalizing collapsed int tables gives floats"""
+        t = self.parsed_int_st
+        f = lambda md: 'all'
+
+        obs = t.collapseSamplesByMetadata(f, reduce_f=max)
+        self.assertEqual(obs.sampleData('all'), array([3., 4.]))
+
+        obs = t.collapseSamplesByMetadata(f, reduce_f=lambda x, y: x + y)
+        self.assertEqual(obs.sampleData('all'), array([5.5, 7.5]))
+
+        obs = t.collapseObservationsByMetadata(lambda md: md['taxonomy'][0],
+                                               min_group_size=1)
+        self.assertEqual(obs.observationData('k__a'), array([6., 7.]))
+
+    def test_collapseSamplesByMetadata_one_to_many(self):
+        """Collapse samples into multiple bins"""
+        def bin_f(md):
+            for path in md['path']:
+                yield path, path[-1]
+
+        data = {(0,0):1,(0,1):2,(0,2):3,
+                (1,0):4,(1,1):5,(1,2):6}
+        samp_md = [{'path':[('x','a'),('x','b')]},{'path':[('x','b')]},
+                   {'path':[('y','c'),('x','a'),('x','a')]}]
+        t = Table(to_sparse(data, dtype=int), ['s1','s2','s3'], ['o1','o2'],
+                  samp_md)
+
+        obs = t.collapseSamplesByMetadata(bin_f, norm=False, one_to_many=True)
+        self.assertEqual(obs.SampleIds, ('a','b','c'))
+        self.assertEqual(obs.SampleMetadata[0], {'Path':('x','a')})
+        self.assertEqual(obs.sampleData('a'), array([7, 16]))
+        self.assertEqual(obs.sampleData('b'), array([3, 9]))
+        self.assertEqual(obs.sampleData('c'), array([3, 6]))
+
+        obs = t.collapseSamplesByMetadata(bin_f, norm=False, one_to_many=True,
+                                          one_to_many_mode='divide')
+        self.assertEqual(obs.sampleData('a'), array([2.5, 6.]))
+        self.assertEqual(obs.sampleData('b'), array([2.5, 7.]))
+        self.assertEqual(obs.sampleData('c'), array([1., 2.]))
+        self.assertEqual(obs.sum(), t.sum())
+
+    def test_collapseObservationsByMetadata_one_to_many(self):
+        """Collapse observations into multiple bins"""
+        def bin_f(md):
+            tax = md['taxonomy']
+            for i in range(len(tax)):
+                yield tax[:i + 1], tax[i]
+
+        data = {(0,0):1,(0,1):2,
+                (1,0):3,(1,1):4,
+                (2,0):5,(2,1):6}
+        obs_md = [{'taxonomy':['k__a','p__b']},{'taxonomy':['k__a','p__c']},
+                  {'taxonomy':['k__b']}]
+        t = Table(to_sparse(data), ['s1','s2'], ['o1','o2','o3'],
+                  ObservationMetadata=obs_md)
+
+        obs = t.collapseObservationsByMetadata(bin_f, norm=False,
+                                               one_to_many=True)
+        self.assertEqual(obs.ObservationIds, ('k__a','k__b','p__b','p__c'))
+        self.assertEqual(obs.ObservationMetadata[2], {'Path':['k__a','p__b']})
+        self.assertEqual(obs.observationData('k__a'), array([4., 6.]))
+        self.assertEqual(obs.observationData('k__b'), array([5., 6.]))
+        self.assertEqual(obs.observationData('p__c'), array([3., 4.]))
+
+        obs = t.collapseObservationsByMetadata(bin_f, norm=False,
+                one_to_many=True, one_to_many_mode='divide')
+        self.assertEqual(obs.observationData('k__a'), array([2., 3.]))
+        self.assertEqual(obs.observationData('p__b'), array([.5, 1.]))
+        self.assertEqual(obs.sum(), t.sum())
+
+        def bad_f(md):
+            yield md['taxonomy'], md['taxonomy'][1]
+        self.assertRaises(IndexError, t.collapseObservationsByMetadata, bad_f,
+                          norm=False, one_to_many=True, strict=True)
+
     def test_getTableDensity(self):
         """Test correctly computes density of table."""
         # Perfectly dense tables.
@@ -1257,6 +1724,37 @@ class SparseTableTests(TestCase):
         # Tables with some zeros explicitly defined.
         self.assertFloatEqual(self.st7.getTableDensity(), 0.75)
 
+    def test_compact_storage(self):
+        """Test storing the table data in as few bytes as possible."""
+        data = array([[1.5, 0], [0, 2.5]])
+        default = table_factory(data, ['a','b'], ['1','2'])
+        compact = table_factory(data, ['a','b'], ['1','2'], storage='compact')
+        self.assertEqual(compact._dtype, np.float32)
+        self.assertEqual(compact, default)
+        self.assertTrue(compact.getDataNbytes() < default.getDataNbytes())
+
+        compact = table_factory(array([[1, 0], [0, 2]]), ['a','b'],
+                                ['1','2'], dtype=int, storage='compact')
+        self.assertEqual(compact._dtype, np.int32)
+
+        # derived tables keep the storage of the table they come from
+        compact = table_factory(array([[1.5, 0, 2], [0, 2.5, 3]]),
+                                ['a','b','c'], ['1','2'], storage='compact')
+        obs = compact.filterSamples(lambda v, id_, md: id_ != 'b')
+        exp = compact._data.take([0, 2], 1).compact()
+        self.assertEqual(obs._dtype, np.float32)
+        self.assertEqual(obs.getDataNbytes(), exp.nbytes)
+        self.assertEqual(compact.normObservationBySample()._dtype, np.float32)
+        self.assertEqual(compact.merge(compact)._dtype, np.float32)
+
+        with self.assertRaises(TableException):
+            _ = table_factory(data, ['a','b'], ['1','2'], storage='tiny')
+
+    def test_getDataNbytes(self):
+        """Test counting the bytes used by the table data."""
+        self.assertEqual(self.st1.getDataNbytes(), self.st1._data.nbytes)
+        self.assertTrue(self.st1.getDataNbytes() > 0)
+
 class SparseOTUTableTests(TestCase):
     def setUp(self):
         self.vals = {(0,0):5,(1,0):7,(1,1):8}
@@ -1329,5 +1827,42 @@ class SparseOTUTableTests(TestCase):
         del obs['date']
         self.assertFloatEqual(obs, exp)
 
+    def test_getBiomFormatJsonString(self):
+        """Should return a JSON string of the table in Biom format."""
+        obs = self.sot_rich.getBiomFormatJsonString('foo')
+        obs = obs.split('"date": ')[1].split(',', 1)[1]
+        exp = ('"matrix_element_type": "int","shape": [2, 2],'
+               '"data": [[0,0,5],[1,0,7],[1,1,8]],'
+               '"rows": [{"id": "1", "metadata": {"taxonomy": '
+               '["k__a", "p__b"]}},{"id": "2", "metadata": {"taxonomy": '
+               '["k__a", "p__c"]}}],'
+               '"columns": [{"id": "a", "metadata": {"barcode": "aatt"}},'
+               '{"id": "b", "metadata": {"barcode": "ttgg"}}]}')
+        self.assertEqual(obs, exp)
+
+        out = StringIO()
+        self.float_table.getBiomFormatJsonString('foo', direct_io=out)
+        obs = parse_biom_table(out.getvalue())
+        self.assertEqual(obs, self.float_table)
+
+        # compact integer dtypes are written as int
+        int32_table = Table(to_sparse(self.vals, dtype=np.int32), ['a','b'],
+                            ['1','2'])
+        obs = int32_table.getBiomFormatJsonString('foo')
+        self.assertIn('"matrix_element_type": "int"', obs)
+        self.assertIn('[0,0,5]', obs)
+        self.assertEqual(
+            int32_table.getBiomFormatObject('foo')['matrix_element_type'],
+            'int')
+
+    def test_iter_json_data_blocks(self):
+        """Should format the nonzero triples in blocks"""
+        obs = list(self.float_table._iter_json_data_blocks(block_size=2))
+        exp = ['[0,1,2.5],[0,2,3.4]', '[1,0,9.3],[1,1,10.23]', '[1,2,2.2]']
+        self.assertEqual(obs, exp)
+
+        obs = list(self.sot_min._iter_json_data_blocks())
+        self.assertEqual(obs, ['[0,0,5],[1,0,7],[1,1,8]'])
+
 if __name__ == '__main__':
     main()
@@ -10,11 +10,14 @@
 
 from os.path import abspath, dirname, exists
 from tempfile import NamedTemporaryFile
+from numpy import (array, bool_, float16, float32, int32, int64, uint8,
+                   uint64)
 from biom.parse import parse_biom_table
 from biom.unit_test import TestCase, main
 from biom.util import (natsort, _natsort_key, flatten, unzip,
                        get_biom_project_dir, parse_biom_config_files,
-                       compute_counts_per_sample_stats, safe_md5)
+                       compute_counts_per_sample_stats, safe_md5,
+                       compact_dtype, sum_dtype)
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2011-2013, The BIOM Format Development Team"
@@ -105,6 +108,22 @@ class UtilTests(TestCase):
         self.assertEqual(flatten(['aa', 'bb', 'cc']), list('aabbcc'))
         self.assertEqual(flatten([1,[2,3], [[4, [5]]]]), [1, 2, 3, [4,[5]]])
 
+    def test_compact_dtype(self):
+        """compact_dtype narrows floats and integers that fit"""
+        self.assertEqual(compact_dtype(array([1.5, 2.])), float32)
+        self.assertEqual(compact_dtype(array([1.5], dtype=float16)), float16)
+        self.assertEqual(compact_dtype(array([1, 2], dtype=int64)), int32)
+        self.assertEqual(compact_dtype(array([1, 2**40])), int64)
+        self.assertEqual(compact_dtype(array([True])), bool_)
+
+    def test_sum_dtype(self):
+        """sum_dtype widens integers to the platform integer"""
+        self.assertEqual(sum_dtype(int32), int64)
+        self.assertEqual(sum_dtype(uint8), uint64)
+        self.assertEqual(sum_dtype(int64), int64)
+        self.assertEqual(sum_dtype(float32), float32)
+        self.assertEqual(sum_dtype(bool_), bool_)
+
     def test_get_biom_project_dir(self):
         """Getting the biom project directory functions as expected.
 